@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import sys
 
 def get_env_variable(var_name):
     """Get the environment variable or return exception."""
@@ -57,6 +58,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'pugorugh.metrics.MetricsMiddleware',
+    'pugorugh.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -98,6 +101,15 @@ DATABASES = {
     }
 }
 
+# Next-dog, dog and preference reads go to these read replicas (aliases of
+# DATABASES, e.g. a second SQLite file holding a copy of db.sqlite3), and
+# writes to 'default'. A user's reads stick to 'default' for
+# STICKY_SECONDS after each of their writes; the deadlines are kept in the
+# default cache, which must be shared between the worker processes.
+DATABASE_ROUTERS = ['pugorugh.routers.ReplicaRouter']
+PUGORUGH_REPLICA_DATABASES = []
+PUGORUGH_REPLICA_STICKY_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -123,7 +135,8 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'pugorugh.authentication.CachedTokenAuthentication',
+        # 'rest_framework.authentication.TokenAuthentication',
         # 'rest_framework.authentication.BasicAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
     ),
@@ -134,6 +147,74 @@ REST_FRAMEWORK = {
 }
 
 
+# Answer undecided next-dog lookups from an in-memory, NumPy backed index of
+# the dog catalog instead of SQL. Ignored when NumPy is not installed, and
+# unless the default cache is shared between the worker processes (not the
+# default LocMemCache) or PUGORUGH_SINGLE_PROCESS is set: the processes
+# tell each other about dog changes through a counter in that cache.
+PUGORUGH_CATALOG_INDEX = True
+
+# Set when a single process serves the site (runserver, the test runner,
+# the in-process benchmarks), so that its process-local cache counts as
+# shared.
+PUGORUGH_SINGLE_PROCESS = any(
+    command in sys.argv
+    for command in ('runserver', 'test', 'benchmark', 'loadtest'))
+
+# In-process token cache of CachedTokenAuthentication: size, seconds a
+# cached token is trusted, and an optional CACHES alias shared by all
+# processes.
+PUGORUGH_TOKEN_CACHE_SIZE = 10000
+PUGORUGH_TOKEN_CACHE_TTL = 60
+PUGORUGH_TOKEN_CACHE_SHARED = None
+
+# Queue swipe decisions in memory and write them to UserDog in batches from
+# a background thread, every INTERVAL_MS milliseconds or BATCH decisions.
+PUGORUGH_WRITE_BEHIND = False
+PUGORUGH_WRITE_BEHIND_INTERVAL_MS = 200
+PUGORUGH_WRITE_BEHIND_BATCH = 500
+
+# Maintain the DogStats like/dislike counters from the decision actions. The
+# deltas are applied in batches every INTERVAL_MS milliseconds or BATCH
+# pending counters, from a thread writing besides the requests; off by
+# default, run rebuild_dog_stats after turning it on.
+PUGORUGH_DOG_STATS = False
+PUGORUGH_DOG_STATS_INTERVAL_MS = 1000
+PUGORUGH_DOG_STATS_BATCH = 1000
+
+# Default order of the undecided queue: 'id' (oldest dogs first), 'recent'
+# (newest first), 'score' (highest Dog.score first, see the
+# update_dog_scores command) or 'recommended' (most similar to the liked
+# dogs first). Clients may pick another one with ?order=.
+PUGORUGH_UNDECIDED_ORDERING = 'id'
+
+# Rank similar dogs (/api/dog/<pk>/similar/ and the recommended ordering)
+# with NumPy over the in-memory catalog. Without it, or without a default
+# cache shared between the worker processes (see PUGORUGH_CATALOG_INDEX),
+# /api/dog/<pk>/similar/ answers 404 and the recommended ordering falls
+# back to the score ordering.
+PUGORUGH_SIMILARITY = True
+
+# Check the views against their SQL query budgets (see pugorugh.budgets).
+# Breaches are logged; in strict mode, the default under manage.py test,
+# exceeding a query count budget raises.
+PUGORUGH_QUERY_BUDGETS = True
+PUGORUGH_QUERY_BUDGET_STRICT = 'test' in sys.argv
+
+# Profile a SAMPLE_RATE share of the requests (wall, SQL and serializer
+# time, query count, response size) into histograms per URL name, read by
+# staff from /api/stats/profiling/.
+PUGORUGH_PROFILING = False
+PUGORUGH_PROFILING_SAMPLE_RATE = 0.01
+
+# Prometheus counters and histograms served at /metrics. Each worker process
+# writes its values to its own file in METRICS_DIR every INTERVAL_MS, and
+# /metrics sums the files; without a directory it only shows one process.
+PUGORUGH_METRICS = True
+PUGORUGH_METRICS_DIR = os.environ.get('PUGORUGH_METRICS_DIR')
+PUGORUGH_METRICS_INTERVAL_MS = 1000
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.9/topics/i18n/
 
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class PugorughConfig(AppConfig):
     name = 'pugorugh'
+
+    def ready(self):
+        # Connect the signal receivers keeping the caches in sync.
+        from . import authentication, catalog, conditional  # noqa: F401
+        # Register the system checks.
+        from . import checks  # noqa: F401
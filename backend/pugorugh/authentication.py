@@ -0,0 +1,135 @@
+"""
+Token authentication backed by an in-process LRU cache with a TTL, and
+optionally by a shared Django cache.
+
+Enable it by listing `pugorugh.authentication.CachedTokenAuthentication` in
+`REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES']`. Settings:
+
+* `PUGORUGH_TOKEN_CACHE_SIZE`: tokens kept per process (default 10000).
+* `PUGORUGH_TOKEN_CACHE_TTL`: seconds a cached token is trusted (default 60).
+* `PUGORUGH_TOKEN_CACHE_SHARED`: alias of a `CACHES` entry shared by all
+  processes, or None (default) to only cache in process.
+
+Cached tokens are dropped when the token is deleted or its user is saved
+(e.g. deactivated), in this process and in the shared cache. Other
+processes' in-process caches catch up within the TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from . import metrics
+
+
+def _setting(name, default):
+    return getattr(settings, 'PUGORUGH_TOKEN_CACHE_' + name, default)
+
+
+def shared_cache():
+    alias = _setting('SHARED', None)
+    return caches[alias] if alias else None
+
+
+def shared_key(key):
+    return 'pugorugh:token:{}'.format(key)
+
+
+class TokenCache(object):
+    """Thread-safe LRU of token key -> (user, token) with a TTL."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, credentials = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return credentials
+
+    def set(self, key, credentials):
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic() + _setting('TTL', 60), credentials)
+            self._entries.move_to_end(key)
+            while len(self._entries) > _setting('SIZE', 10000):
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for key, (_, (user, _)) in list(self._entries.items()):
+                if user.pk == user_id:
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """`TokenAuthentication` that skips the Token/User query when cached."""
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        metrics.cache_lookup('token', credentials is not None)
+        if credentials is not None:
+            return credentials
+
+        shared = shared_cache()
+        if shared is not None:
+            credentials = shared.get(shared_key(key))
+            metrics.cache_lookup('token-shared', credentials is not None)
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            if shared is not None:
+                shared.set(shared_key(key), credentials, _setting('TTL', 60))
+        token_cache.set(key, credentials)
+        return credentials
+
+
+def forget_token(key):
+    token_cache.discard(key)
+    shared = shared_cache()
+    if shared is not None:
+        shared.delete(shared_key(key))
+
+
+def token_deleted(sender, **kwargs):
+    """Drop a deleted token from the caches."""
+    forget_token(kwargs['instance'].key)
+
+
+def user_saved(sender, **kwargs):
+    """Drop the cached tokens of a saved user, e.g. a deactivated one."""
+    user = kwargs['instance']
+    if kwargs['created']:
+        return
+    token_cache.discard_user(user.pk)
+    if shared_cache() is not None:
+        for key in Token.objects.filter(user=user).values_list(
+                'key', flat=True):
+            forget_token(key)
+
+post_delete.connect(token_deleted, sender=Token)
+post_save.connect(user_saved, sender=get_user_model())
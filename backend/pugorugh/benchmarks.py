@@ -0,0 +1,380 @@
+"""
+Micro benchmarks for the hot paths of the API.
+
+Benchmarks run against a throwaway test database seeded with a synthetic
+catalog (see the `benchmark` management command), never against the
+development database.
+"""
+import random
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.backends.utils import CursorWrapper
+from django.test.utils import override_settings
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import authentication
+from . import cards
+from . import catalog
+from . import decisions
+from . import models
+from . import queries
+from . import serializers
+from . import similarity
+
+
+BREEDS = ('Labrador', 'Boxer', 'Pug', 'Beagle', 'Poodle', 'Bulldog',
+          'Golden Retriever', 'Husky', 'Dachshund', 'Unknown mix')
+GENDERS = ('m', 'f', 'u')
+SIZES = ('s', 'm', 'l', 'xl', 'u')
+
+# Registry of benchmark name -> callable(sizes, repeat, stdout).
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def seed_dogs(count, batch_size=5000, seed=0):
+    """Bulk insert `count` random dogs and return their ids in order."""
+    rng = random.Random(seed)
+    for start in range(0, count, batch_size):
+        dogs = [
+            models.Dog(
+                name='Dog {}'.format(start + i),
+                image_filename='{}.jpg'.format(start + i),
+                breed=rng.choice(BREEDS),
+                age=rng.randrange(0, 200),
+                gender=rng.choice(GENDERS),
+                size=rng.choice(SIZES),
+                neutered=rng.random() < 0.5,
+            )
+            for i in range(min(batch_size, count - start))
+        ]
+        # bulk_create() bypasses save(), which derives the age bucket.
+        for dog in dogs:
+            dog.age_bucket = models.Dog.age_bucket_for(dog.age)
+        models.Dog.objects.bulk_create(dogs)
+    return list(models.Dog.objects.order_by('id').values_list('id', flat=True))
+
+
+def seed_user(username, dog_ids, decided_ratio=0.1, seed=0):
+    """Create a user who already liked or disliked a share of `dog_ids`."""
+    rng = random.Random(seed)
+    user = get_user_model().objects.create(username=username)
+    models.UserDog.objects.bulk_create([
+        models.UserDog(user=user, dog_id=dog_id, status=rng.choice('ld'))
+        for dog_id in dog_ids if rng.random() < decided_ratio
+    ])
+    return user
+
+
+def reset_catalog():
+    models.UserDog.objects.all().delete()
+    models.Dog.objects.all().delete()
+    get_user_model().objects.all().delete()
+
+
+def api_client(user):
+    """Return an APIClient authenticated with a token of `user`."""
+    token, _ = Token.objects.get_or_create(user=user)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+    return client
+
+
+class QueryCounter(object):
+    '''
+    Count the SQL statements run on any connection while active.
+
+    `CaptureQueriesContext` cannot count a benchmark: its log keeps the last
+    9000 queries only, and the test client empties it at the start of every
+    request (`reset_queries` on `request_started`). This wraps the execute
+    methods of the cursors instead, which Django 1.9 has no hook for.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _counting(self, method):
+        def execute(cursor, *args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return method(cursor, *args, **kwargs)
+        return execute
+
+    def __enter__(self):
+        self._originals = (CursorWrapper.execute, CursorWrapper.executemany)
+        CursorWrapper.execute = self._counting(self._originals[0])
+        CursorWrapper.executemany = self._counting(self._originals[1])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CursorWrapper.execute, CursorWrapper.executemany = self._originals
+
+
+def measure(func, repeat):
+    """Return (mean milliseconds, queries per call) of calling `func`."""
+    func()
+    with QueryCounter() as counter:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed * 1000 / repeat, counter.count / repeat
+
+
+def classify_dog_age(age_prefs):
+    age_filter = {}
+    for age_pref in age_prefs.split(','):
+        if age_pref == 'b':
+            age_filter['b'] = range(0, 12)
+        elif age_pref == 'y':
+            age_filter['y'] = range(12, 24)
+        elif age_pref == 'a':
+            age_filter['a'] = range(24, 72)
+        elif age_pref == 's':
+            age_filter['s'] = range(72, 200)
+    return age_filter
+
+
+def create_dog_age_list(age_ranges):
+    age_range_list = []
+    for age_range in age_ranges.values():
+        for x in age_range:
+            age_range_list.append(x)
+    return age_range_list
+
+
+def legacy_undecided_candidates(sizes, genders, ages, ordering='id'):
+    """`queries.undecided_candidates` before the age bucket column."""
+    return models.Dog.objects.filter(
+        age__in=create_dog_age_list(classify_dog_age(','.join(ages))),
+        size__in=sizes,
+        gender__in=genders
+    ).order_by(*queries.ORDER_BY[ordering])
+
+
+def legacy_next_dog_id(user, pk):
+    """The pre-keyset undecided lookup: load every candidate id, bisect."""
+    from bisect import bisect
+
+    (size, gender, age) = models.UserPref.objects.filter(
+        user=user
+    ).values_list('size', 'gender', 'age')[0]
+    age_query = create_dog_age_list(classify_dog_age(age))
+    decided_dog_ids = models.Dog.objects.filter(
+        userdog__user=user
+    ).values_list('id', flat=True)
+    filtered_dogs_ids = list(models.Dog.objects.exclude(
+        id__in=decided_dog_ids
+    ).filter(
+        age__in=age_query,
+        size__in=size.split(','),
+        gender__in=gender.split(',')
+    ).order_by('id').values_list('id', flat=True))
+    if pk >= filtered_dogs_ids[-1]:
+        return -1
+    return models.Dog.objects.get(
+        pk=filtered_dogs_ids[bisect(filtered_dogs_ids, pk)]).pk
+
+
+@benchmark('next_dog')
+def bench_next_dog(sizes, repeat, stdout):
+    """Undecided next-dog lookup, legacy bisect vs keyset, by catalog size."""
+    stdout.write('{:>10} {:>14} {:>14} {:>10}'.format(
+        'dogs', 'legacy ms', 'keyset ms', 'queries'))
+    for size in sizes:
+        reset_catalog()
+        dog_ids = seed_dogs(size)
+        user = seed_user('bench', dog_ids)
+        # Look up from the middle of the catalog, like a user mid-session.
+        pk = dog_ids[len(dog_ids) // 2]
+
+        legacy_ms, _ = measure(lambda: legacy_next_dog_id(user, pk), repeat)
+        with override_settings(PUGORUGH_CATALOG_INDEX=False):
+            keyset_ms, keyset_queries = measure(
+                lambda: queries.next_dog(user, 'undecided', pk), repeat)
+        stdout.write('{:>10} {:>14.3f} {:>14.3f} {:>10.1f}'.format(
+            size, legacy_ms, keyset_ms, keyset_queries))
+
+
+@benchmark('catalog')
+def bench_catalog(sizes, repeat, stdout):
+    """Undecided next-dog lookup, ORM keyset vs in-memory catalog index."""
+    if catalog.numpy is None:
+        stdout.write('NumPy is not installed, the catalog index is disabled.')
+        return
+    stdout.write('{:>10} {:>12} {:>12} {:>12} {:>10}'.format(
+        'dogs', 'orm ms', 'catalog ms', 'load ms', 'queries'))
+    for size in sizes:
+        reset_catalog()
+        dog_ids = seed_dogs(size)
+        user = seed_user('bench', dog_ids)
+        pk = dog_ids[len(dog_ids) // 2]
+
+        with override_settings(PUGORUGH_CATALOG_INDEX=False):
+            orm_ms, _ = measure(
+                lambda: queries.next_dog(user, 'undecided', pk), repeat)
+        load_ms, _ = measure(catalog.get_catalog().load, 1)
+        with override_settings(PUGORUGH_CATALOG_INDEX=True):
+            catalog_ms, catalog_queries = measure(
+                lambda: queries.next_dog(user, 'undecided', pk), repeat)
+        stdout.write('{:>10} {:>12.3f} {:>12.3f} {:>12.3f} {:>10.1f}'.format(
+            size, orm_ms, catalog_ms, load_ms, catalog_queries))
+
+
+@benchmark('age_bucket')
+def bench_age_bucket(sizes, repeat, stdout):
+    '''
+    GetFilteredDog undecided requests, filtering on the literal ages of the
+    buckets vs the age bucket column.
+    '''
+    stdout.write('{:>10} {:>14} {:>14} {:>12} {:>12}'.format(
+        'dogs', 'age__in ms', 'bucket ms', 'age__in q.', 'bucket q.'))
+    for size in sizes:
+        reset_catalog()
+        dog_ids = seed_dogs(size)
+        user = seed_user('bench', dog_ids)
+        # Young and senior dogs: the worst case for age__in.
+        user_pref = models.UserPref.objects.get(user=user)
+        user_pref.age, user_pref.size, user_pref.gender = 'y,s', 's,m', 'f'
+        user_pref.save()
+        client = api_client(user)
+        url = '/api/dog/{}/undecided/next/'.format(
+            dog_ids[len(dog_ids) // 2])
+
+        with override_settings(PUGORUGH_CATALOG_INDEX=False):
+            with mock.patch.object(queries, 'undecided_candidates',
+                                   legacy_undecided_candidates):
+                before_ms, before_queries = measure(
+                    lambda: client.get(url), repeat)
+            after_ms, after_queries = measure(lambda: client.get(url), repeat)
+        stdout.write('{:>10} {:>14.3f} {:>14.3f} {:>12.1f} {:>12.1f}'.format(
+            size, before_ms, after_ms, before_queries, after_queries))
+
+
+@benchmark('bulk_decisions')
+def bench_bulk_decisions(sizes, repeat, stdout):
+    """Decisions/sec, one request per dog vs api/dog/decisions/."""
+    stdout.write('{:>10} {:>16} {:>16} {:>10}'.format(
+        'decisions', 'per-dog dec/s', 'bulk dec/s', 'queries'))
+    for size in sizes:
+        reset_catalog()
+        dog_ids = seed_dogs(size)
+        user = seed_user('bench', dog_ids, decided_ratio=0)
+        client = api_client(user)
+        statuses = ('liked', 'disliked')
+
+        def per_dog():
+            for i, dog_id in enumerate(dog_ids):
+                client.put('/api/dog/{}/{}/'.format(dog_id, statuses[i % 2]))
+
+        def bulk():
+            for start in range(0, len(dog_ids), 500):
+                client.post('/api/dog/decisions/', [
+                    {'dog': dog_id, 'status': 'ld'[i % 2]}
+                    for i, dog_id in enumerate(dog_ids[start:start + 500])
+                ])
+
+        per_dog_ms, _ = measure(per_dog, repeat)
+        bulk_ms, bulk_queries = measure(bulk, repeat)
+        stdout.write('{:>10} {:>16.0f} {:>16.0f} {:>10.1f}'.format(
+            size, size * 1000 / per_dog_ms, size * 1000 / bulk_ms,
+            bulk_queries))
+
+
+@benchmark('token_auth')
+def bench_token_auth(sizes, repeat, stdout):
+    """Token authentication, DRF's Token + User join vs the cached class."""
+    stdout.write('{:>10} {:>12} {:>12} {:>12} {:>12}'.format(
+        'users', 'drf ms', 'drf queries', 'cached ms', 'cached q.'))
+    for size in sizes:
+        reset_catalog()
+        get_user_model().objects.bulk_create([
+            get_user_model()(username='user{}'.format(i))
+            for i in range(size)
+        ])
+        Token.objects.bulk_create([
+            Token(key='{:040d}'.format(i), user=user)
+            for i, user in enumerate(
+                get_user_model().objects.order_by('id'))
+        ])
+        keys = list(Token.objects.values_list('key', flat=True))
+        authentication.token_cache.clear()
+
+        def authenticate_all(authenticator):
+            for key in keys:
+                authenticator.authenticate_credentials(key)
+
+        drf_ms, drf_queries = measure(
+            lambda: authenticate_all(TokenAuthentication()), repeat)
+        cached_ms, cached_queries = measure(
+            lambda: authenticate_all(
+                authentication.CachedTokenAuthentication()), repeat)
+        stdout.write('{:>10} {:>12.3f} {:>12.2f} {:>12.3f} {:>12.2f}'.format(
+            size, drf_ms / size, drf_queries / size,
+            cached_ms / size, cached_queries / size))
+
+
+@benchmark('liked_browsing')
+def bench_liked_browsing(sizes, repeat, stdout):
+    """Pages of 20 liked dogs, fetched and serialized vs cached cards."""
+    stdout.write('{:>10} {:>12} {:>12} {:>12} {:>12}'.format(
+        'dogs', 'fetch ms', 'fetch q.', 'cached ms', 'cached q.'))
+    for size in sizes:
+        reset_catalog()
+        cache.clear()
+        dog_ids = seed_dogs(size)
+        user = seed_user('browser', dog_ids, decided_ratio=0.5)
+        pk = dog_ids[len(dog_ids) // 2]
+
+        def fetch():
+            dogs, _ = queries.next_dogs(user, 'liked', pk, 20)
+            return serializers.DogSerializer(dogs, many=True).data
+
+        def cached():
+            versions, _ = queries.next_decided(user, 'liked', pk, 20)
+            return cards.dog_cards(versions)
+
+        fetch_ms, fetch_queries = measure(fetch, repeat)
+        cached_ms, cached_queries = measure(cached, repeat)
+        stdout.write('{:>10} {:>12.3f} {:>12.2f} {:>12.3f} {:>12.2f}'.format(
+            size, fetch_ms, fetch_queries, cached_ms, cached_queries))
+
+
+@benchmark('similar')
+def bench_similar(sizes, repeat, stdout):
+    """Top 20 similar and recommended dogs ranked over the whole catalog."""
+    if not similarity.is_enabled():
+        stdout.write('NumPy is not installed, similar dogs are disabled.')
+        return
+    stdout.write('{:>10} {:>12} {:>16} {:>12} {:>10}'.format(
+        'dogs', 'similar ms', 'recommended ms', 'load ms', 'queries'))
+    for size in sizes:
+        reset_catalog()
+        dog_ids = seed_dogs(size)
+        user = seed_user('bench', dog_ids)
+        bitmaps = decisions.get_bitmaps(user)
+        prefs = queries.user_prefs(user)
+        load_ms, _ = measure(catalog.get_catalog().load, 1)
+        similar_ms, _ = measure(
+            lambda: similarity.similar_to(dog_ids[0], 20), repeat)
+        recommended_ms, recommended_queries = measure(
+            lambda: similarity.recommended_after(
+                -1, 20, bitmaps.liked, prefs[2], prefs[0], prefs[1],
+                bitmaps.decided),
+            repeat)
+        stdout.write('{:>10} {:>12.3f} {:>16.3f} {:>12.3f} {:>10.1f}'.format(
+            size, similar_ms, recommended_ms, load_ms, recommended_queries))
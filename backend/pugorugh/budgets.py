@@ -0,0 +1,167 @@
+"""
+Per-view SQL query budgets.
+
+Views mixing in `QueryBudgetMixin` declare the most queries, and the most
+total SQL time, a request may take, per viewset action if need be. Every
+request runs under `querylog.Capture`, which counts the queries of every
+database alias, replicas included; a breach is counted in a
+process-local registry and logged, and with
+`PUGORUGH_QUERY_BUDGET_STRICT = True` (the default under `manage.py test`)
+a query count breach raises `QueryBudgetExceeded`. SQL time depends on the
+machine, so time breaches are only counted and logged.
+
+The registry keeps, per view, the normalized SQL of its worst breaching
+request for the staff report (`/api/stats/query-budgets/`).
+"""
+import logging
+import re
+import threading
+from collections import Counter, namedtuple
+
+from django.conf import settings
+
+from . import querylog
+
+
+logger = logging.getLogger(__name__)
+
+
+Budget = namedtuple('Budget', ('queries', 'sql_ms'))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def is_enabled():
+    return getattr(settings, 'PUGORUGH_QUERY_BUDGETS', True)
+
+
+def is_strict():
+    return getattr(settings, 'PUGORUGH_QUERY_BUDGET_STRICT', False)
+
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'IN \((?:\?, )*\?\)')
+
+
+def normalize(sql):
+    """Replace the literals of a statement with ?, IN lists with IN (...)."""
+    sql = _NUMBER.sub('?', _STRING.sub('?', sql))
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+class Registry(object):
+    """Process-local requests and breaches per view."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def record(self, view, budget, queries):
+        '''
+        Record the (sql, seconds) queries of one request of `view` and
+        return the list of its budget breaches.
+        '''
+        sql_ms = sum(seconds for _, seconds in queries) * 1000
+        breaches = []
+        if budget.queries is not None and len(queries) > budget.queries:
+            breaches.append('{} queries > {}'.format(
+                len(queries), budget.queries))
+        if budget.sql_ms is not None and sql_ms > budget.sql_ms:
+            breaches.append('{:.1f} ms of SQL > {}'.format(
+                sql_ms, budget.sql_ms))
+
+        with self._lock:
+            stats = self._views.setdefault(view, {
+                'requests': 0,
+                'breaches': 0,
+                'max_queries': 0,
+                'max_sql_ms': 0.0,
+                'worst': [],
+            })
+            stats['requests'] += 1
+            stats['max_sql_ms'] = max(stats['max_sql_ms'], sql_ms)
+            if breaches:
+                stats['breaches'] += 1
+            if len(queries) > stats['max_queries']:
+                stats['max_queries'] = len(queries)
+                if breaches:
+                    stats['worst'] = queries
+            stats['budget'] = budget
+        return breaches
+
+    def report(self):
+        '''
+        Return the views, worst offenders first, with the normalized SQL of
+        their worst breaching request and how many times each statement ran.
+        '''
+        with self._lock:
+            views = [(view, dict(stats))
+                     for view, stats in self._views.items()]
+        report = []
+        for view, stats in views:
+            budget = stats.pop('budget')
+            statements = Counter(
+                normalize(sql) for sql, _ in stats.pop('worst'))
+            report.append(dict(
+                stats,
+                view=view,
+                max_sql_ms=round(stats['max_sql_ms'], 3),
+                budget={'queries': budget.queries, 'sql_ms': budget.sql_ms},
+                worst_sql=[{'sql': sql, 'count': count}
+                           for sql, count in statements.most_common()],
+            ))
+        report.sort(key=lambda stats: (stats['breaches'],
+                                       stats['max_queries']), reverse=True)
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+
+registry = Registry()
+
+
+class QueryBudgetMixin(object):
+    '''
+    Enforce `query_budget` on the requests of a view: a `Budget`, or a
+    {viewset action: Budget} dict with the None key for the other actions.
+    '''
+    query_budget = None
+
+    def budget(self):
+        budget = self.query_budget
+        if isinstance(budget, dict):
+            budget = budget.get(getattr(self, 'action', None),
+                                budget.get(None))
+        return budget
+
+    def budget_name(self):
+        action = getattr(self, 'action', None)
+        name = type(self).__name__
+        return '{}.{}'.format(name, action) if action else name
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_enabled():
+            return super().dispatch(request, *args, **kwargs)
+        with querylog.Capture() as captured:
+            response = super().dispatch(request, *args, **kwargs)
+        # The action is only known once the request has been initialized.
+        view = self.budget_name()
+        budget = self.budget()
+        if budget is None:
+            return response
+        queries = [(query['sql'], float(query['time']))
+                   for query in captured.captured_queries]
+        breaches = registry.record(view, budget, queries)
+        if breaches:
+            logger.warning('%s %s exceeded its query budget: %s', view,
+                           request.path, ', '.join(breaches))
+            if (is_strict() and budget.queries is not None and
+                    len(queries) > budget.queries):
+                raise QueryBudgetExceeded('{}: {}'.format(
+                    view, '; '.join(breaches)))
+        return response
@@ -0,0 +1,47 @@
+"""
+Serialized dog cards, cached per dog version.
+
+A card is the `DogSerializer` payload of a dog. It is cached under the
+dog's id and `updated_at`, so that saving a dog makes its old card
+unreachable instead of requiring an invalidation.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from . import conditional
+from . import metrics
+from . import models
+from . import serializers
+
+
+def card_key(dog_id, updated_at):
+    return 'pugorugh:card:{}:{}'.format(
+        dog_id, conditional.timestamp(updated_at))
+
+
+def cache_timeout():
+    return getattr(settings, 'PUGORUGH_CARD_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def dog_cards(versions):
+    '''
+    Return the cards of the (dog_id, updated_at) pairs, in order.
+
+    Cards missing from the cache are serialized from a single query. Dogs
+    deleted in the meantime are left out.
+    '''
+    keys = [card_key(dog_id, updated_at) for dog_id, updated_at in versions]
+    cards = cache.get_many(keys)
+    missing = [dog_id for (dog_id, _), key in zip(versions, keys)
+               if key not in cards]
+    metrics.cache_lookups('cards', len(keys) - len(missing), len(missing))
+    if missing:
+        requested = dict(versions)
+        fresh = {}
+        for dog in models.Dog.objects.filter(pk__in=missing):
+            card = dict(serializers.DogSerializer(dog).data)
+            fresh[card_key(dog.pk, dog.updated_at)] = card
+            # The dog may have changed since its version was read.
+            cards[card_key(dog.pk, requested[dog.pk])] = card
+        cache.set_many(fresh, cache_timeout())
+    return [cards[key] for key in keys if key in cards]
@@ -0,0 +1,238 @@
+"""
+Process-local, column oriented index of the dog catalog.
+
+The index keeps the id, age bucket, size, gender, breed and neutered flag
+of every `Dog` in compact NumPy arrays sorted by id, so "next undecided dog
+after pk that matches the user preferences" is answered with vectorized
+masks instead of an SQL query. The same columns are the feature matrix of
+the similar dog rankings (see pugorugh.similarity). It is kept in sync
+with `Dog` saves and deletes through model signals; other processes notice
+changes through a generation counter kept in the default cache and reload
+lazily. The index is therefore disabled when the default cache is not
+shared between processes (see pugorugh.checks): a worker would never see
+the changes made in another one.
+
+NumPy is optional. Without it (or with `PUGORUGH_CATALOG_INDEX = False`)
+lookups go through the ORM.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from . import checks
+from . import models
+
+
+GENERATION_KEY = 'pugorugh:catalog:generation'
+
+AGE_CODES = {bucket: code for code, (bucket, _) in enumerate(
+    models.Dog.AGE_BUCKET_CHOICES)}
+SIZE_CODES = {size: code for code, (size, _) in enumerate(
+    models.Dog.SIZE_CHOICES)}
+GENDER_CODES = {gender: code for code, (gender, _) in enumerate(
+    models.Dog.GENDER_CHOICES)}
+# Code of a value that no preference can select.
+NO_MATCH = 255
+
+# Number of rows examined per vectorized step when scanning for matches.
+SCAN_CHUNK = 8192
+
+
+def is_enabled():
+    return (numpy is not None and
+            getattr(settings, 'PUGORUGH_CATALOG_INDEX', False) and
+            checks.shared_default_cache())
+
+
+def _table(values, codes):
+    """Return a lookup table of the uint8 codes selected by `values`."""
+    table = numpy.zeros(256, dtype=bool)
+    table[[codes[value] for value in values if value in codes]] = True
+    return table
+
+
+def breed_key(breed):
+    return (breed or '').strip().lower()
+
+
+class DogCatalog(object):
+    '''
+    Sorted id column plus one uint8 column per preference attribute, an
+    int32 column of breed codes and a uint8 neutered column.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._columns = None
+        self._generation = None
+        # Breed -> code, only ever grown until the next load.
+        self._breeds = {}
+
+    def _breed_code(self, breeds, breed):
+        return breeds.setdefault(breed_key(breed), len(breeds))
+
+    def _current_generation(self):
+        return cache.get_or_set(GENERATION_KEY, 0, None)
+
+    def load(self):
+        """(Re)build the columns from the database."""
+        generation = self._current_generation()
+        rows = models.Dog.objects.order_by('id').values_list(
+            'id', 'age_bucket', 'size', 'gender', 'breed', 'neutered')
+        ids, ages, sizes, genders, breeds, neutered = [], [], [], [], [], []
+        breed_codes = {}
+        for (dog_id, age_bucket, size, gender, breed,
+                is_neutered) in rows.iterator():
+            ids.append(dog_id)
+            ages.append(AGE_CODES.get(age_bucket, NO_MATCH))
+            sizes.append(SIZE_CODES.get(size, NO_MATCH))
+            genders.append(GENDER_CODES.get(gender, NO_MATCH))
+            breeds.append(self._breed_code(breed_codes, breed))
+            neutered.append(is_neutered)
+        with self._lock:
+            self._columns = (
+                numpy.array(ids, dtype=numpy.int64),
+                numpy.array(ages, dtype=numpy.uint8),
+                numpy.array(sizes, dtype=numpy.uint8),
+                numpy.array(genders, dtype=numpy.uint8),
+                numpy.array(breeds, dtype=numpy.int32),
+                numpy.array(neutered, dtype=numpy.uint8),
+            )
+            self._breeds = breed_codes
+            self._generation = generation
+
+    def columns(self):
+        """Return the current columns, reloading them if they are stale."""
+        if (self._columns is None or
+                self._generation != self._current_generation()):
+            self.load()
+        return self._columns
+
+    def invalidate(self):
+        """Force every process, this one included, to reload on next use."""
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, 1, None)
+        with self._lock:
+            self._columns = None
+
+    def _bump(self):
+        # Let other processes know about the change. This process stays up
+        # to date only if nobody else changed the catalog in the meantime.
+        try:
+            generation = cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+        if generation is None or generation != (self._generation or 0) + 1:
+            self._columns = None
+        self._generation = generation
+
+    def upsert(self, dog):
+        """Insert or update a single dog in place."""
+        with self._lock:
+            if self._columns is not None:
+                self._columns = self._upserted(self._columns, dog)
+            self._bump()
+
+    def _upserted(self, columns, dog):
+        ids = columns[0]
+        row = (AGE_CODES.get(dog.age_bucket, NO_MATCH),
+               SIZE_CODES.get(dog.size, NO_MATCH),
+               GENDER_CODES.get(dog.gender, NO_MATCH),
+               self._breed_code(self._breeds, dog.breed),
+               bool(dog.neutered))
+        index = int(numpy.searchsorted(ids, dog.pk))
+        if index < len(ids) and ids[index] == dog.pk:
+            updated = [column.copy() for column in columns[1:]]
+            for column, value in zip(updated, row):
+                column[index] = value
+            return (ids,) + tuple(updated)
+        return (numpy.insert(ids, index, dog.pk),) + tuple(
+            numpy.insert(column, index, value)
+            for column, value in zip(columns[1:], row))
+
+    def remove(self, dog_id):
+        """Drop a single dog in place."""
+        with self._lock:
+            if self._columns is not None:
+                index = int(numpy.searchsorted(self._columns[0], dog_id))
+                if (index < len(self._columns[0]) and
+                        self._columns[0][index] == dog_id):
+                    self._columns = tuple(numpy.delete(column, index)
+                                          for column in self._columns)
+            self._bump()
+
+    def _mask(self, columns, start, stop, ages, sizes, genders, undecided):
+        ids, age_col, size_col, gender_col = columns[:4]
+        mask = ages[age_col[start:stop]]
+        mask &= sizes[size_col[start:stop]]
+        mask &= genders[gender_col[start:stop]]
+        # Ids past the end of the bitmap take its trailing True.
+        mask &= undecided.take(ids[start:stop], mode='clip')
+        return mask
+
+    def _prefs(self, ages, sizes, genders, decided):
+        decided = numpy.unpackbits(numpy.frombuffer(decided, dtype=numpy.uint8))
+        return (_table(ages, AGE_CODES), _table(sizes, SIZE_CODES),
+                _table(genders, GENDER_CODES),
+                numpy.append(decided == 0, True))
+
+    def matching(self, columns, ages, sizes, genders, decided=b''):
+        """Return the mask of the rows of `columns` match_after would pick."""
+        return self._mask(columns, 0, len(columns[0]),
+                          *self._prefs(ages, sizes, genders, decided))
+
+    def match_after(self, pk, limit, ages, sizes, genders, decided=b''):
+        '''
+        Return up to `limit` ids greater than `pk`, in id order, of the dogs
+        whose age bucket, size and gender are among the given preference
+        codes and whose bit is not set in the `decided` bitmap.
+        '''
+        columns = self.columns()
+        ids = columns[0]
+        prefs = self._prefs(ages, sizes, genders, decided)
+        found = []
+        start = int(numpy.searchsorted(ids, pk, side='right'))
+        while start < len(ids) and len(found) < limit:
+            stop = start + SCAN_CHUNK
+            mask = self._mask(columns, start, stop, *prefs)
+            found.extend(ids[start:stop][mask][:limit - len(found)].tolist())
+            start = stop
+        return found
+
+    def existing(self, dog_ids):
+        """Return which of `dog_ids` are in the catalog."""
+        ids = self.columns()[0]
+        wanted = numpy.asarray(list(dog_ids), dtype=numpy.int64)
+        return set(wanted[numpy.isin(wanted, ids)].tolist())
+
+    def has_match(self, ages, sizes, genders, decided=b''):
+        return bool(self.match_after(-1, 1, ages, sizes, genders, decided))
+
+
+_catalog = DogCatalog()
+
+
+def get_catalog():
+    return _catalog
+
+
+def dog_saved(sender, **kwargs):
+    """Keep the index in sync with a saved dog."""
+    _catalog.upsert(kwargs['instance'])
+
+
+def dog_deleted(sender, **kwargs):
+    """Drop a deleted dog from the index."""
+    _catalog.remove(kwargs['instance'].pk)
+
+post_save.connect(dog_saved, sender=models.Dog)
+post_delete.connect(dog_deleted, sender=models.Dog)
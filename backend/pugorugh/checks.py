@@ -0,0 +1,77 @@
+"""
+Checks of the state that processes share through the default cache.
+
+The generation counter of the catalog index (see pugorugh.catalog), the
+primary stickiness deadlines of the replica router (see pugorugh.routers)
+and the cached per-user state, such as the decision bitmaps (see
+pugorugh.decisions), only reach every worker when the default cache is
+shared between processes (memcached, Redis, the database cache...). The
+default `LocMemCache` is not, unless a single process serves the site, as
+with `runserver` and the test runner (`PUGORUGH_SINGLE_PROCESS`).
+
+Without a shared cache the catalog index and the similar dog rankings are
+off, replicas are refused and the per-user state is read from the database
+on every request.
+"""
+from django.conf import settings
+from django.core import checks
+
+
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def single_process():
+    return getattr(settings, 'PUGORUGH_SINGLE_PROCESS', False)
+
+
+def shared_default_cache():
+    """Return whether every process serving the site sees the same cache."""
+    if single_process():
+        return True
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    return backend not in PROCESS_LOCAL_BACKENDS
+
+
+@checks.register()
+def check_shared_cache(app_configs, **kwargs):
+    if shared_default_cache():
+        return []
+    errors = [checks.Warning(
+        'The per-user and per-dog caches are bypassed: the default cache '
+        'is not shared between processes.',
+        hint='Configure a shared default cache, or set '
+             'PUGORUGH_SINGLE_PROCESS = True if one process serves the site.',
+        id='pugorugh.W002',
+    )]
+    if getattr(settings, 'PUGORUGH_CATALOG_INDEX', False):
+        errors.append(checks.Warning(
+            'The catalog index is disabled: the default cache is not '
+            'shared between processes.',
+            hint='Configure a shared default cache, or set '
+                 'PUGORUGH_SINGLE_PROCESS = True if one process serves '
+                 'the site.',
+            id='pugorugh.W001',
+        ))
+    if getattr(settings, 'PUGORUGH_SIMILARITY', True):
+        errors.append(checks.Warning(
+            'The similar dog rankings are disabled: the default cache is '
+            'not shared between processes.',
+            hint='Configure a shared default cache, or set '
+                 'PUGORUGH_SINGLE_PROCESS = True if one process serves '
+                 'the site.',
+            id='pugorugh.W003',
+        ))
+    if getattr(settings, 'PUGORUGH_REPLICA_DATABASES', ()):
+        errors.append(checks.Error(
+            'PUGORUGH_REPLICA_DATABASES needs a default cache shared '
+            'between processes: the reads of a user who just wrote could '
+            'go to a lagging replica.',
+            hint='Configure a shared default cache, or set '
+                 'PUGORUGH_SINGLE_PROCESS = True if one process serves '
+                 'the site.',
+            id='pugorugh.E001',
+        ))
+    return errors
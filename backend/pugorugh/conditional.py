@@ -0,0 +1,152 @@
+"""
+Conditional GET support: strong ETags, Last-Modified and 304 responses.
+
+Validators derive from the `updated_at` field of `Dog` and `UserPref`. The
+`updated_at` of every dog is kept in the default cache (written through by
+the `Dog` signals below), so that checking whether a client's copy of a dog
+is current costs no query at all; preferences carry theirs in the cache
+entry of `UserPref.for_user`. Dogs can be changed through any worker
+process, so the versions are read from the DB unless the default cache is
+shared between the processes (see pugorugh.checks).
+
+Code updating dogs with `QuerySet.update()`, which sends no signal, must set
+`updated_at` itself and call `forget_dogs`.
+"""
+import calendar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.utils.http import http_date, parse_http_date_safe
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import checks
+from . import metrics
+from . import models
+
+
+def dog_version_key(dog_id):
+    return 'pugorugh:version:dog:{}'.format(dog_id)
+
+
+def cache_timeout():
+    return getattr(settings, 'PUGORUGH_VERSION_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def dog_version(dog_id):
+    """Return the `updated_at` of a dog, or None if it does not exist."""
+    if not checks.shared_default_cache():
+        return models.Dog.objects.filter(
+            pk=dog_id
+        ).values_list('updated_at', flat=True).first()
+    key = dog_version_key(dog_id)
+    updated_at = cache.get(key)
+    metrics.cache_lookup('versions', updated_at is not None)
+    if updated_at is None:
+        updated_at = models.Dog.objects.filter(
+            pk=dog_id
+        ).values_list('updated_at', flat=True).first()
+        if updated_at is not None:
+            cache.set(key, updated_at, cache_timeout())
+    return updated_at
+
+
+def dog_versions(dog_ids):
+    """Return {dog_id: updated_at} for the `dog_ids` of existing dogs."""
+    if not checks.shared_default_cache():
+        return dict(models.Dog.objects.filter(
+            pk__in=dog_ids
+        ).values_list('id', 'updated_at'))
+    keys = {dog_version_key(dog_id): dog_id for dog_id in dog_ids}
+    versions = {keys[key]: updated_at
+                for key, updated_at in cache.get_many(list(keys)).items()}
+    missing = [dog_id for dog_id in dog_ids if dog_id not in versions]
+    metrics.cache_lookups('versions', len(versions), len(missing))
+    if missing:
+        found = dict(models.Dog.objects.filter(
+            pk__in=missing
+        ).values_list('id', 'updated_at'))
+        cache.set_many({dog_version_key(dog_id): updated_at
+                        for dog_id, updated_at in found.items()},
+                       cache_timeout())
+        versions.update(found)
+    return versions
+
+
+def forget_dogs(dog_ids):
+    """Drop the cached versions of dogs changed without a save()."""
+    cache.delete_many([dog_version_key(dog_id) for dog_id in dog_ids])
+
+
+def timestamp(updated_at):
+    """Return an aware or UTC naive datetime as microseconds since epoch."""
+    return (calendar.timegm(updated_at.utctimetuple()) * 1000000 +
+            updated_at.microsecond)
+
+
+def make_etag(*parts):
+    """Return a strong, quoted ETag made of `parts`."""
+    return '"{}"'.format('-'.join(str(part) for part in parts))
+
+
+def etag_matches(etag, header):
+    """Return whether an If-None-Match header lists `etag`."""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """Return whether the client's copy, as per its validators, is current."""
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # If-Modified-Since only counts without If-None-Match (RFC 7232).
+        return etag_matches(etag, if_none_match)
+    if last_modified is None:
+        return False
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return (if_modified_since is not None and
+            timestamp(last_modified) // 1000000 <= if_modified_since)
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(
+            timestamp(last_modified) // 1000000)
+    return response
+
+
+def conditional_response(request, etag, last_modified, render):
+    '''
+    Answer 304 Not Modified if the client's copy is current, else call
+    `render()` for the response. Either way the validators are set.
+    '''
+    if is_not_modified(request, etag, last_modified):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = render()
+    if 200 <= response.status_code < 300 or response.status_code == 304:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def dog_saved(sender, **kwargs):
+    dog = kwargs['instance']
+    cache.set(dog_version_key(dog.pk), dog.updated_at, cache_timeout())
+
+
+def dog_deleted(sender, **kwargs):
+    cache.delete(dog_version_key(kwargs['instance'].pk))
+
+post_save.connect(dog_saved, sender=models.Dog)
+post_delete.connect(dog_deleted, sender=models.Dog)
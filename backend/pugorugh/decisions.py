@@ -0,0 +1,410 @@
+"""
+Per-user bitmaps of the dogs a user decided on.
+
+Bit `i` of a bitmap stands for the dog with id `i` (most significant bit of
+each byte first). Every user has three of them: `decided` (any `UserDog`
+row, whatever its status), `liked` and `disliked`. They are kept in the
+default cache, rebuilt from `UserDog` with a single query on a cache miss
+and updated in place by the decision actions of `DogViewSet`, so that the
+next-dog lookups never need to join `UserDog`.
+
+Every decision write also bumps the user's decision version (see
+`decision_version`), which keys the caches derived from the decisions, so
+that a swipe invalidates all of them with one increment.
+
+The decisions of a user can reach any worker process, so the bitmaps are
+only cached when the default cache is shared between the processes (see
+`pugorugh.checks`). Otherwise every read rebuilds them from `UserDog`.
+
+The bitmaps are cached with the version they hold the decisions of, and
+only read back while it is the current one. Updating them in place is a
+read-modify-write of the cache entry, so it is only done by the decision
+that bumped the version right after it (`update_bitmaps`): when two
+decisions of a user race, the loser drops the entry instead of overwriting
+the bits of the other one, and the next read rebuilds it.
+
+Decisions themselves are written with `record_decision`, a single atomic
+upsert statement per decision, or through the write-behind buffer of
+`pugorugh.writebehind` when `PUGORUGH_WRITE_BEHIND` is on.
+"""
+import re
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connections, router, transaction
+from django.shortcuts import Http404
+
+from . import catalog
+from . import checks
+from . import metrics
+from . import models
+from . import stats
+from . import writebehind
+
+
+_NON_ZERO_BYTE = re.compile(b'[^\x00]')
+
+# Inserting through `SELECT ... FROM dog WHERE id = %s` validates that the
+# dog exists in the same statement: no row is written (rowcount 0) if not.
+_INSERT_SQL = (
+    'INSERT INTO {userdog} ({user_id}, {dog_id}, {status}) '
+    'SELECT %s, {id}, %s FROM {dog} WHERE {id} = %s '
+)
+_ON_CONFLICT_SQL = _INSERT_SQL + (
+    'ON CONFLICT ({user_id}, {dog_id}) '
+    'DO UPDATE SET {status} = excluded.{status}'
+)
+UPSERT_SQL = {
+    'sqlite': _ON_CONFLICT_SQL,
+    'postgresql': _ON_CONFLICT_SQL,
+    'mysql': _INSERT_SQL + (
+        'ON DUPLICATE KEY UPDATE {status} = VALUES({status})'
+    ),
+}
+
+
+def cache_key(user_id):
+    return 'pugorugh:decisions:{}'.format(user_id)
+
+
+def cache_timeout():
+    return getattr(settings, 'PUGORUGH_DECISION_CACHE_TIMEOUT', 60 * 60)
+
+
+def version_key(user_id):
+    return 'pugorugh:decisions:version:{}'.format(user_id)
+
+
+def initial_version():
+    # Larger than any version handed out before the counter was evicted,
+    # so that entries keyed on an old version are never read again.
+    return int(time.time() * 1000000)
+
+
+def decision_version(user_id):
+    """Return the user's decision version, starting a counter if needed."""
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(user_id):
+    """Increment the user's decision version and return the new one."""
+    try:
+        return cache.incr(version_key(user_id))
+    except ValueError:
+        version = initial_version()
+        cache.set(version_key(user_id), version, None)
+        return version
+
+
+def set_bit(bitmap, dog_id):
+    index = dog_id >> 3
+    if index >= len(bitmap):
+        bitmap.extend(bytes(index + 1 - len(bitmap)))
+    bitmap[index] |= 0x80 >> (dog_id & 7)
+
+
+def clear_bit(bitmap, dog_id):
+    index = dog_id >> 3
+    if index < len(bitmap):
+        bitmap[index] &= ~(0x80 >> (dog_id & 7)) & 0xff
+
+
+def test_bit(bitmap, dog_id):
+    index = dog_id >> 3
+    return (0 <= index < len(bitmap) and
+            bool(bitmap[index] & (0x80 >> (dog_id & 7))))
+
+
+def ids_after(bitmap, pk, limit):
+    """Return up to `limit` set bits greater than `pk`, in ascending order."""
+    start = max(pk + 1, 0)
+    index = start >> 3
+    ids = []
+    while len(ids) < limit:
+        match = _NON_ZERO_BYTE.search(bitmap, index)
+        if match is None:
+            break
+        index = match.start()
+        value = bitmap[index]
+        for bit in range(8):
+            dog_id = (index << 3) + bit
+            if value & (0x80 >> bit) and dog_id >= start:
+                ids.append(dog_id)
+                if len(ids) == limit:
+                    break
+        index += 1
+    return ids
+
+
+def any_set(bitmap):
+    return _NON_ZERO_BYTE.search(bitmap) is not None
+
+
+class DecisionBitmaps(object):
+    """The decided, liked and disliked dog bitmaps of one user."""
+    __slots__ = ('decided', 'liked', 'disliked')
+
+    def __init__(self):
+        self.decided = bytearray()
+        self.liked = bytearray()
+        self.disliked = bytearray()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the bitmaps from (dog_id, status) pairs."""
+        bitmaps = cls()
+        for dog_id, status in rows:
+            bitmaps.set(dog_id, status)
+        return bitmaps
+
+    def set(self, dog_id, status):
+        set_bit(self.decided, dog_id)
+        clear_bit(self.liked, dog_id)
+        clear_bit(self.disliked, dog_id)
+        if status == 'l':
+            set_bit(self.liked, dog_id)
+        elif status == 'd':
+            set_bit(self.disliked, dog_id)
+
+    def is_decided(self, dog_id):
+        return test_bit(self.decided, dog_id)
+
+    def status(self, dog_id):
+        """Return the status of the decision on a dog, or None."""
+        if not self.is_decided(dog_id):
+            return None
+        if test_bit(self.liked, dog_id):
+            return 'l'
+        if test_bit(self.disliked, dog_id):
+            return 'd'
+        return 'u'
+
+    def for_filter(self, dog_filter):
+        """Return the bitmap listing the dogs of a liked/disliked filter."""
+        return self.liked if dog_filter == 'liked' else self.disliked
+
+
+def is_cached():
+    return checks.shared_default_cache()
+
+
+def read_bitmaps(user):
+    """Build the user's bitmaps from `UserDog` and the pending decisions."""
+    # Decisions still waiting in the write-behind buffer, or being flushed,
+    # win over the rows they will overwrite. They are read first, and the
+    # buffer keeps a batch until it is committed, so that a flush running
+    # meanwhile cannot hide them from both reads.
+    pending = buffer.pending_for(user.pk)
+    bitmaps = DecisionBitmaps.from_rows(
+        models.UserDog.objects.filter(
+            user=user
+        ).values_list('dog_id', 'status').iterator()
+    )
+    for dog_id, status in pending:
+        bitmaps.set(dog_id, status)
+    return bitmaps
+
+
+def get_bitmaps(user):
+    """Return the user's bitmaps, rebuilding them from the DB on a miss."""
+    if not is_cached():
+        return read_bitmaps(user)
+    key = cache_key(user.pk)
+    cached = cache.get_many([version_key(user.pk), key])
+    # Read before the rows: a decision written meanwhile bumps the version
+    # past the one the rebuilt bitmaps are cached with.
+    version = cached.get(version_key(user.pk))
+    if version is None:
+        version = decision_version(user.pk)
+    cached_version, bitmaps = cached.get(key, (None, None))
+    if cached_version != version:
+        bitmaps = None
+    metrics.cache_lookup('bitmaps', bitmaps is not None)
+    if bitmaps is None:
+        bitmaps = read_bitmaps(user)
+        cache.set(key, (version, bitmaps), cache_timeout())
+    return bitmaps
+
+
+def update_bitmaps(user, pairs):
+    '''
+    Bump the user's decision version and record (dog_id, status) decisions
+    in the user's cached bitmaps, if they hold every decision before them.
+
+    Nothing is cached otherwise: the next read rebuilds the bitmaps from
+    `UserDog`, which already holds the decisions. Cached bitmaps of an
+    older version mean that another decision bumped the version in between
+    and may be writing them too, so they are dropped.
+    '''
+    if not is_cached():
+        return
+    key = cache_key(user.pk)
+    version = bump_version(user.pk)
+    cached_version, bitmaps = cache.get(key, (None, None))
+    if bitmaps is None:
+        return
+    if cached_version != version - 1:
+        cache.delete(key)
+        return
+    for dog_id, status in pairs:
+        bitmaps.set(dog_id, status)
+    cache.set(key, (version, bitmaps), cache_timeout())
+
+
+def upsert_sql(connection):
+    """Return the upsert statement for `connection`, or None if unsupported."""
+    if connection.vendor == 'sqlite' and (
+            connection.Database.sqlite_version_info < (3, 24, 0)):
+        return None
+    sql = UPSERT_SQL.get(connection.vendor)
+    if sql is None:
+        return None
+    quote = connection.ops.quote_name
+    return sql.format(
+        userdog=quote(models.UserDog._meta.db_table),
+        dog=quote(models.Dog._meta.db_table),
+        user_id=quote('user_id'),
+        dog_id=quote('dog_id'),
+        status=quote('status'),
+        id=quote('id'),
+    )
+
+
+def _record_with_orm(user_id, dog_id, status, using):
+    """Fallback for databases without an upsert statement."""
+    with transaction.atomic(using=using):
+        if not models.Dog.objects.using(using).filter(pk=dog_id).exists():
+            return False
+        try:
+            with transaction.atomic(using=using):
+                models.UserDog.objects.using(using).update_or_create(
+                    user_id=user_id, dog_id=dog_id,
+                    defaults={'status': status})
+        except IntegrityError:
+            # A concurrent request created the row first.
+            models.UserDog.objects.using(using).filter(
+                user_id=user_id, dog_id=dog_id).update(status=status)
+    return True
+
+
+def write_decision(user_id, dog_id, status):
+    '''
+    Upsert one decision in a single statement. Returns False, writing
+    nothing, if the dog does not exist.
+    '''
+    using = router.db_for_write(models.UserDog)
+    connection = connections[using]
+    sql = upsert_sql(connection)
+    with writebehind.serialized_writes(using):
+        if sql is None:
+            return _record_with_orm(user_id, dog_id, status, using)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [user_id, status, dog_id])
+            return cursor.rowcount != 0
+
+
+def write_decisions(rows):
+    '''
+    Upsert (user_id, dog_id, status) rows in one transaction with a
+    batched statement. Rows of dogs that do not exist are skipped.
+    '''
+    using = router.db_for_write(models.UserDog)
+    connection = connections[using]
+    sql = upsert_sql(connection)
+    with writebehind.serialized_writes(using), \
+            transaction.atomic(using=using):
+        if sql is None:
+            for user_id, dog_id, status in rows:
+                _record_with_orm(user_id, dog_id, status, using)
+        elif rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, [
+                    [user_id, status, dog_id]
+                    for user_id, dog_id, status in rows])
+
+
+def write_behind_enabled():
+    return getattr(settings, 'PUGORUGH_WRITE_BEHIND', False)
+
+
+buffer = writebehind.DecisionBuffer(
+    write_decisions,
+    interval=getattr(settings, 'PUGORUGH_WRITE_BEHIND_INTERVAL_MS', 200) / 1000,
+    batch_size=getattr(settings, 'PUGORUGH_WRITE_BEHIND_BATCH', 500),
+)
+
+
+def existing_dog_ids(dog_ids):
+    """Return which of `dog_ids` belong to existing dogs."""
+    if catalog.is_enabled():
+        return catalog.get_catalog().existing(dog_ids)
+    return set(models.Dog.objects.filter(
+        pk__in=set(dog_ids)
+    ).values_list('id', flat=True))
+
+
+def decision_changes(bitmaps, pairs):
+    '''
+    Return the (dog_id, old status, new status) changes made by (dog_id,
+    status) decisions, applied in order on top of `bitmaps`.
+    '''
+    statuses = {}
+    changes = []
+    for dog_id, status in pairs:
+        changes.append((dog_id, statuses.get(dog_id, bitmaps.status(dog_id)),
+                        status))
+        statuses[dog_id] = status
+    return changes
+
+
+def record_decision(user, dog_id, status):
+    '''
+    Set the user's decision on a dog and return it as an unsaved `UserDog`.
+
+    The decision is written with one atomic upsert, or queued in the
+    write-behind buffer when enabled, and its `DogStats` deltas are queued.
+    Raises Http404 if the dog does not exist.
+    '''
+    old_status = get_bitmaps(user).status(dog_id)
+    if write_behind_enabled():
+        if not existing_dog_ids([dog_id]):
+            raise Http404
+        buffer.add(user.pk, dog_id, status)
+    elif not write_decision(user.pk, dog_id, status):
+        raise Http404
+    stats.record(user, [(dog_id, old_status, status)])
+    update_bitmaps(user, [(dog_id, status)])
+    metrics.DECISIONS.inc(status=status)
+    return models.UserDog(user=user, dog_id=dog_id, status=status)
+
+
+def record_decisions(user, pairs):
+    '''
+    Set many (dog_id, status) decisions of the user at once.
+
+    Dog existence is checked with a single query and the decisions on
+    existing dogs are written in one transaction with one batched upsert
+    (or queued in the write-behind buffer). Returns the set of dog ids that
+    exist, i.e. whose decision was recorded.
+    '''
+    existing = existing_dog_ids([dog_id for dog_id, _ in pairs])
+    pairs = [(dog_id, status) for dog_id, status in pairs
+             if dog_id in existing]
+    changes = decision_changes(get_bitmaps(user), pairs)
+    if write_behind_enabled():
+        for dog_id, status in pairs:
+            buffer.add(user.pk, dog_id, status)
+    else:
+        write_decisions([(user.pk, dog_id, status)
+                         for dog_id, status in pairs])
+    stats.record(user, changes)
+    update_bitmaps(user, pairs)
+    for dog_id, status in pairs:
+        metrics.DECISIONS.inc(status=status)
+    return existing
@@ -0,0 +1,129 @@
+"""
+Streaming exports of the `UserDog` decisions, joined with `Dog` and `User`.
+
+Rows are read in keyset chunks of `id > last id` (each chunk through
+`.iterator()`), encoded one line at a time as CSV or JSON Lines and
+optionally gzip-compressed on the fly, so memory use does not depend on
+the size of the table. Both the staff endpoint and the `export_decisions`
+command consume `export()`.
+"""
+import csv
+import json
+import zlib
+
+from . import models
+
+
+FORMATS = ('csv', 'jsonl')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Exported column -> `UserDog` lookup.
+COLUMNS = (
+    ('id', 'id'),
+    ('user_id', 'user_id'),
+    ('username', 'user__username'),
+    ('dog_id', 'dog_id'),
+    ('dog_name', 'dog__name'),
+    ('breed', 'dog__breed'),
+    ('age', 'dog__age'),
+    ('gender', 'dog__gender'),
+    ('size', 'dog__size'),
+    ('status', 'status'),
+)
+
+CHUNK_SIZE = 2000
+
+
+def decision_rows(user_id=None, chunk_size=CHUNK_SIZE):
+    """Yield the decisions as tuples of `COLUMNS`, in id order."""
+    queryset = models.UserDog.objects.order_by('id').values_list(
+        *(lookup for _, lookup in COLUMNS))
+    if user_id is not None:
+        queryset = queryset.filter(user_id=user_id)
+    last_id = 0
+    while True:
+        count = 0
+        for row in queryset.filter(id__gt=last_id)[:chunk_size].iterator():
+            count += 1
+            yield row
+        if count < chunk_size:
+            return
+        last_id = row[0]
+
+
+class _Line(object):
+    """File-like object handing back what csv.writer writes to it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(_Line())
+    yield writer.writerow([name for name, _ in COLUMNS]).encode('utf-8')
+    for row in rows:
+        yield writer.writerow(row).encode('utf-8')
+
+
+def iter_jsonl(rows):
+    names = [name for name, _ in COLUMNS]
+    for row in rows:
+        yield (json.dumps(dict(zip(names, row))) + '\n').encode('utf-8')
+
+
+ENCODERS = {
+    'csv': iter_csv,
+    'jsonl': iter_jsonl,
+}
+
+
+def gzipped(chunks, flush_size=64 * 1024):
+    """Gzip a stream of bytes, yielding compressed blocks as they fill."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    pending = 0
+    for chunk in chunks:
+        pending += len(chunk)
+        block = compressor.compress(chunk)
+        if pending >= flush_size:
+            block += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if block:
+            yield block
+    yield compressor.flush()
+
+
+def buffered(chunks, size=64 * 1024):
+    """Join small chunks into blocks of about `size` bytes."""
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def export(export_format, user_id=None, compress=False):
+    """Return an iterator of the bytes of a decision export."""
+    chunks = ENCODERS[export_format](decision_rows(user_id))
+    if compress:
+        return gzipped(chunks)
+    return buffered(chunks)
+
+
+def filename(export_format, user_id=None, compress=False):
+    name = 'decisions'
+    if user_id is not None:
+        name += '-user-{}'.format(user_id)
+    name += '.' + export_format
+    if compress:
+        name += '.gz'
+    return name
@@ -0,0 +1,222 @@
+"""
+Resized WebP/JPEG variants and precomputed details of the dog photos.
+
+The `build_image_variants` command renders every variant of every
+`Dog.image_filename` found in `PUGORUGH_IMAGE_SOURCE_DIR` into
+`PUGORUGH_IMAGE_VARIANT_DIR`, spreading the photos over a process pool.
+Output names embed a hash of the source bytes and of the variant spec, so
+they can be cached forever. A `manifest.json` next to them maps each source
+to its variants and records the size and mtime the source had, which lets
+incremental runs skip unchanged photos without reading them.
+
+The same pass measures each photo and derives its dominant color and a tiny
+blurred placeholder, stored on `Dog` (`photo_details`). The importer fills
+them in for new dogs and `backfill_image_details` for existing rows.
+
+Pillow is optional: without it the commands refuse to run and dogs are
+serialized without variants or details.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+
+from django.conf import settings
+
+try:
+    from PIL import Image, ImageFilter
+except ImportError:  # pragma: no cover
+    Image = None
+
+
+APP_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'static')
+
+# Variant name -> maximum width in pixels. Photos are never upscaled.
+VARIANTS = {
+    'thumb': 160,
+    'card': 480,
+}
+
+# Output format -> (file extension, Pillow save options).
+FORMATS = {
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'quality': 75, 'optimize': True, 'progressive': True}),
+}
+
+MANIFEST_NAME = 'manifest.json'
+
+# Size of the blurred placeholder, inlined in the payloads as a data URI.
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+
+
+def is_enabled():
+    return Image is not None
+
+
+def source_dir():
+    return getattr(settings, 'PUGORUGH_IMAGE_SOURCE_DIR',
+                   os.path.join(APP_STATIC_DIR, 'images', 'dogs'))
+
+
+def variant_dir():
+    return getattr(settings, 'PUGORUGH_IMAGE_VARIANT_DIR',
+                   os.path.join(source_dir(), 'variants'))
+
+
+def variant_url(name):
+    return getattr(settings, 'PUGORUGH_IMAGE_VARIANT_URL',
+                   settings.STATIC_URL + 'images/dogs/variants/') + name
+
+
+def spec():
+    """Return what the variant files depend on besides the source bytes."""
+    return json.dumps([VARIANTS, FORMATS], sort_keys=True).encode()
+
+
+def describe(image, size=None):
+    """Return the `Dog` image fields describing an opened photo."""
+    width, height = size or image.size
+    small = image.convert('RGB')
+    small.thumbnail((64, 64))
+    palette_image = small.quantize(colors=8)
+    _, index = max(palette_image.getcolors())
+    red, green, blue = palette_image.getpalette()[index * 3:index * 3 + 3]
+
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    output = io.BytesIO()
+    small.filter(ImageFilter.GaussianBlur(1)).save(
+        output, 'JPEG', quality=PLACEHOLDER_QUALITY)
+    return {
+        'image_width': width,
+        'image_height': height,
+        'dominant_color': '#{:02x}{:02x}{:02x}'.format(red, green, blue),
+        'placeholder': 'data:image/jpeg;base64,' + base64.b64encode(
+            output.getvalue()).decode('ascii'),
+    }
+
+
+def describe_photo(source_path):
+    """Return the `Dog` image fields of a photo file, or None if unreadable."""
+    try:
+        image = Image.open(source_path)
+        size = image.size
+        # Let JPEGs decode at a fraction of their size: 64px are enough.
+        image.draft('RGB', (64, 64))
+        return describe(image, size)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def photo_details(image_filename):
+    """Return the `Dog` image fields of a photo of the source dir, or {}."""
+    if not is_enabled() or not image_filename:
+        return {}
+    return describe_photo(os.path.join(source_dir(), image_filename)) or {}
+
+
+def render_variants(source_path, out_dir):
+    '''
+    Render every variant of one photo. Returns the source digest, a
+    {variant: {format: file name}} dict and the photo's `Dog` image fields,
+    or None if the photo cannot be read or decoded.
+
+    Runs in the worker processes of the command, so it only touches files.
+    Files that already exist are not written again: their name is derived
+    from their content.
+    '''
+    try:
+        with open(source_path, 'rb') as source:
+            data = source.read()
+        image = Image.open(io.BytesIO(data))
+        details = describe(image)
+        image = image.convert('RGB')
+    except (IOError, OSError, ValueError):
+        return None
+    digest = hashlib.sha256(data).hexdigest()
+    tag = hashlib.sha256(digest.encode() + spec()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+
+    variants = {}
+    for variant, width in sorted(VARIANTS.items()):
+        resized = None
+        for format_name, (extension, options) in sorted(FORMATS.items()):
+            name = '{}.{}.{}.{}'.format(stem, variant, tag, extension)
+            variants.setdefault(variant, {})[format_name] = name
+            path = os.path.join(out_dir, name)
+            if os.path.exists(path):
+                continue
+            if resized is None:
+                resized = image.copy()
+                resized.thumbnail((width, width * 4), Image.LANCZOS)
+            temporary = path + '.tmp'
+            resized.save(temporary, format_name.upper(), **options)
+            os.replace(temporary, path)
+    return digest, variants, details
+
+
+def read_manifest(out_dir=None):
+    path = os.path.join(out_dir or variant_dir(), MANIFEST_NAME)
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(manifest, out_dir=None):
+    path = os.path.join(out_dir or variant_dir(), MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def is_current(entry, source_path, out_dir):
+    """Return whether a manifest entry still describes the source photo."""
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return False
+    return (
+        entry.get('size') == stat.st_size and
+        entry.get('mtime') == stat.st_mtime and
+        entry.get('variants') and
+        all(os.path.exists(os.path.join(out_dir, name))
+            for formats in entry['variants'].values()
+            for name in formats.values())
+    )
+
+
+class VariantIndex(object):
+    """The manifest of the variant directory, reloaded when it changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._urls = {}
+
+    def urls(self, image_filename):
+        """Return the {variant: {format: url}} of a photo, or {}."""
+        path = os.path.join(variant_dir(), MANIFEST_NAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        if mtime != self._mtime:
+            with self._lock:
+                self._urls = {
+                    filename: {
+                        variant: {format_name: variant_url(name)
+                                  for format_name, name in formats.items()}
+                        for variant, formats in entry['variants'].items()
+                    }
+                    for filename, entry in read_manifest().items()
+                }
+                self._mtime = mtime
+        return self._urls.get(image_filename, {})
+
+
+variant_index = VariantIndex()
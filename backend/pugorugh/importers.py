@@ -0,0 +1,245 @@
+"""
+Streaming readers and a chunked, idempotent writer for dog feeds.
+
+Readers yield one dict per dog from a JSON array, JSON Lines or CSV file
+without loading the whole file. `DogImporter` validates the rows in chunks
+and upserts them on a natural key, so running an import twice leaves the
+catalog unchanged.
+"""
+import csv
+import io
+import json
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import catalog
+from . import conditional
+from . import images
+from . import metrics
+from . import models
+from . import serializers
+
+
+FORMATS = ('json', 'jsonl', 'csv')
+
+
+def guess_format(path):
+    """Return the feed format implied by a file name."""
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if path.endswith('.csv'):
+        return 'csv'
+    return 'json'
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield the items of a top-level JSON array, reading it in chunks."""
+    decoder = json.JSONDecoder()
+    state = {'buffer': '', 'eof': False}
+
+    def fill():
+        chunk = stream.read(chunk_size)
+        state['buffer'] += chunk
+        state['eof'] = not chunk
+
+    def next_char(position):
+        """Skip whitespace; return (position, char) with '' at the end."""
+        while True:
+            buffer = state['buffer']
+            while position < len(buffer) and buffer[position] in ' \t\r\n':
+                position += 1
+            if position < len(buffer):
+                return position, buffer[position]
+            if state['eof']:
+                return position, ''
+            fill()
+
+    position, char = next_char(0)
+    if char != '[':
+        raise ValueError('Expected a JSON array.')
+    position, char = next_char(position + 1)
+    first = True
+    while char != ']':
+        if not first:
+            if char != ',':
+                raise ValueError(
+                    'Expected "," or "]", got {!r}.'.format(char))
+            position, char = next_char(position + 1)
+        if char == '':
+            raise ValueError('Unexpected end of the JSON array.')
+        while True:
+            try:
+                item, end = decoder.raw_decode(state['buffer'], position)
+            except ValueError:
+                if state['eof']:
+                    raise
+                fill()
+                continue
+            if not state['eof'] and state['buffer'][end:end + 1] not in (
+                    ' ', '\t', '\r', '\n', ',', ']'):
+                # A number cut by the chunk may go on in the next one.
+                fill()
+                continue
+            break
+        yield item
+        first = False
+        # Drop what was consumed, so memory stays bounded by the chunk size.
+        state['buffer'] = state['buffer'][end:]
+        position, char = next_char(0)
+
+
+def iter_json_lines(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_csv(stream):
+    for row in csv.DictReader(stream):
+        yield {field: value for field, value in row.items() if value != ''}
+
+
+READERS = {
+    'json': iter_json_array,
+    'jsonl': iter_json_lines,
+    'csv': iter_csv,
+}
+
+
+def open_feed(path):
+    return io.open(path, 'r', encoding='utf-8', newline='')
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DogImporter(object):
+    """Validate and upsert dog rows on a natural key, batch by batch."""
+
+    def __init__(self, natural_key=('image_filename',), batch_size=1000):
+        self.natural_key = tuple(natural_key)
+        self.batch_size = batch_size
+        self.read = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        # Rows overridden by a later row of the same natural key.
+        self.skipped = 0
+        self.errors = []
+        self.started = None
+        self.finished = None
+
+    def key_of(self, values):
+        return tuple(values.get(field) for field in self.natural_key)
+
+    def key_errors(self, values):
+        """Return the errors of the natural key fields a row lacks."""
+        return {field: ['This field is required by the natural key.']
+                for field in self.natural_key
+                if values.get(field) in (None, '')}
+
+    def key_of_dog(self, dog):
+        return tuple(getattr(dog, field) for field in self.natural_key)
+
+    def run(self, rows):
+        self.started = time.perf_counter()
+        try:
+            for chunk in chunked(rows, self.batch_size):
+                self.import_chunk(chunk)
+        finally:
+            self.finished = time.perf_counter()
+            metrics.IMPORT_SECONDS.inc(self.finished - self.started)
+            # bulk_create() and update() bypass the Dog signals.
+            catalog.get_catalog().invalidate()
+        return self
+
+    def import_chunk(self, chunk):
+        """Validate one chunk and write it in a single transaction."""
+        valid = {}
+        unchanged, skipped = self.unchanged, self.skipped
+        errors = len(self.errors)
+        for row in chunk:
+            self.read += 1
+            serializer = serializers.DogImportSerializer(data=row)
+            if not serializer.is_valid():
+                self.errors.append((self.read, serializer.errors))
+                continue
+            key_errors = self.key_errors(serializer.validated_data)
+            if key_errors:
+                self.errors.append((self.read, key_errors))
+                continue
+            # The last row of a natural key in a chunk wins.
+            key = self.key_of(serializer.validated_data)
+            if key in valid:
+                self.skipped += 1
+            valid[key] = serializer.validated_data
+
+        updated_ids = []
+        with transaction.atomic():
+            existing = self.existing_dogs(valid)
+            new_dogs = []
+            for key, values in valid.items():
+                values = dict(values)
+                values['age_bucket'] = models.Dog.age_bucket_for(
+                    values.get('age'))
+                dog = existing.get(key)
+                if dog is not None and all(
+                        getattr(dog, field) == value
+                        for field, value in values.items()):
+                    self.unchanged += 1
+                    continue
+                if dog is None or dog.image_filename != values.get(
+                        'image_filename', dog.image_filename):
+                    values.update(images.photo_details(
+                        values.get('image_filename')))
+                if dog is None:
+                    new_dogs.append(models.Dog(**values))
+                else:
+                    models.Dog.objects.filter(pk=dog.pk).update(
+                        updated_at=timezone.now(), **values)
+                    updated_ids.append(dog.pk)
+            models.Dog.objects.bulk_create(new_dogs)
+            self.created += len(new_dogs)
+        self.updated += len(updated_ids)
+        conditional.forget_dogs(updated_ids)
+        for result, count in (('created', len(new_dogs)),
+                              ('updated', len(updated_ids)),
+                              ('unchanged', self.unchanged - unchanged),
+                              ('skipped', self.skipped - skipped),
+                              ('invalid', len(self.errors) - errors)):
+            if count:
+                metrics.IMPORTED_ROWS.inc(count, result=result)
+
+    def existing_dogs(self, valid):
+        """Return the dogs already stored for the chunk's natural keys."""
+        if not valid:
+            return {}
+        if len(self.natural_key) == 1:
+            field = self.natural_key[0]
+            queryset = models.Dog.objects.filter(**{
+                field + '__in': [key[0] for key in valid]})
+        else:
+            # Narrow on the first field, then match the full key in Python.
+            queryset = models.Dog.objects.filter(**{
+                self.natural_key[0] + '__in': {key[0] for key in valid}})
+        dogs = {self.key_of_dog(dog): dog for dog in queryset.iterator()}
+        return {key: dog for key, dog in dogs.items() if key in valid}
+
+    @property
+    def seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.read / self.seconds if self.seconds else 0.0
@@ -0,0 +1,224 @@
+"""
+Load-test harness driving simulated swipe sessions through the HTTP API.
+
+Every simulated user registers, logs in, sets random preferences, then
+pulls the next undecided dog and likes or dislikes it, `swipes` times.
+Sessions run concurrently in a thread or process pool and talk plain HTTP
+(urllib), either to a server given by URL or to an in-process threaded
+WSGI server on a throwaway database (see the `loadtest` command).
+
+Each request is timed and reported per endpoint as requests per second and
+p50/p95/p99 latency. The report is also the JSON baseline that later runs
+are compared with.
+"""
+import json
+import math
+import random
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+
+PERCENTILES = (50, 95, 99)
+
+POOLS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+PASSWORD = 'load-test-password'
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of ascending `values`."""
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100 * len(values))))
+    return values[rank - 1]
+
+
+class Client(object):
+    """Minimal JSON API client recording (endpoint, seconds, status)."""
+
+    def __init__(self, base_url, timings, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timings = timings
+        self.timeout = timeout
+        self.token = None
+
+    def request(self, endpoint, method, path, data=None):
+        '''
+        Send a request and return its decoded JSON body, or None when it
+        failed. Connection errors are recorded with a status of 0.
+        '''
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method=method)
+        request.add_header('Accept', 'application/json')
+        if body is not None:
+            request.add_header('Content-Type', 'application/json')
+        if self.token is not None:
+            request.add_header('Authorization', 'Token ' + self.token)
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=self.timeout) as response:
+                status = response.status
+                payload = response.read()
+        except urllib.error.HTTPError as error:
+            status = error.code
+            payload = error.read()
+        except OSError:
+            status = 0
+            payload = b''
+        self.timings.append((endpoint, time.perf_counter() - start, status))
+        if 200 <= status < 300 and payload:
+            return json.loads(payload.decode('utf-8'))
+        return None
+
+
+def random_preferences(rng):
+    def pick(choices):
+        chosen = [choice for choice in choices if rng.random() < 0.7]
+        return ','.join(chosen or [rng.choice(choices)])
+    return {
+        'age': pick(('b', 'y', 'a', 's')),
+        'gender': pick(('m', 'f')),
+        'size': pick(('s', 'm', 'l', 'xl')),
+    }
+
+
+def run_session(base_url, username, swipes, seed, like_ratio=0.5):
+    '''
+    Play the session of one new user and return the timings of its
+    requests. A session ends early if a step fails or the user runs out of
+    dogs.
+    '''
+    rng = random.Random(seed)
+    timings = []
+    client = Client(base_url, timings)
+    credentials = {'username': username, 'password': PASSWORD}
+    client.request('register', 'POST', '/api/user/', credentials)
+    login = client.request('login', 'POST', '/api/user/login/', credentials)
+    if login is None:
+        return timings
+    client.token = login['token']
+    client.request('preferences', 'PUT', '/api/user/preferences/',
+                   random_preferences(rng))
+
+    pk = -1
+    for _ in range(swipes):
+        dog = client.request(
+            'next', 'GET', '/api/dog/{}/undecided/next/'.format(pk))
+        if dog is None or dog['id'] == -1:
+            break
+        status = 'liked' if rng.random() < like_ratio else 'disliked'
+        client.request(status, 'PUT',
+                       '/api/dog/{}/{}/'.format(dog['id'], status))
+        pk = dog['id']
+    return timings
+
+
+def summarize(timings, seconds):
+    '''
+    Return the report of a run: its totals and, per endpoint, the number of
+    requests and errors, requests per second and latencies in milliseconds.
+    '''
+    latencies = defaultdict(list)
+    errors = Counter()
+    for endpoint, elapsed, status in timings:
+        latencies[endpoint].append(elapsed * 1000)
+        if not 200 <= status < 400:
+            errors[endpoint] += 1
+
+    endpoints = {}
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        summary = {
+            'requests': len(values),
+            'errors': errors[endpoint],
+            'rps': len(values) / seconds if seconds else 0.0,
+            'mean_ms': sum(values) / len(values),
+        }
+        for percent in PERCENTILES:
+            summary['p{}_ms'.format(percent)] = percentile(values, percent)
+        endpoints[endpoint] = summary
+    return {
+        'seconds': seconds,
+        'requests': len(timings),
+        'errors': sum(errors.values()),
+        'rps': len(timings) / seconds if seconds else 0.0,
+        'endpoints': endpoints,
+    }
+
+
+def compare(report, baseline, tolerance=0.2):
+    '''
+    Return the regressions of `report` against a `baseline` report: a
+    throughput drop or a p95 latency rise of more than `tolerance`.
+    '''
+    regressions = []
+    if report['rps'] < baseline['rps'] * (1 - tolerance):
+        regressions.append('throughput {:.1f} rps < baseline {:.1f}'.format(
+            report['rps'], baseline['rps']))
+    for endpoint, summary in sorted(report['endpoints'].items()):
+        expected = baseline['endpoints'].get(endpoint)
+        if expected is None:
+            continue
+        if summary['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            regressions.append('{} p95 {:.2f} ms > baseline {:.2f}'.format(
+                endpoint, summary['p95_ms'], expected['p95_ms']))
+    return regressions
+
+
+def run(base_url, users, swipes, concurrency, pool='thread', seed=0):
+    """Run `users` sessions, `concurrency` at a time; return the report."""
+    prefix = 'load-{}'.format(uuid.uuid4().hex[:8])
+    timings = []
+    start = time.perf_counter()
+    with POOLS[pool](concurrency) as executor:
+        futures = [
+            executor.submit(run_session, base_url,
+                            '{}-{}'.format(prefix, number), swipes,
+                            seed + number)
+            for number in range(users)
+        ]
+        for future in futures:
+            timings.extend(future.result())
+    report = summarize(timings, time.perf_counter() - start)
+    report['config'] = {
+        'users': users,
+        'swipes': swipes,
+        'concurrency': concurrency,
+        'pool': pool,
+    }
+    return report
+
+
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(application):
+    '''
+    Serve a WSGI application from a thread, one thread per connection, on
+    a free local port. Return the server and its base URL.
+    '''
+    server = make_server('127.0.0.1', 0, application,
+                         server_class=ThreadedWSGIServer,
+                         handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='pugorugh-loadtest',
+                     daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
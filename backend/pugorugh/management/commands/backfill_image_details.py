@@ -0,0 +1,59 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from pugorugh import conditional
+from pugorugh import images
+from pugorugh import models
+
+
+class Command(BaseCommand):
+    help = ('Store the size, dominant color and placeholder of the dog '
+            'photos, reading the photos in parallel.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (1 reads in this process).')
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Recompute the details of every dog, not only the missing.')
+
+    def handle(self, *args, **options):
+        if not images.is_enabled():
+            raise CommandError('Pillow is required to read the photos.')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        dogs = models.Dog.objects.exclude(image_filename='')
+        if not options['all']:
+            dogs = dogs.filter(image_width__isnull=True)
+        filenames = sorted(set(dogs.values_list('image_filename', flat=True)))
+        paths = [os.path.join(images.source_dir(), filename)
+                 for filename in filenames]
+
+        start = time.perf_counter()
+        if options['workers'] == 1:
+            results = [images.describe_photo(path) for path in paths]
+        else:
+            with ProcessPoolExecutor(options['workers']) as pool:
+                results = list(pool.map(
+                    images.describe_photo, paths,
+                    chunksize=max(1, len(paths) // (options['workers'] * 4))))
+
+        updated = 0
+        with transaction.atomic():
+            for filename, details in zip(filenames, results):
+                if details is None:
+                    self.stderr.write('Unreadable photo: {}'.format(filename))
+                    continue
+                changed = dogs.filter(image_filename=filename)
+                dog_ids = list(changed.values_list('id', flat=True))
+                updated += changed.update(updated_at=timezone.now(), **details)
+                conditional.forget_dogs(dog_ids)
+        self.stdout.write('{} dogs updated from {} photos ({:.2f}s)'.format(
+            updated, len(filenames), time.perf_counter() - start))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment
+
+from pugorugh.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = ('Run a benchmark against a throwaway test database seeded with '
+            'a synthetic dog catalog.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+            help='Catalog sizes (number of dogs) to benchmark.')
+        parser.add_argument(
+            '--repeat', type=int, default=50,
+            help='Number of timed calls per catalog size.')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+
+        # Benchmarks drive the API through the test client.
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        try:
+            BENCHMARKS[options['name']](
+                options['sizes'], options['repeat'], self.stdout)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,98 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from pugorugh import conditional
+from pugorugh import images
+from pugorugh import models
+
+
+class Command(BaseCommand):
+    help = ('Render resized WebP/JPEG variants of the dog photos with '
+            'content-hashed names, skipping unchanged photos.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (1 renders in this process).')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Render every photo, even the unchanged ones.')
+        parser.add_argument(
+            '--prune', action='store_true',
+            help='Delete the variants no dog photo refers to any more.')
+
+    def handle(self, *args, **options):
+        if not images.is_enabled():
+            raise CommandError('Pillow is required to render image variants.')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        source_dir = images.source_dir()
+        out_dir = images.variant_dir()
+        os.makedirs(out_dir, exist_ok=True)
+        manifest = images.read_manifest(out_dir)
+
+        filenames = set(models.Dog.objects.exclude(
+            image_filename=''
+        ).values_list('image_filename', flat=True))
+        todo = []
+        missing = 0
+        for filename in sorted(filenames):
+            path = os.path.join(source_dir, filename)
+            if not os.path.isfile(path):
+                self.stderr.write('Missing photo: {}'.format(filename))
+                missing += 1
+            elif options['force'] or not images.is_current(
+                    manifest.get(filename, {}), path, out_dir):
+                todo.append(filename)
+
+        start = time.perf_counter()
+        paths = [os.path.join(source_dir, filename) for filename in todo]
+        if options['workers'] == 1:
+            results = [images.render_variants(path, out_dir)
+                       for path in paths]
+        else:
+            with ProcessPoolExecutor(options['workers']) as pool:
+                results = list(pool.map(
+                    images.render_variants, paths, [out_dir] * len(paths)))
+        unreadable = 0
+        for filename, path, result in zip(todo, paths, results):
+            if result is None:
+                # Left out of the manifest, so the next run tries again.
+                self.stderr.write('Unreadable photo: {}'.format(filename))
+                unreadable += 1
+                continue
+            digest, variants, details = result
+            dogs = models.Dog.objects.filter(image_filename=filename)
+            conditional.forget_dogs(list(dogs.values_list('id', flat=True)))
+            dogs.update(updated_at=timezone.now(), **details)
+            stat = os.stat(path)
+            manifest[filename] = {
+                'source': digest,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'variants': variants,
+            }
+
+        pruned = 0
+        if options['prune']:
+            manifest = {filename: entry for filename, entry
+                        in manifest.items() if filename in filenames}
+            used = {name for entry in manifest.values()
+                    for formats in entry['variants'].values()
+                    for name in formats.values()}
+            for name in os.listdir(out_dir):
+                if name != images.MANIFEST_NAME and name not in used:
+                    os.remove(os.path.join(out_dir, name))
+                    pruned += 1
+        images.write_manifest(manifest, out_dir)
+
+        self.stdout.write(
+            '{} photos rendered, {} unchanged, {} unreadable, {} files '
+            'pruned ({:.2f}s)'.format(
+                len(todo) - unreadable, len(filenames) - len(todo) - missing,
+                unreadable, pruned, time.perf_counter() - start))
@@ -0,0 +1,90 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from pugorugh import models
+from pugorugh import queries
+
+
+# Prefix turning a SELECT into a query plan request, per database vendor.
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'mysql': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+def hot_queries(user, dog_id):
+    '''
+    Return (name, queryset) pairs for the queries run by views.py, or
+    (name, (sql, params)) for those run as raw SQL.
+    '''
+    pref = models.UserPref(user=user)
+    prefs = (pref.size.split(','), pref.gender.split(','),
+             pref.age.split(','))
+    by_id = queries.undecided_candidates(*prefs)
+    by_score = queries.undecided_candidates(*prefs, ordering='score')
+    ties, lower = queries.ranges_after(by_score, 'score', (0.5, dog_id))
+    return [
+        ('preferences', models.UserPref.objects.filter(user=user)),
+        ('decision bitmaps', models.UserDog.objects.filter(
+            user=user).values_list('dog_id', 'status')),
+        ('undecided candidates', queries.candidates_sql(
+            by_id.filter(id__gt=dog_id)[:33])),
+        ('undecided candidates by score, ties',
+         queries.candidates_sql(ties[:33])),
+        ('undecided candidates by score, lower',
+         queries.candidates_sql(lower[:33])),
+        ('undecided candidates, decided excluded', queries.candidates_sql(
+            queries.exclude_decided(by_id, user).filter(
+                id__gt=dog_id)[:33])),
+        ('undecided end of list', models.Dog.objects.exclude(
+            id__in=models.UserDog.objects.filter(user=user).values('dog_id')
+        ).filter(
+            age_bucket__in=prefs[2], size__in=prefs[0], gender__in=prefs[1]
+        )[:1]),
+        ('liked dogs', queries.filtered_dogs(user, 'liked').filter(
+            id__gt=dog_id).order_by('id')[:1]),
+        ('disliked dogs', queries.filtered_dogs(user, 'disliked').filter(
+            id__gt=dog_id).order_by('id')[:1]),
+        ('dogs by pk', models.Dog.objects.filter(pk__in=[dog_id])),
+        ('decision lookup', models.UserDog.objects.filter(
+            user=user, dog_id=dog_id)),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Print the query plan of every hot query of the API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user-id', type=int, default=1,
+            help='Id of the user to build the queries for.')
+        parser.add_argument(
+            '--dog-id', type=int, default=1,
+            help='Dog id used as the keyset position.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to explain the queries on.')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None:
+            raise CommandError(
+                'EXPLAIN is not supported on {}.'.format(connection.vendor))
+
+        user = get_user_model()(pk=options['user_id'])
+        for name, query in hot_queries(user, options['dog_id']):
+            if isinstance(query, tuple):
+                sql, params = query
+            else:
+                sql, params = query.query.sql_with_params()
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(sql % tuple(repr(param) for param in params))
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                for row in cursor.fetchall():
+                    self.stdout.write('    ' + ' | '.join(
+                        str(column) for column in row))
+            self.stdout.write('')
@@ -0,0 +1,46 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from pugorugh import exports
+
+
+class Command(BaseCommand):
+    help = ('Stream the decisions, joined with their dog and user, as CSV '
+            'or JSON Lines.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=exports.FORMATS, default='csv',
+            help='Output format.')
+        parser.add_argument(
+            '--user-id', type=int,
+            help='Only export the decisions of this user.')
+        parser.add_argument(
+            '--gzip', action='store_true',
+            help='Compress the output with gzip.')
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write to, or - (default) for stdout.')
+
+    def handle(self, *args, **options):
+        chunks = exports.export(
+            options['format'], options['user_id'], options['gzip'])
+        start = time.perf_counter()
+        written = 0
+        if options['output'] == '-':
+            output = sys.stdout.buffer
+        else:
+            output = open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+            else:
+                output.flush()
+        self.stderr.write('{} bytes written ({:.2f}s)'.format(
+            written, time.perf_counter() - start))
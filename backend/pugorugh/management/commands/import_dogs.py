@@ -0,0 +1,55 @@
+import sys
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import importers
+from pugorugh import models
+
+
+class Command(BaseCommand):
+    help = ('Import dogs from a JSON array, JSON Lines or CSV feed, '
+            'updating the dogs already imported.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Feed to import, or - for stdin.')
+        parser.add_argument(
+            '--format', choices=importers.FORMATS,
+            help='Feed format (guessed from the file name by default).')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Rows validated and written per transaction.')
+        parser.add_argument(
+            '--natural-key', default='image_filename',
+            help='Comma separated Dog fields identifying a dog in the feed.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        natural_key = options['natural_key'].split(',')
+        for field in natural_key:
+            try:
+                models.Dog._meta.get_field(field)
+            except FieldDoesNotExist:
+                raise CommandError('Dog has no field {!r}.'.format(field))
+
+        path = options['path']
+        feed_format = options['format'] or importers.guess_format(path)
+        importer = importers.DogImporter(natural_key, options['batch_size'])
+        stream = sys.stdin if path == '-' else importers.open_feed(path)
+        try:
+            importer.run(importers.READERS[feed_format](stream))
+        except ValueError as error:
+            raise CommandError('Invalid {} feed: {}'.format(
+                feed_format, error))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for line, errors in importer.errors:
+            self.stderr.write('Row {}: {}'.format(line, errors))
+        self.stdout.write(
+            '{0.read} rows: {0.created} created, {0.updated} updated, '
+            '{0.unchanged} unchanged, {0.skipped} skipped, {1} invalid '
+            '({0.seconds:.2f}s, {0.rows_per_second:.0f} rows/s)'.format(
+                importer, len(importer.errors)))
@@ -0,0 +1,127 @@
+import json
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+
+from pugorugh import benchmarks
+from pugorugh import decisions
+from pugorugh import loadtest
+from pugorugh import stats
+
+
+class Command(BaseCommand):
+    help = ('Drive concurrent simulated swipe sessions through the API and '
+            'report throughput and latency percentiles per endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            help='Base URL of a running server to load. By default the API '
+                 'is served in-process from a throwaway database.')
+        parser.add_argument(
+            '--dogs', type=int, default=10000,
+            help='Number of synthetic dogs seeded in the throwaway database.')
+        parser.add_argument(
+            '--users', type=int, default=50,
+            help='Number of simulated users, one session each.')
+        parser.add_argument(
+            '--swipes', type=int, default=20,
+            help='Dogs pulled and decided per session.')
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='Number of sessions running at the same time.')
+        parser.add_argument(
+            '--pool', choices=sorted(loadtest.POOLS), default='thread',
+            help='Run the sessions from a thread or a process pool.')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the synthetic data and of the sessions.')
+        parser.add_argument(
+            '--output',
+            help='Write the report as a JSON baseline to this file.')
+        parser.add_argument(
+            '--baseline',
+            help='Compare with a baseline written by --output and fail on '
+                 'regressions.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='Allowed throughput drop and p95 rise against the baseline.')
+
+    def handle(self, *args, **options):
+        for name in ('users', 'swipes', 'concurrency'):
+            if options[name] < 1:
+                raise CommandError('--{} must be at least 1.'.format(name))
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        if options['url']:
+            report = self.run(options['url'], options)
+        else:
+            report = self.run_in_process(options)
+
+        self.write_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        if baseline is not None:
+            regressions = loadtest.compare(
+                report, baseline, options['tolerance'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError('{} regression(s) against {}.'.format(
+                    len(regressions), options['baseline']))
+
+    def run(self, url, options):
+        return loadtest.run(url, options['users'], options['swipes'],
+                            options['concurrency'], options['pool'],
+                            options['seed'])
+
+    def run_in_process(self, options):
+        '''
+        Seed a throwaway database and serve the API from this process. The
+        SQLite test database is a file, so that the server threads share it.
+        '''
+        directory = None
+        if (connection.vendor == 'sqlite' and
+                not connection.settings_dict['TEST'].get('NAME')):
+            directory = tempfile.mkdtemp()
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                directory, 'loadtest.sqlite3')
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        server = None
+        try:
+            benchmarks.seed_dogs(options['dogs'], seed=options['seed'])
+            server, url = loadtest.serve(get_wsgi_application())
+            return self.run(url, options)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            # Write what is buffered before the database goes away.
+            decisions.buffer.stop()
+            stats.buffer.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if directory is not None:
+                os.rmdir(directory)
+
+    def write_report(self, report):
+        columns = ['requests', 'errors', 'rps', 'mean_ms'] + [
+            'p{}_ms'.format(percent) for percent in loadtest.PERCENTILES]
+        self.stdout.write('{:<12}'.format('endpoint') + ''.join(
+            '{:>10}'.format(column) for column in columns))
+        for endpoint, summary in sorted(report['endpoints'].items()):
+            self.stdout.write('{:<12}'.format(endpoint) + ''.join(
+                '{:>10}'.format(summary[column]) if column in (
+                    'requests', 'errors')
+                else '{:>10.2f}'.format(summary[column])
+                for column in columns))
+        self.stdout.write(
+            '{requests} requests, {errors} errors in {seconds:.2f}s: '
+            '{rps:.1f} requests/s'.format(**report))
@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, Count, When
+
+from pugorugh import models
+from pugorugh import stats
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the DogStats popularity counters from UserDog, a chunk '
+            'of dogs at a time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of dogs aggregated and rewritten per transaction.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+
+        start = time.perf_counter()
+        # Deltas queued by this process are part of UserDog already.
+        stats.buffer.flush()
+        default = models.UserPref()
+        last_id = 0
+        dogs = rows = 0
+        while True:
+            dog_ids = list(models.Dog.objects.filter(
+                id__gt=last_id
+            ).order_by('id').values_list('id', flat=True)[
+                :options['chunk_size']])
+            if not dog_ids:
+                break
+            last_id = dog_ids[-1]
+
+            counts = {}
+            for row in models.UserDog.objects.filter(
+                dog_id__gte=dog_ids[0], dog_id__lte=last_id
+            ).order_by().values(
+                'dog_id', 'user__userpref__age', 'user__userpref__gender',
+                'user__userpref__size'
+            ).annotate(
+                likes=Count(Case(When(status='l', then=1))),
+                dislikes=Count(Case(When(status='d', then=1)))
+            ):
+                segment = stats.segment(
+                    row['user__userpref__age'] or default.age,
+                    row['user__userpref__gender'] or default.gender,
+                    row['user__userpref__size'] or default.size)
+                for key in ((row['dog_id'], models.DogStats.ALL),
+                            (row['dog_id'], segment)):
+                    likes, dislikes = counts.get(key, (0, 0))
+                    counts[key] = (likes + row['likes'],
+                                   dislikes + row['dislikes'])
+
+            with transaction.atomic():
+                models.DogStats.objects.filter(
+                    dog_id__gte=dog_ids[0], dog_id__lte=last_id).delete()
+                models.DogStats.objects.bulk_create([
+                    models.DogStats(dog_id=dog_id, segment=segment,
+                                    likes=likes, dislikes=dislikes)
+                    for (dog_id, segment), (likes, dislikes)
+                    in counts.items()])
+            dogs += len(dog_ids)
+            rows += len(counts)
+
+        self.stdout.write('{} dogs, {} DogStats rows ({:.2f}s)'.format(
+            dogs, rows, time.perf_counter() - start))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import models
+from pugorugh import stats
+
+
+class Command(BaseCommand):
+    help = ('Refresh the score of every dog, which orders the score ordered '
+            'undecided queue, from its DogStats counters.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of dogs scored per transaction.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+
+        start = time.perf_counter()
+        last_id = 0
+        dogs = changed = 0
+        while True:
+            dog_ids = list(models.Dog.objects.filter(
+                id__gt=last_id
+            ).order_by('id').values_list('id', flat=True)[
+                :options['chunk_size']])
+            if not dog_ids:
+                break
+            last_id = dog_ids[-1]
+            changed += stats.update_scores(dog_ids)
+            dogs += len(dog_ids)
+
+        self.stdout.write('{} dogs scored, {} changed ({:.2f}s)'.format(
+            dogs, changed, time.perf_counter() - start))
@@ -0,0 +1,328 @@
+"""
+Counters and histograms exposed at `/metrics` in the Prometheus text format.
+
+Each process adds to plain dicts in memory, under one uncontended lock, so
+recording costs about a microsecond. With `PUGORUGH_METRICS_DIR` set, a
+background thread writes the values of the process to its own JSON file
+in that directory every `PUGORUGH_METRICS_INTERVAL_MS` milliseconds (and
+at exit), and `/metrics` sums the files of every process. Files of exited
+processes keep counting, so the totals never go down; empty the directory
+when deploying. Without a directory `/metrics` only shows this process.
+
+The file of a process is named after its pid when it first records a value.
+A worker forked from a process that already recorded some (uWSGI, gunicorn
+`--preload`) starts over from zero under a name of its own, the parent's
+values being counted in the parent's file.
+"""
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import querylog
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def is_enabled():
+    return getattr(settings, 'PUGORUGH_METRICS', True)
+
+
+def directory():
+    return getattr(settings, 'PUGORUGH_METRICS_DIR', None)
+
+
+def interval():
+    return getattr(settings, 'PUGORUGH_METRICS_INTERVAL_MS', 1000) / 1000
+
+
+class Store(object):
+    '''
+    The counter values and histogram buckets of this process, keyed by
+    (metric name, label values).
+    '''
+
+    def __init__(self):
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._thread = None
+        self._filename = None
+
+    def _check_pid(self):
+        """Start over in a process forked after values were recorded."""
+        pid = os.getpid()
+        if pid != self._pid:
+            if self._pid is not None:
+                # The lock may have been held by another thread at the fork.
+                self._reset()
+            self._pid = pid
+
+    @property
+    def filename(self):
+        self._check_pid()
+        if self._filename is None:
+            self._filename = 'pugorugh-{}-{}.json'.format(
+                self._pid, uuid.uuid4().hex[:8])
+        return self._filename
+
+    def inc(self, key, amount):
+        self._check_pid()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        if self._thread is None:
+            self.start()
+
+    def observe(self, key, bounds, value):
+        self._check_pid()
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                # One count per bucket, then the sum.
+                values = self._histograms[key] = [0] * (len(bounds) + 2)
+            values[bisect.bisect_left(bounds, value)] += 1
+            values[-1] += value
+        if self._thread is None:
+            self.start()
+
+    def snapshot(self):
+        self._check_pid()
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value]
+                             for (name, labels), value
+                             in self._counters.items()],
+                'histograms': [[name, list(labels), list(values)]
+                               for (name, labels), values
+                               in self._histograms.items()],
+            }
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = False
+            if not directory():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='pugorugh-metrics', daemon=True)
+            self._thread.start()
+        atexit.register(self.dump)
+
+    def _run(self):
+        while True:
+            time.sleep(interval())
+            try:
+                self.dump()
+            except OSError:
+                logger.exception('Writing the metrics of %s failed',
+                                 self.filename)
+
+    def dump(self):
+        """Write the values of this process to its file, atomically."""
+        path = os.path.join(directory(), self.filename)
+        with open(path + '.tmp', 'w') as output:
+            json.dump(self.snapshot(), output)
+        os.replace(path + '.tmp', path)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+store = Store()
+
+# Name -> metric, in exposition order.
+METRICS = OrderedDict()
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        METRICS[name] = self
+
+    def key(self, labels):
+        return (self.name, tuple(str(labels[label]) for label in self.labels))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        store.inc(self.key(labels), amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        store.observe(self.key(labels), self.buckets, value)
+
+
+REQUEST_SECONDS = Histogram(
+    'pugorugh_request_duration_seconds',
+    'Request latency by URL name, method and status.',
+    ('view', 'method', 'status'),
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+QUERIES = Histogram(
+    'pugorugh_db_queries', 'SQL queries per request by URL name.', ('view',),
+    (0, 1, 2, 3, 4, 5, 6, 8, 10, 20, 50))
+CACHE_REQUESTS = Counter(
+    'pugorugh_cache_requests_total', 'Cache lookups by cache and result.',
+    ('cache', 'result'))
+DECISIONS = Counter(
+    'pugorugh_decisions_total', 'Swipe decisions by status.', ('status',))
+REGISTRATIONS = Counter(
+    'pugorugh_registrations_total', 'Registered users.')
+IMPORTED_ROWS = Counter(
+    'pugorugh_import_rows_total', 'Dog feed rows imported by result.',
+    ('result',))
+IMPORT_SECONDS = Counter(
+    'pugorugh_import_seconds_total', 'Time spent importing dog feeds.')
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def cache_lookups(cache, hits, misses):
+    """Count the hits and misses of a `get_many()`."""
+    if hits:
+        CACHE_REQUESTS.inc(hits, cache=cache, result='hit')
+    if misses:
+        CACHE_REQUESTS.inc(misses, cache=cache, result='miss')
+
+
+def snapshots():
+    """Return the snapshot of this process and those of the others."""
+    result = [store.snapshot()]
+    if directory():
+        own = os.path.join(directory(), store.filename)
+        for path in glob.glob(os.path.join(directory(), 'pugorugh-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as snapshot:
+                    result.append(json.load(snapshot))
+            except (OSError, ValueError):
+                # Exited or rewritten meanwhile.
+                continue
+    return result
+
+
+def collect():
+    """Sum the snapshots into {name: {labels: value or values}}."""
+    totals = {}
+    for snapshot in snapshots():
+        for name, labels, value in snapshot['counters']:
+            samples = totals.setdefault(name, {})
+            labels = tuple(labels)
+            samples[labels] = samples.get(labels, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            samples = totals.setdefault(name, {})
+            labels = tuple(labels)
+            current = samples.get(labels)
+            samples[labels] = (values if current is None else
+                               [a + b for a, b in zip(current, values)])
+    return totals
+
+
+def escape(value):
+    return (value.replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    totals = collect()
+    lines = []
+    for name, metric in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(name, metric.kind))
+        for labels, value in sorted(totals.get(name, {}).items()):
+            if metric.kind == 'counter':
+                lines.append('{}{} {}'.format(
+                    name, format_labels(metric.labels, labels),
+                    format_number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),),
+                                    value[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(metric.labels, labels, [
+                        ('le', format_number(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(metric.labels, labels),
+                format_number(value[-1])))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(metric.labels, labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    '''
+    Time every request by URL name, method and status, and count its SQL
+    queries on every database alias by URL name.
+    '''
+
+    def __init__(self):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        request._metrics_queries = querylog.Capture().__enter__()
+        request._metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            captured = request._metrics_queries
+            captured.__exit__(None, None, None)
+            match = getattr(request, 'resolver_match', None)
+            view = match.view_name if match else '<unresolved>'
+            REQUEST_SECONDS.observe(elapsed, view=view,
+                                    method=request.method,
+                                    status=response.status_code)
+            QUERIES.observe(len(captured), view=view)
+        return response
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_age_bucket(apps, schema_editor):
+    Dog = apps.get_model('pugorugh', 'Dog')
+    db_alias = schema_editor.connection.alias
+    for bucket, low, high in (('b', 0, 12), ('y', 12, 24), ('a', 24, 72),
+                              ('s', 72, 200)):
+        Dog.objects.using(db_alias).filter(
+            age__gte=low, age__lt=high
+        ).update(age_bucket=bucket)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pugorugh', '0019_auto_20170504_0934'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dog',
+            name='age_bucket',
+            field=models.CharField(blank=True, choices=[('b', 'baby'), ('y', 'young'), ('a', 'adult'), ('s', 'senior')], db_index=True, default='', editable=False, max_length=1),
+        ),
+        migrations.RunPython(backfill_age_bucket, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def remove_duplicate_user_dogs(apps, schema_editor):
+    """Keep only the latest decision of each (user, dog) pair."""
+    UserDog = apps.get_model('pugorugh', 'UserDog')
+    db_alias = schema_editor.connection.alias
+    duplicates = UserDog.objects.using(db_alias).values('user', 'dog').annotate(
+        rows=Count('id'),
+        latest=Max('id')
+    ).filter(rows__gt=1)
+    for duplicate in duplicates.iterator():
+        UserDog.objects.using(db_alias).filter(
+            user=duplicate['user'],
+            dog=duplicate['dog']
+        ).exclude(id=duplicate['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pugorugh', '0020_dog_age_bucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_user_dogs, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='userdog',
+            unique_together=set([('user', 'dog')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userdog',
+            index_together=set([('user', 'status', 'dog')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pugorugh', '0024_dogstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dog',
+            name='score',
+            field=models.FloatField(default=0.5, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='dog',
+            index_together=set([('score', 'id')]),
+        ),
+    ]
@@ -1,7 +1,12 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
 from django.db.models.signals import post_save
 
+from . import checks
+from . import metrics
+
 
 class Dog(models.Model):
     """Dog model class."""
@@ -17,6 +22,19 @@ class Dog(models.Model):
         ('xl', 'extra large'),
         ('u', 'unknown'),
     )
+    AGE_BUCKET_CHOICES = (
+        ('b', 'baby'),
+        ('y', 'young'),
+        ('a', 'adult'),
+        ('s', 'senior'),
+    )
+    # Age bucket -> [low, high) range of ages in months.
+    AGE_BUCKET_RANGES = (
+        ('b', 0, 12),
+        ('y', 12, 24),
+        ('a', 24, 72),
+        ('s', 72, 200),
+    )
 
     name = models.CharField(max_length=255, default='Unknown name')
     image_filename = models.CharField(max_length=255, default='')
@@ -33,10 +51,58 @@ class Dog(models.Model):
         default='Unknown size'
     )
     neutered = models.BooleanField(default=False)
+    # Derived from age on save, so that preference filtering is a small IN
+    # on an indexed column. Blank for ages outside of every bucket.
+    age_bucket = models.CharField(
+        max_length=1,
+        choices=AGE_BUCKET_CHOICES,
+        blank=True,
+        default='',
+        db_index=True,
+        editable=False
+    )
+    # Precomputed from the photo (see pugorugh.images) so that clients can
+    # lay out and paint the card before the photo arrives.
+    image_width = models.PositiveIntegerField(null=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, editable=False)
+    dominant_color = models.CharField(
+        max_length=7,
+        blank=True,
+        default='',
+        editable=False
+    )
+    placeholder = models.TextField(blank=True, default='', editable=False)
+    # Validator of the conditional GETs, see pugorugh.conditional.
+    updated_at = models.DateTimeField(auto_now=True)
+    # Rank in the score ordered undecided queue, higher first. Refreshed
+    # from DogStats by the update_dog_scores command.
+    score = models.FloatField(default=0.5, editable=False)
+
+    class Meta:
+        # Keyset pagination of the score ordered queue on (score, id).
+        index_together = ('score', 'id')
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def age_bucket_for(cls, age):
+        """Return the age bucket of an age in months."""
+        for bucket, low, high in cls.AGE_BUCKET_RANGES:
+            if age is not None and low <= age < high:
+                return bucket
+        return ''
+
+    def save(self, *args, **kwargs):
+        self.age_bucket = self.age_bucket_for(self.age)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            derived = {'updated_at'}
+            if 'age' in update_fields:
+                derived.add('age_bucket')
+            kwargs['update_fields'] = set(update_fields) | derived
+        super().save(*args, **kwargs)
+
 
 class UserDog(models.Model):
     """User's Dog decision model class."""
@@ -52,10 +118,43 @@ class UserDog(models.Model):
         choices=STATUS_CHOICES,
     )
 
+    class Meta:
+        unique_together = ('user', 'dog')
+        # Covers the liked/disliked listings, which filter on (user, status)
+        # and only read dog ids.
+        index_together = ('user', 'status', 'dog')
+
     def __str__(self):
         return self.user.username + ' - ' + self.dog.name + ' - ' + self.status
 
 
+class DogStats(models.Model):
+    '''
+    Likes and dislikes of a dog among the users of a preference segment.
+
+    Maintained incrementally by the decision actions (see pugorugh.stats)
+    and rebuilt from `UserDog` by the `rebuild_dog_stats` command.
+    '''
+    # Segment of the rows counting every user.
+    ALL = 'all'
+
+    dog = models.ForeignKey(Dog, on_delete=models.CASCADE)
+    segment = models.CharField(max_length=32)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('dog', 'segment')
+
+    def __str__(self):
+        return '{} - {}'.format(self.dog_id, self.segment)
+
+    @property
+    def like_rate(self):
+        decided = self.likes + self.dislikes
+        return self.likes / decided if decided else None
+
+
 class UserPref(models.Model):
     """User Preference model class."""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -71,10 +170,51 @@ class UserPref(models.Model):
         max_length=8,
         default='s,m,l,xl'
     )
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.user.username
 
+    @staticmethod
+    def cache_key(user_id):
+        return 'pugorugh:userpref:{}'.format(user_id)
+
+    @classmethod
+    def for_user(cls, user):
+        '''
+        Return the preferences of a user, read through the cache.
+
+        On a cache hit the returned instance is unsaved and has no id; it is
+        only meant to be read. Preferences can be changed through any worker
+        process, so they are read from the DB unless the default cache is
+        shared between the processes (see pugorugh.checks).
+        '''
+        if not checks.shared_default_cache():
+            return cls.objects.get(user=user)
+        cached = cache.get(cls.cache_key(user.pk))
+        metrics.cache_lookup('preferences', cached is not None)
+        if cached is None:
+            user_pref = cls.objects.get(user=user)
+            user_pref.write_cache()
+            return user_pref
+        (size, gender, age, updated_at) = cached
+        return cls(user=user, size=size, gender=gender, age=age,
+                   updated_at=updated_at)
+
+    def write_cache(self):
+        if not checks.shared_default_cache():
+            return
+        cache.set(
+            self.cache_key(self.user_id),
+            (self.size, self.gender, self.age, self.updated_at),
+            getattr(settings, 'PUGORUGH_PREFS_CACHE_TIMEOUT', 60 * 60 * 24)
+        )
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Write-through, so that cached preferences never go stale.
+        self.write_cache()
+
 
 def create_userpref(sender, **kwargs):
     """Create UserPref isntance whenever User is created."""
@@ -0,0 +1,197 @@
+"""
+Sampled request profiling aggregated into fixed-size histograms.
+
+With `PUGORUGH_PROFILING = True`, `ProfilingMiddleware` profiles a
+`PUGORUGH_PROFILING_SAMPLE_RATE` share of the requests: wall time, SQL
+time and query count, time spent in serializers (see
+`ProfiledSerializerMixin`) and response size. Samples are folded into one
+histogram per metric and URL name (e.g. `filtered-dog-detail`,
+`api:dog-liked`), so memory stays bounded by the number of routes however
+long the process runs. Staff read the aggregates of the process from
+`/api/stats/profiling/`.
+"""
+import bisect
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import querylog
+
+
+# Upper bounds of the histogram buckets of each metric; a last bucket
+# counts the samples above the last bound.
+BOUNDS = {
+    'wall_ms': (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000),
+    'sql_ms': (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    'queries': (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50, 100),
+    'serializer_ms': (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200),
+    'response_bytes': (256, 1024, 4096, 16384, 65536, 262144, 1048576,
+                       4194304),
+}
+
+PERCENTILES = (50, 95, 99)
+
+# URL name of the requests that matched no route.
+UNRESOLVED = '<unresolved>'
+
+
+def is_enabled():
+    return getattr(settings, 'PUGORUGH_PROFILING', False)
+
+
+def sample_rate():
+    return getattr(settings, 'PUGORUGH_PROFILING_SAMPLE_RATE', 0.01)
+
+
+class Histogram(object):
+    """Bucket counts plus the count, sum and max of one metric."""
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        '''
+        Return the upper bound of the bucket holding the percentile, or the
+        max for the last bucket.
+        '''
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'max': round(self.max, 3),
+            'buckets': dict(zip(
+                [str(bound) for bound in self.bounds] + ['inf'],
+                self.buckets)),
+        }
+        for percent in PERCENTILES:
+            summary['p{}'.format(percent)] = self.percentile(percent)
+        return summary
+
+
+class Registry(object):
+    """Process-local histograms per URL name and metric."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, sample):
+        with self._lock:
+            histograms = self._routes.get(route)
+            if histograms is None:
+                histograms = self._routes[route] = {
+                    metric: Histogram(bounds)
+                    for metric, bounds in BOUNDS.items()}
+            for metric, value in sample.items():
+                if value is not None:
+                    histograms[metric].add(value)
+
+    def report(self):
+        """Return the routes, most total wall time first."""
+        with self._lock:
+            report = [
+                dict({metric: histogram.summary()
+                      for metric, histogram in histograms.items()},
+                     route=route,
+                     total_wall_ms=round(histograms['wall_ms'].total, 3))
+                for route, histograms in self._routes.items()
+            ]
+        report.sort(key=lambda route: route['total_wall_ms'], reverse=True)
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+registry = Registry()
+
+_local = threading.local()
+
+
+class Profile(object):
+    __slots__ = ('start', 'queries', 'serializer_seconds')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = querylog.Capture()
+        self.serializer_seconds = 0.0
+
+
+def current():
+    """Return the profile of the request of this thread, if sampled."""
+    return getattr(_local, 'profile', None)
+
+
+class ProfiledSerializerMixin(object):
+    """Add the time spent serializing to the current profile."""
+
+    def to_representation(self, instance):
+        profile = current()
+        if profile is None:
+            return super().to_representation(instance)
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            profile.serializer_seconds += time.perf_counter() - start
+
+
+class ProfilingMiddleware(object):
+    """Profile a sample of the requests, see the module docstring."""
+
+    def __init__(self):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        _local.profile = None
+        if random.random() >= sample_rate():
+            return None
+        profile = Profile()
+        profile.queries.__enter__()
+        _local.profile = profile
+        return None
+
+    def process_response(self, request, response):
+        profile = current()
+        if profile is None:
+            return response
+        _local.profile = None
+        profile.queries.__exit__(None, None, None)
+
+        match = getattr(request, 'resolver_match', None)
+        queries = profile.queries.captured_queries
+        registry.record(match.view_name if match else UNRESOLVED, {
+            'wall_ms': (time.perf_counter() - profile.start) * 1000,
+            'sql_ms': sum(float(query['time']) for query in queries) * 1000,
+            'queries': len(profile.queries),
+            'serializer_ms': profile.serializer_seconds * 1000,
+            'response_bytes': (None if response.streaming
+                               else len(response.content)),
+        })
+        return response
@@ -0,0 +1,377 @@
+import bisect
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.shortcuts import Http404
+
+from . import catalog
+from . import conditional
+from . import decisions
+from . import metrics
+from . import models
+from . import similarity
+
+
+def dog_image_url(image_filename):
+    """URL of a dog photo, as the swipe UI builds it."""
+    return '{}images/dogs/{}'.format(settings.STATIC_URL, image_filename)
+
+
+def end_of_list_dog():
+    """Imaginary Dog with the id of -1 sent when the user ran out of dogs."""
+    return models.Dog(
+        name=None,
+        image_filename=None,
+        breed=None,
+        age=None,
+        gender=None,
+        size=None,
+        id=-1
+    )
+
+
+def user_prefs(user):
+    """Return the (sizes, genders, ages) lists the given user prefers."""
+    user_pref = models.UserPref.for_user(user)
+    return (user_pref.size.split(','), user_pref.gender.split(','),
+            user_pref.age.split(','))
+
+
+def filtered_dogs(user, dog_filter):
+    '''
+    Return an unevaluated queryset of the dogs matching the filter choice
+    (undecided, liked or disliked) of the given user.
+
+    All filtering happens in SQL so that callers can apply a keyset
+    (`id > pk`) on top of it without loading the candidate ids.
+    '''
+    if dog_filter == 'undecided':
+        (sizes, genders, ages) = user_prefs(user)
+
+        # Dogs liked and disliked by the current user, as a subquery.
+        decided_dog_ids = models.UserDog.objects.filter(
+            user=user
+        ).values('dog_id')
+
+        return models.Dog.objects.exclude(
+            id__in=decided_dog_ids
+        ).filter(
+            age_bucket__in=ages,
+            size__in=sizes,
+            gender__in=genders
+        )
+
+    elif dog_filter == 'liked':
+        return models.Dog.objects.filter(
+            userdog__user=user,
+            userdog__status='l'
+        )
+
+    else:
+        return models.Dog.objects.filter(
+            userdog__user=user,
+            userdog__status='d'
+        )
+
+
+# Number of extra candidate rows fetched per query when skipping the dogs
+# a user already decided on.
+UNDECIDED_SCAN_SLACK = 32
+
+# Number of candidate batches filtered through the decided bitmap before
+# the rest of the page is read with the decided dogs excluded in SQL.
+UNDECIDED_MAX_BATCHES = 1
+
+
+# Orderings of the undecided queue: oldest first, newest first, highest
+# `Dog.score` first (newest first among equal scores) and most similar to
+# the user's liked dogs first (see pugorugh.similarity).
+UNDECIDED_ORDERINGS = ('id', 'recent', 'score', 'recommended')
+
+ORDER_BY = {
+    'id': ('id',),
+    'recent': ('-id',),
+    'score': ('-score', '-id'),
+}
+
+
+def undecided_ordering():
+    return getattr(settings, 'PUGORUGH_UNDECIDED_ORDERING', 'id')
+
+
+def undecided_candidates(sizes, genders, ages, ordering='id'):
+    """Dogs matching the given preferences, decided or not, in `ordering`."""
+    return models.Dog.objects.filter(
+        age_bucket__in=ages,
+        size__in=sizes,
+        gender__in=genders
+    ).order_by(*ORDER_BY[ordering])
+
+
+def position_of(pk, ordering):
+    '''
+    Return the keyset position, a (score, id) pair, of the dog `pk` in
+    `ordering`, or None to start from the top.
+
+    Only the score ordering needs to read the dog, by primary key. A pk of
+    -1, or of a dog deleted since, starts over.
+    '''
+    if ordering == 'id' or (ordering == 'recent' and pk >= 0):
+        return (None, pk)
+    if pk < 0:
+        return None
+    score = models.Dog.objects.filter(
+        pk=pk
+    ).values_list('score', flat=True).first()
+    return None if score is None else (score, pk)
+
+
+def ranges_after(queryset, ordering, position):
+    '''
+    Keyset filter: the dogs of `queryset` past `position` in `ordering`, as
+    a list of querysets to read in turn, each one index range.
+
+    The score ordering is split in two: the rest of the dogs scoring `s`
+    (`score = s AND id < pk`), then the lower scores. Neither
+    `score < s OR (score = s AND id < pk)` nor the `(score, id) < (s, pk)`
+    row value seeks into the (score, id) index on SQLite: both scan every
+    dog scoring `s` from the top, and most dogs keep the default score.
+    '''
+    if position is None:
+        return [queryset]
+    score, pk = position
+    if ordering == 'id':
+        return [queryset.filter(id__gt=pk)]
+    if ordering == 'recent':
+        return [queryset.filter(id__lt=pk)]
+    return [queryset.filter(score=score, id__lt=pk),
+            queryset.filter(score__lt=score)]
+
+
+def candidates_sql(queryset):
+    '''
+    Return the SQL and parameters of a slice of `undecided_candidates`.
+
+    Without ANALYZE statistics SQLite prefers the `age_bucket` index of the
+    preference filter and sorts the matches in a temporary B-tree, reading
+    every matching dog for each page. On SQLite the age bucket term is
+    written `+age_bucket IN (...)`, SQLite's hint not to use an index for
+    it, which leaves the primary key or the (score, id) index to walk in
+    order.
+    '''
+    sql, params = queryset.query.sql_with_params()
+    connection = connections[queryset.db]
+    if connection.vendor == 'sqlite':
+        column = '{}.{} IN ('.format(
+            connection.ops.quote_name(models.Dog._meta.db_table),
+            connection.ops.quote_name('age_bucket'))
+        sql = sql.replace(column, '+' + column)
+    return sql, params
+
+
+def fetch_candidates(queryset):
+    """Evaluate a slice of `undecided_candidates`, see `candidates_sql`."""
+    sql, params = candidates_sql(queryset)
+    return list(models.Dog.objects.db_manager(queryset.db).raw(sql, params))
+
+
+def exclude_decided(queryset, user):
+    '''
+    Exclude the dogs the user decided on from `queryset` in SQL: those of
+    the `UserDog` rows, as a subquery, and those still pending in the
+    write-behind buffer.
+    '''
+    queryset = queryset.exclude(id__in=models.UserDog.objects.filter(
+        user=user
+    ).values('dog_id'))
+    pending = [dog_id for dog_id, _ in decisions.buffer.pending_for(user.pk)]
+    if pending:
+        queryset = queryset.exclude(id__in=pending)
+    return queryset
+
+
+def _catalog_page(user, pk, limit):
+    '''
+    Look undecided dogs up in the in-memory catalog index.
+
+    Returns the dogs plus a callable telling whether the filter matches any
+    dog at all, which is only needed at the end of the list.
+    '''
+    (sizes, genders, ages) = user_prefs(user)
+    prefs = (ages, sizes, genders, decisions.get_bitmaps(user).decided)
+
+    index = catalog.get_catalog()
+    dog_ids = index.match_after(pk, limit, *prefs)
+    dogs = models.Dog.objects.in_bulk(dog_ids)
+    return ([dogs[dog_id] for dog_id in dog_ids if dog_id in dogs],
+            lambda: index.has_match(*prefs))
+
+
+def _undecided_page(user, pk, limit, ordering='id'):
+    '''
+    Walk the dogs matching the user preferences in `ordering`, skipping
+    those set in the user's decided bitmap instead of joining `UserDog`.
+
+    Every ordering is an index range scan from a keyset position: `id` for
+    the id orderings, `(score, id)` for the score ordering.
+
+    A user who decided on most of the dogs walked would need batch after
+    batch: past `UNDECIDED_MAX_BATCHES` batches the rest of the page is
+    read with the decided dogs excluded in SQL (`exclude_decided`), so a
+    page costs a bounded number of queries.
+    '''
+    (sizes, genders, ages) = user_prefs(user)
+    bitmaps = decisions.get_bitmaps(user)
+    queryset = undecided_candidates(sizes, genders, ages, ordering)
+    position = position_of(pk, ordering)
+
+    def has_match():
+        return filtered_dogs(user, 'undecided').exists()
+
+    dogs = []
+    batch_size = limit + UNDECIDED_SCAN_SLACK
+    for _ in range(UNDECIDED_MAX_BATCHES):
+        batch = []
+        for part in ranges_after(queryset, ordering, position):
+            batch.extend(fetch_candidates(part[:batch_size - len(batch)]))
+            if len(batch) == batch_size:
+                break
+        dogs.extend(dog for dog in batch if not bitmaps.is_decided(dog.id))
+        if len(dogs) >= limit or len(batch) < batch_size:
+            return dogs[:limit], has_match
+        position = (batch[-1].score, batch[-1].id)
+
+    for part in ranges_after(exclude_decided(queryset, user), ordering,
+                             position):
+        dogs.extend(fetch_candidates(part[:limit - len(dogs)]))
+        if len(dogs) == limit:
+            break
+    return dogs, has_match
+
+
+def _recommended_page(user, pk, limit):
+    """Rank the undecided dogs by similarity to the user's liked dogs."""
+    (sizes, genders, ages) = user_prefs(user)
+    bitmaps = decisions.get_bitmaps(user)
+    prefs = (ages, sizes, genders, bitmaps.decided)
+
+    dog_ids = similarity.recommended_after(pk, limit, bitmaps.liked, *prefs)
+    dogs = models.Dog.objects.in_bulk(dog_ids)
+    return ([dogs[dog_id] for dog_id in dog_ids if dog_id in dogs],
+            lambda: catalog.get_catalog().has_match(*prefs))
+
+
+def _decided_page(user, dog_filter, pk, limit):
+    """Read liked or disliked dogs straight off the user's bitmaps."""
+    bitmap = decisions.get_bitmaps(user).for_filter(dog_filter)
+    dogs = []
+    while len(dogs) < limit:
+        dog_ids = decisions.ids_after(bitmap, pk, limit - len(dogs))
+        if not dog_ids:
+            break
+        # Dogs deleted since the bitmap was built are skipped.
+        found = models.Dog.objects.in_bulk(dog_ids)
+        dogs.extend(found[dog_id] for dog_id in dog_ids if dog_id in found)
+        pk = dog_ids[-1]
+    return dogs, lambda: decisions.any_set(bitmap)
+
+
+def decided_ids_key(user_id, version, dog_filter):
+    return 'pugorugh:browse:{}:{}:{}'.format(user_id, version, dog_filter)
+
+
+def decided_ids(user, dog_filter):
+    '''
+    Return the sorted ids of the user's liked or disliked dogs.
+
+    The list is cached under the user's decision version, so any decision
+    of the user makes it unreachable at once, when the decisions are (see
+    `decisions.is_cached`).
+    '''
+    if not decisions.is_cached():
+        return read_decided_ids(user, dog_filter)
+    key = decided_ids_key(
+        user.pk, decisions.decision_version(user.pk), dog_filter)
+    dog_ids = cache.get(key)
+    metrics.cache_lookup('decided-ids', dog_ids is not None)
+    if dog_ids is None:
+        dog_ids = read_decided_ids(user, dog_filter)
+        cache.set(key, dog_ids, decisions.cache_timeout())
+    return dog_ids
+
+
+def read_decided_ids(user, dog_filter):
+    bitmap = decisions.get_bitmaps(user).for_filter(dog_filter)
+    return array('l', decisions.ids_after(bitmap, -1, len(bitmap) * 8))
+
+
+def next_decided(user, dog_filter, pk, limit):
+    '''
+    Return up to `limit` (dog_id, updated_at) pairs of the liked or disliked
+    dogs after `pk`, plus whether the list holds any dog at all.
+
+    Served from the cache alone once it is warm: the id list, then the dog
+    versions, which also skip the dogs deleted since the decision.
+    '''
+    dog_ids = decided_ids(user, dog_filter)
+    start = bisect.bisect_right(dog_ids, pk)
+    found = []
+    while len(found) < limit and start < len(dog_ids):
+        batch = dog_ids[start:start + limit - len(found)]
+        versions = conditional.dog_versions(batch)
+        found.extend((dog_id, versions[dog_id])
+                     for dog_id in batch if dog_id in versions)
+        start += len(batch)
+    return found, bool(dog_ids)
+
+
+def _page(user, dog_filter, pk, limit, ordering='id'):
+    """Return up to `limit` dogs after `pk` and a has-any-match callable."""
+    if dog_filter != 'undecided':
+        return _decided_page(user, dog_filter, pk, limit)
+    if ordering == 'recommended':
+        if similarity.is_enabled():
+            return _recommended_page(user, pk, limit)
+        ordering = 'score'
+    # The catalog index is kept in id order only.
+    if catalog.is_enabled() and ordering == 'id':
+        return _catalog_page(user, pk, limit)
+    return _undecided_page(user, pk, limit, ordering)
+
+
+def next_dog(user, dog_filter, pk, ordering='id'):
+    '''
+    Return the first dog of the user's filter after the dog `pk`: the first
+    one with a greater id, or for the undecided filter the next one in
+    `ordering` (see UNDECIDED_ORDERINGS).
+
+    This is a single indexed `id > pk ORDER BY id LIMIT 1` query (or a
+    catalog index or bitmap lookup). Only when it comes back empty is the
+    filter checked for any match at all, to tell the end of the list (the
+    -1 dog) apart from an empty list (404).
+    '''
+    dogs, has_match = _page(user, dog_filter, pk, 1, ordering)
+    if dogs:
+        return dogs[0]
+    if has_match():
+        return end_of_list_dog()
+    raise Http404
+
+
+def next_dogs(user, dog_filter, pk, count, ordering='id'):
+    '''
+    Return `(dogs, cursor)` for the page of up to `count` dogs of the
+    user's filter after the dog `pk`, as for `next_dog`.
+
+    `cursor` is the pk to request the following page with, or None once the
+    end of the list is reached. One extra row is fetched to find out whether
+    another page exists, so a full page costs a single query.
+    '''
+    dogs, has_match = _page(user, dog_filter, pk, count + 1, ordering)
+    if len(dogs) > count:
+        return dogs[:count], dogs[count - 1].id
+    if not dogs and not has_match():
+        raise Http404
+    return dogs, None
@@ -0,0 +1,39 @@
+"""
+Capture of the SQL queries a request runs, on every database alias.
+
+With the replica router (see pugorugh.routers) the reads of a request go
+to a replica alias, so watching the default connection alone, as
+`django.test.utils.CaptureQueriesContext` does, misses them. `Capture`
+turns on the query log of every connection of the thread (Django keeps one
+set of connections per thread) and collects what each logged meanwhile.
+"""
+from itertools import islice
+
+from django.db import connections
+
+
+class Capture(object):
+    """Context manager collecting the {'sql', 'time'} entries of a block."""
+
+    def __init__(self):
+        self.captured_queries = []
+        self._states = []
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def __enter__(self):
+        self.captured_queries = []
+        self._states = []
+        for connection in connections.all():
+            self._states.append((connection, connection.force_debug_cursor,
+                                 len(connection.queries_log)))
+            connection.force_debug_cursor = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection, forced, start in self._states:
+            connection.force_debug_cursor = forced
+            self.captured_queries.extend(
+                islice(connection.queries_log, start, None))
+        self._states = []
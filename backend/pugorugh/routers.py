@@ -0,0 +1,135 @@
+"""
+Read-replica routing with read-your-writes stickiness.
+
+`ReplicaRouter` sends every write to the default (primary) database. Reads
+go to the primary too, except inside a replica read, which views opt into
+with `ReplicaReadMixin`: for the safe requests of such a view (of its
+`replica_actions`, on a viewset), all reads after authentication go to one
+of the `PUGORUGH_REPLICA_DATABASES` aliases, picked at random per request.
+
+Replicas lag behind the primary. Once a user sends a write request
+(anything but GET, HEAD or OPTIONS) to one of these views, the user's reads
+stick to the primary for `PUGORUGH_REPLICA_STICKY_SECONDS`. The deadline is
+kept in the default cache, which must therefore be shared between the
+worker processes (see pugorugh.checks): with a process-local cache a read
+served by another worker than the write would miss it. Replicas are
+refused with `ImproperlyConfigured` otherwise. Keep the window above the
+replication lag and the write-behind flush interval.
+
+Other users may still read a row before it reaches their replica, and
+what a lagging replica fills the caches with (a dog version, the catalog)
+stays there until the next invalidation.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+from . import checks
+
+
+_local = threading.local()
+
+
+def replicas():
+    aliases = getattr(settings, 'PUGORUGH_REPLICA_DATABASES', ())
+    if aliases and not checks.shared_default_cache():
+        raise ImproperlyConfigured(
+            'PUGORUGH_REPLICA_DATABASES needs a default cache shared '
+            'between processes to keep the reads of a user who just wrote '
+            'on the primary.')
+    return aliases
+
+
+def sticky_seconds():
+    return getattr(settings, 'PUGORUGH_REPLICA_STICKY_SECONDS', 10)
+
+
+def sticky_key(user_id):
+    return 'pugorugh:primary:{}'.format(user_id)
+
+
+def stick_to_primary(user_id):
+    """Send the reads of the user to the primary for the sticky window."""
+    seconds = sticky_seconds()
+    cache.set(sticky_key(user_id), time.time() + seconds, seconds)
+
+
+def is_sticky(user_id):
+    deadline = cache.get(sticky_key(user_id))
+    return deadline is not None and deadline > time.time()
+
+
+def current():
+    """Return the replica the reads of this thread go to, if any."""
+    return getattr(_local, 'replica', None)
+
+
+def begin_replica_reads(user_id=None):
+    '''
+    Send the reads of this thread to a replica until `end_replica_reads()`,
+    unless no replica is configured or the user wrote recently. Return the
+    replica, or None.
+    '''
+    aliases = replicas()
+    if not aliases or (user_id is not None and is_sticky(user_id)):
+        _local.replica = None
+    else:
+        _local.replica = random.choice(aliases)
+    return _local.replica
+
+
+def end_replica_reads():
+    _local.replica = None
+
+
+class ReplicaRouter(object):
+    """Writes to the primary; reads to the replica of the thread, if any."""
+
+    def db_for_read(self, model, **hints):
+        return current()
+
+    def db_for_write(self, model, **hints):
+        # Not None: instances read from a replica must be saved on the
+        # primary, not where they were read from.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # A replica holds the rows of the primary.
+        databases = {DEFAULT_DB_ALIAS}.union(replicas())
+        if {obj1._state.db, obj2._state.db} <= databases:
+            return True
+        return None
+
+
+class ReplicaReadMixin(object):
+    '''
+    Serve the safe requests of a view from a replica, see the module
+    docstring. On a viewset `replica_actions` lists the actions to serve
+    from a replica; None means all of them.
+    '''
+    replica_actions = None
+
+    def initial(self, request, *args, **kwargs):
+        # Authentication and permissions read from the primary.
+        super().initial(request, *args, **kwargs)
+        if not replicas():
+            return
+        user_id = request.user.pk
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            if user_id is not None:
+                stick_to_primary(user_id)
+            return
+        action = getattr(self, 'action', None)
+        if self.replica_actions is None or action in self.replica_actions:
+            begin_replica_reads(user_id)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            end_replica_reads()
@@ -3,14 +3,7 @@ import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 django.setup()
 
-from pugorugh.serializers import DogSerializer
-import json
+from django.core.management import call_command
 
-with open('pugorugh/static/dog_details.json', 'r') as file:
-    data = json.load(file)
-
-    serializer = DogSerializer(data=data, many=True)
-    if serializer.is_valid():
-        serializer.save()
-    else:
-        print(serializer.errors)
+# Re-running the import updates the dogs instead of duplicating them.
+call_command('import_dogs', 'pugorugh/static/dog_details.json')
@@ -2,10 +2,12 @@ from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
 
+from . import images
 from . import models
+from .profiling import ProfiledSerializerMixin
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
     def create(self, validated_data):
@@ -20,18 +22,30 @@ class UserSerializer(serializers.ModelSerializer):
         model = get_user_model()
 
 
-class StaffUserSerializer(serializers.ModelSerializer):
+class StaffUserSerializer(ProfiledSerializerMixin,
+                          serializers.ModelSerializer):
     class Meta:
         model = get_user_model()
         fields = ('is_staff',)
 
 
-class DogSerializer(serializers.ModelSerializer):
+class DogSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
+    # {variant: {format: url}} of the resized photos, see pugorugh.images.
+    image_variants = serializers.SerializerMethodField()
+
+    def get_image_variants(self, dog):
+        return images.variant_index.urls(dog.image_filename)
+
     class Meta:
         fields = (
             'id',
             'name',
             'image_filename',
+            'image_variants',
+            'image_width',
+            'image_height',
+            'dominant_color',
+            'placeholder',
             'breed',
             'age',
             'gender',
@@ -40,7 +54,22 @@ class DogSerializer(serializers.ModelSerializer):
         model = models.Dog
 
 
-class UserDogSerializer(serializers.ModelSerializer):
+class DogImportSerializer(serializers.ModelSerializer):
+    """Validates the rows of a dog feed (see the import_dogs command)."""
+    class Meta:
+        fields = (
+            'name',
+            'image_filename',
+            'breed',
+            'age',
+            'gender',
+            'size',
+            'neutered'
+        )
+        model = models.Dog
+
+
+class UserDogSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         fields = (
             'dog',
@@ -49,7 +78,13 @@ class UserDogSerializer(serializers.ModelSerializer):
         model = models.UserDog
 
 
-class UserPrefSerializer(serializers.ModelSerializer):
+class DecisionSerializer(serializers.Serializer):
+    """A single decision of a bulk decision submission."""
+    dog = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=('l', 'd', 'u'))
+
+
+class UserPrefSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         fields = (
             'age',
@@ -0,0 +1,118 @@
+"""
+Content-based "similar dogs" rankings over the in-memory dog catalog.
+
+The features of a dog are columns of the catalog index: breed, size,
+gender, age bucket and neutered flag, each a small integer code. A profile
+holds, per feature, the weighted share of the reference dogs (one dog, or
+the dogs a user liked) having each code. A dog scores the sum of the
+profile shares of its own codes, which is the dot product of its one-hot
+feature vector with the profile, computed with one `numpy.take` per
+feature. The top K then comes from `numpy.argpartition`, so ranking a
+million dogs takes a few tens of milliseconds and no query.
+
+Ties rank the newest dogs first, like the score ordering of the undecided
+queue.
+
+Like the catalog index, the rankings are disabled when the default cache is
+not shared between processes (see pugorugh.checks): the catalog of a worker
+would never see the dogs changed through another one.
+"""
+from django.conf import settings
+
+from . import catalog
+from . import checks
+
+
+# (feature, catalog column, weight)
+FEATURES = (
+    ('breed', 4, 2.0),
+    ('size', 2, 1.0),
+    ('age', 1, 1.0),
+    ('gender', 3, 0.5),
+    ('neutered', 5, 0.5),
+)
+
+
+def is_enabled():
+    return (catalog.numpy is not None and
+            getattr(settings, 'PUGORUGH_SIMILARITY', True) and
+            checks.shared_default_cache())
+
+
+def rows_of(ids, dog_ids):
+    """Return the catalog rows of those of `dog_ids` that are in `ids`."""
+    numpy = catalog.numpy
+    dog_ids = numpy.asarray(dog_ids, dtype=numpy.int64)
+    if not len(ids) or not len(dog_ids):
+        return numpy.zeros(0, dtype=numpy.int64)
+    rows = numpy.minimum(numpy.searchsorted(ids, dog_ids), len(ids) - 1)
+    return rows[ids[rows] == dog_ids]
+
+
+def scores(columns, rows):
+    """Score every dog of `columns` against the profile of the dogs `rows`."""
+    numpy = catalog.numpy
+    result = numpy.zeros(len(columns[0]), dtype=numpy.float32)
+    if not len(rows):
+        return result
+    for _, column, weight in FEATURES:
+        shares = numpy.bincount(columns[column][rows]).astype(numpy.float32)
+        shares *= weight / len(rows)
+        # Codes missing from the reference dogs share nothing: the trailing
+        # 0 takes every code past the last one seen.
+        shares = numpy.append(shares, numpy.float32(0))
+        result += numpy.take(shares, columns[column], mode='clip')
+    return result
+
+
+def top(ids, dog_scores, mask, limit):
+    """Return the rows of the `limit` best scores within `mask`, in order."""
+    numpy = catalog.numpy
+    rows = numpy.flatnonzero(mask)
+    if len(rows) > limit:
+        values = dog_scores[rows]
+        kth = numpy.partition(values, len(rows) - limit)[len(rows) - limit]
+        above = rows[values > kth]
+        tied = rows[values == kth][::-1][:limit - len(above)]
+        rows = numpy.concatenate((above, tied))
+    return rows[numpy.lexsort((-ids[rows], -dog_scores[rows]))]
+
+
+def similar_to(dog_id, limit):
+    '''
+    Return the ids of the `limit` dogs most similar to the dog `dog_id`, or
+    None if that dog is not in the catalog.
+    '''
+    columns = catalog.get_catalog().columns()
+    ids = columns[0]
+    rows = rows_of(ids, [dog_id])
+    if not len(rows):
+        return None
+    mask = catalog.numpy.ones(len(ids), dtype=bool)
+    mask[rows[0]] = False
+    return ids[top(ids, scores(columns, rows), mask, limit)].tolist()
+
+
+def recommended_after(pk, limit, liked, ages, sizes, genders, decided=b''):
+    '''
+    Return up to `limit` ids of the undecided dogs matching the preferences,
+    most similar to the dogs of the `liked` bitmap first, that come after
+    the dog `pk` in that ranking.
+
+    The ranking is recomputed on every call, so the position of `pk` is
+    its current (score, id); a pk of -1, or of a dog deleted since, starts
+    over.
+    '''
+    numpy = catalog.numpy
+    index = catalog.get_catalog()
+    columns = index.columns()
+    ids = columns[0]
+    liked_ids = numpy.flatnonzero(
+        numpy.unpackbits(numpy.frombuffer(liked, dtype=numpy.uint8)))
+    dog_scores = scores(columns, rows_of(ids, liked_ids))
+    mask = index.matching(columns, ages, sizes, genders, decided)
+    rows = rows_of(ids, [pk]) if pk >= 0 else ()
+    if len(rows):
+        score = dog_scores[rows[0]]
+        mask &= (dog_scores < score) | ((dog_scores == score) & (ids < pk))
+    return ids[top(ids, dog_scores, mask, limit)].tolist()
@@ -150,10 +150,28 @@ var Dog = React.createClass({
       );
     }
 
+    var card = (this.state.details.image_variants || {}).card;
+    // Reserve the photo's box and paint its placeholder until it loads.
+    var imageProps = {
+      className: "dog-photo",
+      width: this.state.details.image_width,
+      height: this.state.details.image_height,
+      style: {
+        backgroundColor: this.state.details.dominant_color || undefined,
+        backgroundImage: this.state.details.placeholder ? "url(" + this.state.details.placeholder + ")" : undefined,
+        backgroundSize: "cover"
+      }
+    };
+
     return React.createElement(
       "div",
       null,
-      React.createElement("img", { src: "static/images/dogs/" + this.state.details.image_filename }),
+      card ? React.createElement(
+        "picture",
+        null,
+        React.createElement("source", { srcSet: card.webp, type: "image/webp" }),
+        React.createElement("img", Object.assign({ src: card.jpeg }, imageProps))
+      ) : React.createElement("img", Object.assign({ src: "static/images/dogs/" + this.state.details.image_filename }, imageProps)),
       React.createElement(
         "p",
         { className: "dog-card" },
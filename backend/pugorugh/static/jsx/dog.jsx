@@ -116,9 +116,27 @@ var Dog = React.createClass({
       );
     }
 
+    var card = (this.state.details.image_variants || {}).card;
+    // Reserve the photo's box and paint its placeholder until it loads.
+    var imageProps = {
+      className: "dog-photo",
+      width: this.state.details.image_width,
+      height: this.state.details.image_height,
+      style: {
+        backgroundColor: this.state.details.dominant_color || undefined,
+        backgroundImage: this.state.details.placeholder ? "url(" + this.state.details.placeholder + ")" : undefined,
+        backgroundSize: "cover"
+      }
+    };
+
     return (
       <div>
-        <img src={"static/images/dogs/" + this.state.details.image_filename} />
+        {card ? (
+          <picture>
+            <source srcSet={card.webp} type="image/webp" />
+            <img src={card.jpeg} {...imageProps} />
+          </picture>
+        ) : <img src={"static/images/dogs/" + this.state.details.image_filename} {...imageProps} />}
         <p className="dog-card">
           {this.state.details.name}&bull;
           {this.state.details.breed}&bull;
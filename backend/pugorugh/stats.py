@@ -0,0 +1,215 @@
+"""
+Incremental maintenance of the `DogStats` popularity counters.
+
+Every decision turns into like/dislike deltas, computed from the status the
+user's decision bitmaps held before it, for the dog's `DogStats.ALL` row and
+for the row of the user's preference segment. The deltas are summed in an
+in-process buffer that a background thread applies every
+`PUGORUGH_DOG_STATS_INTERVAL_MS` milliseconds, so the decision actions run
+no extra query. A flush costs one `UPDATE ... SET likes = likes + n`
+(`F()` expressions) per distinct (segment, delta), whatever the number of
+dogs, and takes the SQLite write lock of the process (see
+`pugorugh.writebehind`) so that it does not fail the decision writes.
+
+The counters are off by default (`PUGORUGH_DOG_STATS = False`): the flush
+is a second writer, which a single-file SQLite database serializes with
+the swipes. Run `rebuild_dog_stats` after turning them on.
+
+The segment is the one of the user's preferences when deciding. The
+`rebuild_dog_stats` command recomputes everything from `UserDog` with the
+current preferences, which also fixes the rare double count of two
+concurrent decisions of a user on the same dog.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.db.models import Case, F, FloatField, Value, When
+
+from . import models
+from . import writebehind
+
+
+def is_enabled():
+    return getattr(settings, 'PUGORUGH_DOG_STATS', False)
+
+
+def canonical(value, choices):
+    """Return a comma separated preference in the order of `choices`."""
+    chosen = set(value.split(','))
+    return ','.join(code for code, _ in choices if code in chosen)
+
+
+def segment(age, gender, size):
+    """Return the segment of a set of preferences, e.g. "b,y|f|s,m"."""
+    return '|'.join((
+        canonical(age, models.Dog.AGE_BUCKET_CHOICES),
+        canonical(gender, models.Dog.GENDER_CHOICES),
+        canonical(size, models.Dog.SIZE_CHOICES),
+    ))
+
+
+def segment_for(user):
+    user_pref = models.UserPref.for_user(user)
+    return segment(user_pref.age, user_pref.gender, user_pref.size)
+
+
+def deltas(changes):
+    '''
+    Return {dog_id: (likes delta, dislikes delta)} for (dog_id, old status,
+    new status) changes.
+    '''
+    result = {}
+    for dog_id, old, new in changes:
+        likes, dislikes = result.get(dog_id, (0, 0))
+        result[dog_id] = (likes + (new == 'l') - (old == 'l'),
+                          dislikes + (new == 'd') - (old == 'd'))
+    return {dog_id: delta for dog_id, delta in result.items()
+            if delta != (0, 0)}
+
+
+def apply_deltas(counts):
+    '''
+    Add {(dog_id, segment): (likes, dislikes)} deltas to `DogStats`, with one
+    UPDATE per distinct (segment, delta).
+    '''
+    counts = {key: delta for key, delta in counts.items()
+              if delta != (0, 0)}
+    if not counts:
+        return
+    using = router.db_for_write(models.DogStats)
+    with writebehind.serialized_writes(using), transaction.atomic(using):
+        create_missing(set(counts), using)
+        grouped = defaultdict(list)
+        for (dog_id, dog_segment), delta in counts.items():
+            grouped[dog_segment, delta].append(dog_id)
+        for (dog_segment, (likes, dislikes)), dog_ids in grouped.items():
+            models.DogStats.objects.using(using).filter(
+                segment=dog_segment, dog_id__in=dog_ids
+            ).update(likes=F('likes') + likes,
+                     dislikes=F('dislikes') + dislikes)
+
+
+def create_missing(keys, using):
+    """Create zeroed `DogStats` rows for the (dog_id, segment) keys."""
+    segments = {dog_segment for _, dog_segment in keys}
+    existing = set(models.DogStats.objects.using(using).filter(
+        dog_id__in={dog_id for dog_id, _ in keys}, segment__in=segments
+    ).values_list('dog_id', 'segment'))
+    missing = keys - existing
+    if not missing:
+        return
+    try:
+        with transaction.atomic(using):
+            models.DogStats.objects.using(using).bulk_create([
+                models.DogStats(dog_id=dog_id, segment=dog_segment)
+                for dog_id, dog_segment in missing])
+    except IntegrityError:
+        # Another request created some of them first.
+        for dog_id, dog_segment in missing:
+            models.DogStats.objects.using(using).get_or_create(
+                dog_id=dog_id, segment=dog_segment)
+
+
+class DeltaBuffer(writebehind.DecisionBuffer):
+    """Summed (dog_id, segment) -> (likes, dislikes) deltas to apply."""
+
+    def merge(self, key, value):
+        likes, dislikes = self._pending.get(key, (0, 0))
+        self._pending[key] = (likes + value[0], dislikes + value[1])
+
+    def restore(self, batch):
+        for key, value in batch.items():
+            self.merge(key, value)
+
+
+def write_deltas(rows):
+    """Writer of the delta buffer: (dog_id, segment, delta) rows."""
+    apply_deltas({(dog_id, dog_segment): delta
+                  for dog_id, dog_segment, delta in rows})
+
+
+buffer = DeltaBuffer(
+    write_deltas,
+    interval=getattr(settings, 'PUGORUGH_DOG_STATS_INTERVAL_MS', 1000) / 1000,
+    batch_size=getattr(settings, 'PUGORUGH_DOG_STATS_BATCH', 1000),
+    name='pugorugh-dog-stats',
+)
+
+
+def record(user, changes):
+    '''
+    Queue the `DogStats` deltas of (dog_id, old status, new status) decision
+    changes of a user; the old status is None for a first decision.
+    '''
+    if not is_enabled():
+        return
+    dog_deltas = deltas(changes)
+    if not dog_deltas:
+        return
+    user_segment = segment_for(user)
+    for dog_id, delta in dog_deltas.items():
+        buffer.put((dog_id, models.DogStats.ALL), delta)
+        buffer.put((dog_id, user_segment), delta)
+
+
+# Pseudo-counts of the like rate prior: a dog nobody decided on scores 0.5,
+# the default `Dog.score`, and a few decisions move it only a little.
+PRIOR_LIKES = 1
+PRIOR_DISLIKES = 1
+
+
+# Dogs per score UPDATE: three parameters each, under the 999 variables
+# of older SQLite builds.
+SCORE_UPDATE_BATCH = 300
+
+
+def score(likes, dislikes):
+    """Return the smoothed like rate ranking a dog in the score ordering."""
+    return ((likes + PRIOR_LIKES) /
+            (likes + dislikes + PRIOR_LIKES + PRIOR_DISLIKES))
+
+
+def update_scores(dog_ids):
+    '''
+    Store the score of the given dogs from their `DogStats.ALL` row and
+    return the number of dogs whose score changed.
+
+    The changed scores are written `SCORE_UPDATE_BATCH` dogs per UPDATE,
+    with a `CASE id WHEN ... THEN <score>` expression; the score is not part
+    of the serialized dog, so the dog versions are left alone.
+    '''
+    counts = dict.fromkeys(dog_ids, (0, 0))
+    counts.update(
+        (dog_id, (likes, dislikes))
+        for dog_id, likes, dislikes in models.DogStats.objects.filter(
+            dog_id__in=dog_ids, segment=models.DogStats.ALL
+        ).values_list('dog_id', 'likes', 'dislikes'))
+    changed = {}
+    for dog_id, current in models.Dog.objects.filter(
+            id__in=dog_ids).values_list('id', 'score'):
+        new = score(*counts[dog_id])
+        if new != current:
+            changed[dog_id] = new
+    using = router.db_for_write(models.Dog)
+    changed_ids = sorted(changed)
+    with transaction.atomic(using):
+        for start in range(0, len(changed_ids), SCORE_UPDATE_BATCH):
+            batch = changed_ids[start:start + SCORE_UPDATE_BATCH]
+            models.Dog.objects.using(using).filter(id__in=batch).update(
+                score=Case(*[When(id=dog_id, then=Value(changed[dog_id]))
+                             for dog_id in batch],
+                           default=F('score'), output_field=FloatField()))
+    return len(changed)
+
+
+def dog_stats(dog_id):
+    """Return {segment: {likes, dislikes, like_rate}} of a dog."""
+    return {
+        row.segment: {
+            'likes': row.likes,
+            'dislikes': row.dislikes,
+            'like_rate': row.like_rate,
+        }
+        for row in models.DogStats.objects.filter(dog_id=dog_id)
+    }
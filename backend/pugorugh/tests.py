@@ -1,13 +1,51 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.db import connection, connections
+from django.db.models import Q
+from django.test import (LiveServerTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
 
 from rest_framework.test import APIClient, APITestCase
 from rest_framework.authtoken.models import Token
 
-from .models import Dog, UserDog, UserPref
+from . import authentication
+from . import benchmarks
+from . import budgets
+from . import catalog
+from . import checks
+from . import decisions
+from . import exports
+from . import images
+from . import importers
+from . import loadtest
+from . import metrics
+from . import profiling
+from . import queries
+from . import routers
+from . import similarity
+from . import stats
+from . import writebehind
+from .models import Dog, DogStats, UserDog, UserPref
 from .serializers import (UserSerializer, DogSerializer,
                           UserDogSerializer, UserPrefSerializer)
+from .views import DogViewSet, GetFilteredDog
 
 
 # Test data
@@ -70,6 +108,13 @@ dog6 = {
 # Base testing
 class BasicSetupForAPITests(APITestCase):
     def setUp(self):
+        cache.clear()
+        authentication.token_cache.clear()
+        # DogStats deltas are flushed by the tests, not by a thread.
+        patcher = mock.patch.object(stats, 'buffer', stats.DeltaBuffer(
+            stats.write_deltas, autostart=False))
+        self.stats_buffer = patcher.start()
+        self.addCleanup(patcher.stop)
         self.client = APIClient()
         self.test_user = get_user_model().objects.create(
             username='test_user',
@@ -176,6 +221,53 @@ class DogViewsTests(BasicSetupForAPITests):
         self.assertEqual(response2.data, {'dog': 2, 'status': 'u'})
         self.assertEqual(response2.data['dog'], self.test_dog2.pk)
 
+    def test_change_status_of_missing_dog(self):
+        response = self.client.put('/api/dog/999/liked/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(UserDog.objects.filter(dog_id=999).exists())
+
+    def test_change_dog_status_single_query(self):
+        # Cached by any next-dog lookup.
+        decisions.get_bitmaps(self.test_user)
+        with self.assertNumQueries(2):
+            # Token authentication plus the upsert.
+            response = self.client.put(
+                '/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.assertEqual(response.data, {'dog': self.test_dog5.pk,
+                                         'status': 'l'})
+        self.assertEqual(
+            UserDog.objects.get(user=self.test_user, dog=self.test_dog5).status,
+            'l'
+        )
+
+    # /api/dog/decisions/
+    def test_bulk_decisions(self):
+        response = self.client.post('/api/dog/decisions/', [
+            {'dog': self.test_dog5.pk, 'status': 'l'},
+            {'dog': self.test_dog1.pk, 'status': 'd'},
+            {'dog': 999, 'status': 'l'},
+            {'dog': self.test_dog6.pk, 'status': 'x'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0], {'dog': self.test_dog5.pk,
+                                            'status': 'l'})
+        self.assertEqual(response.data[1], {'dog': self.test_dog1.pk,
+                                            'status': 'd'})
+        self.assertEqual(response.data[2]['errors'], {'dog': ['Not found.']})
+        self.assertIn('status', response.data[3]['errors'])
+        self.assertEqual(
+            dict(UserDog.objects.filter(
+                user=self.test_user).values_list('dog_id', 'status')),
+            {self.test_dog1.pk: 'd', self.test_dog2.pk: 'l',
+             self.test_dog3.pk: 'd', self.test_dog4.pk: 'd',
+             self.test_dog5.pk: 'l'}
+        )
+
+    def test_bulk_decisions_requires_list(self):
+        response = self.client.post(
+            '/api/dog/decisions/', {'dog': 1, 'status': 'l'})
+        self.assertEqual(response.status_code, 400)
+
     # /api/dog/<pk>/liked/next/
     def test_get_next_liked_dog(self):
         response = self.client.get('/api/dog/1/liked/next/')
@@ -199,6 +291,58 @@ class DogViewsTests(BasicSetupForAPITests):
         self.assertEqual(data['id'], -1)
         self.assertEqual(data['name'], None)
 
+    def test_get_next_liked_dog_skips_to_following_id(self):
+        response = self.client.get('/api/dog/1/liked/next/')
+        self.assertEqual(response.data['id'], self.test_dog2.pk)
+
+    def test_get_next_liked_dog_exceed_max_pk(self):
+        response = self.client.get('/api/dog/2/liked/next/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], -1)
+
+    def test_get_next_dog_without_any_dogs(self):
+        UserDog.objects.filter(status='d').delete()
+        response = self.client.get('/api/dog/-1/disliked/next/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_next_dogs_page(self):
+        response = self.client.get('/api/dog/-1/liked/next/', {'count': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [dog['id'] for dog in response.data['results']],
+            [self.test_dog1.pk]
+        )
+        self.assertEqual(response.data['next'], self.test_dog1.pk)
+        self.assertEqual(
+            response.data['images'],
+            [settings.STATIC_URL + 'images/dogs/buddy.png']
+        )
+
+        response = self.client.get(
+            '/api/dog/{}/liked/next/'.format(response.data['next']),
+            {'count': 5}
+        )
+        self.assertEqual(
+            [dog['id'] for dog in response.data['results']],
+            [self.test_dog2.pk]
+        )
+        self.assertIsNone(response.data['next'])
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_liked_dogs_read_from_the_db_without_a_shared_cache(self):
+        response = self.client.get('/api/dog/-1/liked/next/')
+        self.assertEqual(response.data['id'], self.test_dog1.pk)
+        # Disliked through another worker process.
+        UserDog.objects.filter(dog=self.test_dog1).update(status='d')
+        response = self.client.get('/api/dog/-1/liked/next/')
+        self.assertEqual(response.data['id'], self.test_dog2.pk)
+
+    def test_get_next_dogs_page_bad_count(self):
+        response = self.client.get('/api/dog/-1/liked/next/', {'count': 0})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/dog/-1/liked/next/', {'count': 'a'})
+        self.assertEqual(response.status_code, 400)
+
     def test_bad_filter(self):
         response = self.client.get('/api/dog/1/likedd/next/')
         self.assertEqual(response.status_code, 404)
@@ -231,10 +375,153 @@ class DogViewsTests(BasicSetupForAPITests):
         self.assertEqual(response.data['age'], 50)
 
 
+@override_settings(PUGORUGH_CATALOG_INDEX=False)
+class DogViewsWithoutCatalogTests(DogViewsTests):
+    pass
+
+
 class UserDogViewsTests(BasicSetupForAPITests):
     pass
 
 
+@override_settings(PUGORUGH_WRITE_BEHIND=True)
+class WriteBehindTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        buffer = writebehind.DecisionBuffer(
+            decisions.write_decisions, autostart=False)
+        patcher = mock.patch.object(decisions, 'buffer', buffer)
+        self.buffer = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_decisions_are_buffered(self):
+        response = self.client.put(
+            '/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.assertEqual(response.data, {'dog': self.test_dog5.pk,
+                                         'status': 'l'})
+        self.assertEqual(self.buffer.depth(), 1)
+        self.assertFalse(UserDog.objects.filter(dog=self.test_dog5).exists())
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(
+            UserDog.objects.get(user=self.test_user, dog=self.test_dog5).status,
+            'l'
+        )
+        self.assertEqual(self.buffer.stats()['flushed'], 1)
+
+    def test_reads_see_pending_decisions(self):
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.client.put('/api/dog/{}/disliked/'.format(self.test_dog2.pk))
+        # Even once the bitmaps are evicted from the cache.
+        cache.clear()
+        response = self.client.get('/api/dog/-1/liked/next/', {'count': 5})
+        self.assertEqual(
+            [dog['id'] for dog in response.data['results']],
+            [self.test_dog1.pk, self.test_dog5.pk]
+        )
+
+    def test_reads_see_decisions_being_flushed(self):
+        started, release = threading.Event(), threading.Event()
+
+        def writer(rows):
+            # Holds the batch as an uncommitted transaction would.
+            started.set()
+            release.wait(5)
+        self.buffer.writer = writer
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        flusher = threading.Thread(target=self.buffer.flush)
+        flusher.start()
+        self.addCleanup(flusher.join)
+        self.addCleanup(release.set)
+        self.assertTrue(started.wait(5))
+
+        cache.clear()
+        bitmaps = decisions.get_bitmaps(self.test_user)
+        self.assertTrue(decisions.test_bit(bitmaps.liked, self.test_dog5.pk))
+        self.assertEqual(self.buffer.pending_for(self.test_user.pk),
+                         [(self.test_dog5.pk, 'l')])
+        release.set()
+        flusher.join()
+        self.assertEqual(self.buffer.pending_for(self.test_user.pk), [])
+
+    def test_missing_dog(self):
+        response = self.client.put('/api/dog/999/liked/')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.buffer.depth(), 0)
+
+    def test_stats_are_staff_only(self):
+        response = self.client.get('/api/stats/write-behind/')
+        self.assertEqual(response.status_code, 403)
+        self.test_user.is_staff = True
+        self.test_user.save()
+        response = self.client.get('/api/stats/write-behind/')
+        self.assertEqual(response.data['depth'], 0)
+        self.assertTrue(response.data['enabled'])
+
+
+class ConcurrentDecisionTests(TransactionTestCase):
+    @mock.patch.object(stats, 'buffer', stats.DeltaBuffer(
+        stats.write_deltas, autostart=False))
+    def test_concurrent_swipes_on_same_dog(self):
+        user = get_user_model().objects.create(username='swiper')
+        token = Token.objects.create(user=user)
+        dog = Dog.objects.create(**dog1)
+        url = '/api/dog/{}/{}/'
+        statuses = []
+        errors = []
+
+        def swipe(status):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+            try:
+                response = client.put(url.format(dog.pk, status))
+                statuses.append(response.status_code)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=swipe, args=(('liked', 'disliked')[i % 2],))
+            for i in range(16)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(statuses, [200] * 16)
+        self.assertEqual(
+            UserDog.objects.filter(user=user, dog=dog).count(), 1)
+
+    @override_settings(PUGORUGH_DOG_STATS=True)
+    def test_swipes_while_the_stats_thread_flushes(self):
+        buffer = stats.DeltaBuffer(stats.write_deltas, interval=0.001,
+                                   name='pugorugh-dog-stats-test')
+        patcher = mock.patch.object(stats, 'buffer', buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = get_user_model().objects.create(username='swiper')
+        token = Token.objects.create(user=user)
+        dogs = Dog.objects.bulk_create([
+            Dog(**dict(dog1, image_filename='{}.jpg'.format(i)))
+            for i in range(40)])
+        dog_ids = list(Dog.objects.values_list('id', flat=True))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        statuses = [client.put('/api/dog/{}/liked/'.format(dog_id)).status_code
+                    for dog_id in dog_ids]
+        self.assertTrue(buffer.stats()['running'])
+        buffer.stop()
+
+        self.assertEqual(statuses, [200] * len(dogs))
+        self.assertEqual(buffer.failures, 0)
+        self.assertEqual(DogStats.objects.filter(
+            segment=DogStats.ALL, likes=1).count(), len(dogs))
+
+
 class UserPrefViewsTests(BasicSetupForAPITests):
     def test_get_user_pref(self):
         response = self.client.get('/api/user/preferences/')
@@ -267,6 +554,839 @@ class UserPrefViewsTests(BasicSetupForAPITests):
         self.assertEqual(response.data['size'], test_user_pref.size)
 
 
+class CachedUserPrefTests(BasicSetupForAPITests):
+    def test_preferences_read_through_cache(self):
+        self.client.get('/api/user/preferences/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/user/preferences/')
+        self.assertEqual(response.data['age'], 'b,y,a,s')
+
+    def test_preferences_write_through(self):
+        self.client.get('/api/user/preferences/')
+        self.client.put(
+            '/api/user/preferences/',
+            {'age': ['b', 'a'], 'gender': 'f', 'size': 'xl'}
+        )
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/user/preferences/')
+        self.assertEqual(response.data['age'], 'b,a')
+        self.assertEqual(response.data['size'], 'xl')
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_preferences_read_from_the_db_without_a_shared_cache(self):
+        UserPref.for_user(self.test_user)
+        # Preferences saved by another worker process.
+        UserPref.objects.filter(user=self.test_user).update(size='xl')
+        self.assertEqual(UserPref.for_user(self.test_user).size, 'xl')
+
+    def test_new_user_preferences_are_cached(self):
+        user = get_user_model().objects.create(username='new_user')
+        with self.assertNumQueries(0):
+            user_pref = UserPref.for_user(user)
+        self.assertEqual(user_pref.gender, 'm,f')
+
+    def test_next_undecided_dog_without_preference_query(self):
+        self.client.get('/api/dog/-1/undecided/next/')
+        with self.assertNumQueries(1):
+            # The dog itself.
+            response = self.client.get('/api/dog/-1/undecided/next/')
+        self.assertEqual(response.data['id'], self.test_dog5.pk)
+
+
+class CachedTokenAuthenticationTests(BasicSetupForAPITests):
+    def test_token_is_cached(self):
+        self.client.get('/api/user/isstaff/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/user/isstaff/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get('/api/user/isstaff/')
+        self.user_token.delete()
+        response = self.client.get('/api/user/isstaff/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get('/api/user/isstaff/')
+        self.test_user.is_active = False
+        self.test_user.save()
+        response = self.client.get('/api/user/isstaff/')
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(PUGORUGH_TOKEN_CACHE_SHARED='default')
+    def test_shared_cache(self):
+        self.client.get('/api/user/isstaff/')
+        authentication.token_cache.clear()
+        with self.assertNumQueries(0):
+            self.client.get('/api/user/isstaff/')
+        self.test_user.is_active = False
+        self.test_user.save()
+        authentication.token_cache.clear()
+        response = self.client.get('/api/user/isstaff/')
+        self.assertEqual(response.status_code, 401)
+
+
+class DecidedBrowsingCacheTests(BasicSetupForAPITests):
+    def test_repeat_browsing_hits_memory_only(self):
+        url = '/api/dog/{}/liked/next/'.format(self.test_dog1.pk)
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['id'], self.test_dog2.pk)
+        self.client.get('/api/dog/-1/liked/next/?count=5')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/dog/-1/liked/next/?count=5')
+        self.assertEqual(
+            [dog['id'] for dog in response.data['results']],
+            [self.test_dog1.pk, self.test_dog2.pk])
+
+    def test_swipe_bumps_decision_version(self):
+        version = decisions.decision_version(self.test_user.pk)
+        self.client.get('/api/dog/-1/disliked/next/?count=5')
+        self.client.post('/api/dog/{}/disliked/'.format(self.test_dog1.pk))
+        self.assertEqual(
+            decisions.decision_version(self.test_user.pk), version + 1)
+        response = self.client.get('/api/dog/-1/disliked/next/?count=5')
+        self.assertEqual(
+            [dog['id'] for dog in response.data['results']],
+            [self.test_dog1.pk, self.test_dog3.pk, self.test_dog4.pk])
+
+    def test_changed_and_deleted_dogs(self):
+        url = '/api/dog/-1/liked/next/'
+        self.client.get(url)
+        self.test_dog1.name = 'Bud'
+        self.test_dog1.save()
+        self.assertEqual(self.client.get(url).data['name'], 'Bud')
+        Dog.objects.get(pk=self.test_dog1.pk).delete()
+        self.assertEqual(self.client.get(url).data['id'], self.test_dog2.pk)
+
+    def test_evicted_version_is_not_reused(self):
+        version = decisions.decision_version(self.test_user.pk)
+        cache.delete(decisions.version_key(self.test_user.pk))
+        self.assertGreater(
+            decisions.decision_version(self.test_user.pk), version)
+
+
+class DecisionExportTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        self.test_user.is_staff = True
+        self.test_user.save()
+
+    def content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_staff_only(self):
+        self.test_user.is_staff = False
+        self.test_user.save()
+        response = self.client.get('/api/export/decisions/')
+        self.assertEqual(response.status_code, 403)
+
+    def test_csv_export(self):
+        response = self.client.get('/api/export/decisions/')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(
+            self.content(response).decode('utf-8').splitlines()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['dog_name'], 'Buddy')
+        self.assertEqual(rows[0]['username'], 'test_user')
+        self.assertEqual(rows[2]['status'], 'd')
+
+    def test_gzipped_jsonl_export_of_a_user(self):
+        other = get_user_model().objects.create(username='other')
+        UserDog.objects.create(user=other, dog=self.test_dog5, status='l')
+        response = self.client.get('/api/export/decisions/', {
+            'output': 'jsonl', 'gzip': '1', 'user': other.pk})
+        self.assertIn('decisions-user-{}.jsonl.gz'.format(other.pk),
+                      response['Content-Disposition'])
+        lines = gzip.decompress(self.content(response)).splitlines()
+        self.assertEqual(
+            [json.loads(line.decode('utf-8'))['dog_id'] for line in lines],
+            [self.test_dog5.pk])
+
+    def test_rows_are_read_in_chunks(self):
+        rows = list(exports.decision_rows(chunk_size=3))
+        self.assertEqual([row[0] for row in rows], list(
+            UserDog.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_export_decisions_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'decisions.csv.gz')
+        call_command('export_decisions', '--gzip', '--output', path,
+                     stderr=StringIO())
+        with gzip.open(path, 'rt') as export:
+            self.assertEqual(len(export.read().splitlines()), 5)
+
+
+@override_settings(PUGORUGH_DOG_STATS=True)
+class DogStatsTests(BasicSetupForAPITests):
+    def stats_of(self, dog):
+        return stats.dog_stats(dog.pk)
+
+    def test_decisions_update_the_counters(self):
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog6.pk))
+        self.client.put('/api/dog/{}/disliked/'.format(self.test_dog6.pk))
+        self.stats_buffer.flush()
+        segment = stats.segment_for(self.test_user)
+        self.assertEqual(segment, 'b,y,a,s|m,f|s,m,l,xl')
+        self.assertEqual(self.stats_of(self.test_dog5), {
+            DogStats.ALL: {'likes': 1, 'dislikes': 0, 'like_rate': 1.0},
+            segment: {'likes': 1, 'dislikes': 0, 'like_rate': 1.0},
+        })
+        self.assertEqual(self.stats_of(self.test_dog6)[DogStats.ALL],
+                         {'likes': 0, 'dislikes': 1, 'like_rate': 0.0})
+
+    def test_deltas_are_applied_in_one_update_per_delta(self):
+        for dog in (self.test_dog5, self.test_dog6):
+            self.client.put('/api/dog/{}/liked/'.format(dog.pk))
+        self.stats_buffer.flush()
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog1.pk))
+        for dog in (self.test_dog5, self.test_dog6):
+            self.client.put('/api/dog/{}/undecided/'.format(dog.pk))
+        # Select the existing rows, create none, then one UPDATE per
+        # (segment, delta).
+        with self.assertNumQueries(5):
+            self.stats_buffer.flush()
+        self.assertEqual(self.stats_of(self.test_dog5)[DogStats.ALL]['likes'],
+                         0)
+
+    def test_failed_bulk_write_records_no_deltas(self):
+        with mock.patch.object(decisions, 'write_decisions',
+                               side_effect=IntegrityError), \
+                self.assertRaises(IntegrityError):
+            self.client.post('/api/dog/decisions/', [
+                {'dog': self.test_dog5.pk, 'status': 'l'}])
+        self.stats_buffer.flush()
+        self.assertEqual(self.stats_of(self.test_dog5), {})
+
+    def test_rebuild_matches_incremental_counts(self):
+        other = get_user_model().objects.create(username='other')
+        UserPref.objects.filter(user=other).update(gender='f', size='s')
+        # Undo the fixtures' decisions made without the API.
+        UserDog.objects.all().delete()
+        cache.clear()
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog1.pk))
+        self.client.put('/api/dog/{}/disliked/'.format(self.test_dog2.pk))
+        self.client.force_authenticate(other)
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog1.pk))
+        self.stats_buffer.flush()
+
+        def counts():
+            return sorted(DogStats.objects.filter(
+                Q(likes__gt=0) | Q(dislikes__gt=0)
+            ).values_list('dog_id', 'segment', 'likes', 'dislikes'))
+
+        incremental = counts()
+        self.assertIn((self.test_dog1.pk, DogStats.ALL, 2, 0), incremental)
+        self.assertIn((self.test_dog1.pk, 'b,y,a,s|f|s', 1, 0), incremental)
+        DogStats.objects.update(likes=7)
+        call_command('rebuild_dog_stats', '--chunk-size', '2',
+                     stdout=StringIO())
+        self.assertEqual(counts(), incremental)
+
+    def test_stats_endpoint_is_staff_only(self):
+        url = '/api/dog/{}/stats/'.format(self.test_dog1.pk)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.test_user.is_staff = True
+        self.test_user.save()
+        call_command('rebuild_dog_stats', stdout=StringIO())
+        response = self.client.get(url)
+        self.assertEqual(response.data['dog'], self.test_dog1.pk)
+        self.assertEqual(response.data['segments'][DogStats.ALL]['likes'], 1)
+        self.assertEqual(
+            self.client.get('/api/dog/999/stats/').status_code, 404)
+
+
+class UndecidedOrderingTests(BasicSetupForAPITests):
+    def next_id(self, pk, **params):
+        response = self.client.get(
+            '/api/dog/{}/undecided/next/'.format(pk), params)
+        return response.data['id']
+
+    def test_id_ordering_is_the_default(self):
+        self.assertEqual(self.next_id(-1), self.test_dog5.pk)
+        self.assertEqual(self.next_id(self.test_dog5.pk), self.test_dog6.pk)
+
+    def test_recent_ordering(self):
+        self.assertEqual(self.next_id(-1, order='recent'), self.test_dog6.pk)
+        self.assertEqual(self.next_id(self.test_dog6.pk, order='recent'),
+                         self.test_dog5.pk)
+        self.assertEqual(self.next_id(self.test_dog5.pk, order='recent'), -1)
+
+    @override_settings(PUGORUGH_UNDECIDED_ORDERING='recent')
+    def test_ordering_setting(self):
+        self.assertEqual(self.next_id(-1), self.test_dog6.pk)
+        self.assertEqual(self.next_id(-1, order='id'), self.test_dog5.pk)
+
+    def test_score_ordering(self):
+        # Equal scores: newest first.
+        self.assertEqual(self.next_id(-1, order='score'), self.test_dog6.pk)
+        Dog.objects.filter(pk=self.test_dog5.pk).update(score=0.9)
+        self.assertEqual(self.next_id(-1, order='score'), self.test_dog5.pk)
+        self.assertEqual(self.next_id(self.test_dog5.pk, order='score'),
+                         self.test_dog6.pk)
+        self.assertEqual(self.next_id(self.test_dog6.pk, order='score'), -1)
+
+    def test_mostly_decided_queue_takes_bounded_queries(self):
+        dogs = [Dog.objects.create(**dog5) for _ in range(40)]
+        for dog in dogs[1:]:
+            self.client.put('/api/dog/{}/disliked/'.format(dog.pk))
+        with mock.patch.object(queries, 'UNDECIDED_SCAN_SLACK', 0):
+            with self.assertNumQueries(2):
+                # One batch, then the rest with the decided dogs excluded.
+                self.assertEqual(self.next_id(-1, order='recent'),
+                                 dogs[0].pk)
+            self.assertEqual(self.next_id(dogs[0].pk, order='recent'),
+                             self.test_dog6.pk)
+
+    def test_score_ordered_pages(self):
+        dogs = [Dog.objects.create(**dog5) for _ in range(4)]
+        Dog.objects.filter(pk=dogs[1].pk).update(score=0.9)
+        Dog.objects.filter(pk=dogs[2].pk).update(score=0.1)
+        url = '/api/dog/{}/undecided/next/'
+        response = self.client.get(url.format(-1),
+                                   {'count': 3, 'order': 'score'})
+        self.assertEqual([dog['id'] for dog in response.data['results']],
+                         [dogs[1].pk, dogs[3].pk, dogs[0].pk])
+        response = self.client.get(url.format(response.data['next']),
+                                   {'count': 3, 'order': 'score'})
+        self.assertEqual([dog['id'] for dog in response.data['results']],
+                         [self.test_dog6.pk, self.test_dog5.pk, dogs[2].pk])
+        self.assertIsNone(response.data['next'])
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite plans')
+    def test_orderings_scan_an_index_range(self):
+        for ordering in ('id', 'recent', 'score'):
+            queryset = queries.undecided_candidates(
+                ['s', 'm'], ['m', 'f'], ['b', 'y'], ordering)
+            for position in (None, (0.5, self.test_dog5.pk)):
+                for part in queries.ranges_after(queryset, ordering,
+                                                 position):
+                    sql, params = queries.candidates_sql(part[:33])
+                    with connection.cursor() as cursor:
+                        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                        plan = ' '.join(str(row[-1])
+                                        for row in cursor.fetchall())
+                    self.assertNotIn('TEMP B-TREE', plan, ordering)
+                    self.assertNotIn('age_bucket', plan, ordering)
+
+    def test_unknown_ordering(self):
+        response = self.client.get('/api/dog/-1/undecided/next/',
+                                   {'order': 'name'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_dog_scores_command(self):
+        DogStats.objects.create(dog=self.test_dog5, segment=DogStats.ALL,
+                                likes=3, dislikes=1)
+        DogStats.objects.create(dog=self.test_dog6, segment=DogStats.ALL,
+                                likes=0, dislikes=2)
+        out = StringIO()
+        call_command('update_dog_scores', '--chunk-size', '2', stdout=out)
+        self.assertIn('6 dogs scored, 2 changed', out.getvalue())
+        self.assertEqual(Dog.objects.get(pk=self.test_dog5.pk).score,
+                         stats.score(3, 1))
+        self.assertEqual(Dog.objects.get(pk=self.test_dog1.pk).score, 0.5)
+        self.assertEqual(self.next_id(-1, order='score'), self.test_dog5.pk)
+
+    @mock.patch.object(stats, 'SCORE_UPDATE_BATCH', 2)
+    def test_scores_are_updated_in_batches(self):
+        for likes, dog in enumerate((self.test_dog1, self.test_dog2,
+                                     self.test_dog5)):
+            DogStats.objects.create(dog=dog, segment=DogStats.ALL,
+                                    likes=likes + 1, dislikes=0)
+        # Read the stats and the scores, then one UPDATE per two dogs in
+        # a savepoint.
+        with self.assertNumQueries(6):
+            self.assertEqual(stats.update_scores(
+                [self.test_dog1.pk, self.test_dog2.pk, self.test_dog5.pk]), 3)
+        self.assertEqual(
+            list(Dog.objects.filter(pk__in=[
+                self.test_dog1.pk, self.test_dog2.pk, self.test_dog5.pk,
+            ]).order_by('pk').values_list('score', flat=True)),
+            [stats.score(1, 0), stats.score(2, 0), stats.score(3, 0)])
+
+
+class SimilarDogsTests(BasicSetupForAPITests):
+    def similar_ids(self, dog, **params):
+        response = self.client.get(
+            '/api/dog/{}/similar/'.format(dog.pk), params)
+        return [card['id'] for card in response.data['results']]
+
+    def test_similar_dogs(self):
+        # Breed, size and age bucket first; ties go to the newest dog.
+        self.assertEqual(self.similar_ids(self.test_dog2), [
+            self.test_dog4.pk, self.test_dog3.pk, self.test_dog6.pk,
+            self.test_dog5.pk, self.test_dog1.pk])
+        self.assertEqual(self.similar_ids(self.test_dog2, count=2),
+                         [self.test_dog4.pk, self.test_dog3.pk])
+
+    def test_similar_dogs_follow_dog_changes(self):
+        self.similar_ids(self.test_dog2)
+        self.test_dog6.breed = 'Golden Retriever '
+        self.test_dog6.save()
+        self.assertEqual(self.similar_ids(self.test_dog2, count=2),
+                         [self.test_dog4.pk, self.test_dog6.pk])
+
+    def test_similar_errors(self):
+        url = '/api/dog/{}/similar/'
+        self.assertEqual(self.client.get(url.format(999)).status_code, 404)
+        response = self.client.get(url.format(self.test_dog1.pk),
+                                   {'count': 0})
+        self.assertEqual(response.status_code, 400)
+        with override_settings(PUGORUGH_SIMILARITY=False):
+            response = self.client.get(url.format(self.test_dog1.pk))
+        self.assertEqual(response.status_code, 404)
+
+    def test_recommended_ordering(self):
+        # Liked: a young labrador and an adult golden retriever.
+        golden = Dog.objects.create(**dog2)
+        url = '/api/dog/{}/undecided/next/'
+        response = self.client.get(url.format(-1),
+                                   {'count': 2, 'order': 'recommended'})
+        self.assertEqual([dog['id'] for dog in response.data['results']],
+                         [golden.pk, self.test_dog5.pk])
+        response = self.client.get(url.format(response.data['next']),
+                                   {'order': 'recommended'})
+        self.assertEqual(response.data['id'], self.test_dog6.pk)
+        response = self.client.get(url.format(self.test_dog6.pk),
+                                   {'order': 'recommended'})
+        self.assertEqual(response.data['id'], -1)
+
+    @override_settings(PUGORUGH_SIMILARITY=False)
+    def test_recommended_falls_back_to_score(self):
+        response = self.client.get('/api/dog/-1/undecided/next/',
+                                   {'order': 'recommended'})
+        self.assertEqual(response.data['id'], self.test_dog6.pk)
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_requires_a_shared_cache(self):
+        self.assertFalse(similarity.is_enabled())
+        response = self.client.get(
+            '/api/dog/{}/similar/'.format(self.test_dog1.pk))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/api/dog/-1/undecided/next/',
+                                   {'order': 'recommended'})
+        self.assertEqual(response.data['id'], self.test_dog6.pk)
+
+
+class LoadTestReportTests(TestCase):
+    timings = [('next', 0.001 * ms, 200) for ms in range(1, 101)] + [
+        ('liked', 0.004, 200), ('liked', 0.002, 500)]
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 95), 7)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_summarize(self):
+        report = loadtest.summarize(self.timings, 2.0)
+        self.assertEqual(report['requests'], 102)
+        self.assertEqual(report['errors'], 1)
+        self.assertEqual(report['rps'], 51.0)
+        self.assertAlmostEqual(report['endpoints']['next']['p95_ms'], 95)
+        self.assertEqual(report['endpoints']['liked']['errors'], 1)
+
+    def test_compare_with_baseline(self):
+        baseline = loadtest.summarize(self.timings, 2.0)
+        self.assertEqual(loadtest.compare(baseline, baseline), [])
+        slower = loadtest.summarize(
+            [(endpoint, seconds * 2, status)
+             for endpoint, seconds, status in self.timings], 4.0)
+        regressions = loadtest.compare(slower, baseline)
+        self.assertEqual(len(regressions), 3)
+        self.assertIn('throughput', regressions[0])
+
+
+class LoadTestSessionTests(LiveServerTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(stats, 'buffer', stats.DeltaBuffer(
+            stats.write_deltas, autostart=False))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        benchmarks.seed_dogs(200)
+
+    def test_sessions_go_through_every_endpoint(self):
+        report = loadtest.run(self.live_server_url, users=2, swipes=3,
+                              concurrency=1)
+        self.assertEqual(report['errors'], 0)
+        endpoints = report['endpoints']
+        self.assertEqual(endpoints['register']['requests'], 2)
+        self.assertEqual(endpoints['next']['requests'], 6)
+        self.assertEqual(endpoints['liked']['requests'] +
+                         endpoints['disliked']['requests'], 6)
+        self.assertEqual(UserDog.objects.count(), 6)
+
+
+class BenchmarkMeasureTests(BasicSetupForAPITests):
+    def test_counts_queries_past_the_debug_log(self):
+        _, per_call = benchmarks.measure(
+            lambda: [Dog.objects.exists() for _ in range(5000)], 2)
+        self.assertEqual(per_call, 5000)
+
+    def test_counts_queries_of_test_client_requests(self):
+        cache.clear()
+        client = benchmarks.api_client(self.test_user)
+        _, per_call = benchmarks.measure(
+            lambda: client.put('/api/dog/{}/liked/'.format(
+                self.test_dog5.pk)), 3)
+        # The upsert; the token and the bitmaps are cached after the first.
+        self.assertEqual(per_call, 1)
+
+
+class QueryBudgetTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        budgets.registry.clear()
+        self.addCleanup(budgets.registry.clear)
+
+    def over_budget(self):
+        return mock.patch.object(
+            GetFilteredDog, 'query_budget', budgets.Budget(1, None))
+
+    def test_breach_raises_in_strict_mode(self):
+        with self.over_budget(), self.assertLogs('pugorugh.budgets'):
+            with self.assertRaises(budgets.QueryBudgetExceeded):
+                self.client.get('/api/dog/-1/undecided/next/')
+
+    @override_settings(PUGORUGH_QUERY_BUDGET_STRICT=False)
+    def test_breach_is_counted_and_logged(self):
+        with self.over_budget(), self.assertLogs(
+                'pugorugh.budgets', 'WARNING'):
+            response = self.client.get('/api/dog/-1/undecided/next/')
+        self.assertEqual(response.status_code, 200)
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+
+        report = budgets.registry.report()
+        self.assertEqual([view['view'] for view in report],
+                         ['GetFilteredDog', 'DogViewSet.liked'])
+        self.assertEqual(report[0]['breaches'], 1)
+        self.assertEqual(report[0]['budget'], {'queries': 1, 'sql_ms': None})
+        self.assertTrue(report[0]['worst_sql'])
+        self.assertEqual(report[1]['breaches'], 0)
+        self.assertEqual(report[1]['worst_sql'], [])
+
+    def test_actions_have_their_own_budget(self):
+        view = DogViewSet()
+        view.action = 'retrieve'
+        self.assertEqual(view.budget().queries, 3)
+        self.assertEqual(view.budget_name(), 'DogViewSet.retrieve')
+        view.action = 'create'
+        self.assertEqual(view.budget().queries, 6)
+
+    def test_normalize(self):
+        self.assertEqual(
+            budgets.normalize(
+                "SELECT * FROM dog WHERE id IN (1, 2, 3) AND name = 'Bo''s' "
+                "AND score > 0.5"),
+            'SELECT * FROM dog WHERE id IN (...) AND name = ? AND score > ?')
+
+    def test_report_is_staff_only(self):
+        url = '/api/stats/query-budgets/'
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.test_user.is_staff = True
+        self.test_user.save()
+        self.client.get('/api/user/isstaff/')
+        response = self.client.get(url)
+        self.assertTrue(response.data['strict'])
+        self.assertIn('IsStaff',
+                      [view['view'] for view in response.data['views']])
+
+
+@override_settings(PUGORUGH_PROFILING=True,
+                   PUGORUGH_PROFILING_SAMPLE_RATE=1.0)
+class ProfilingTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        profiling.registry.clear()
+        self.addCleanup(profiling.registry.clear)
+
+    def routes(self):
+        return {route['route']: route
+                for route in profiling.registry.report()}
+
+    def test_requests_are_profiled_per_url_name(self):
+        self.client.get('/api/dog/-1/undecided/next/')
+        self.client.get('/api/dog/-1/undecided/next/')
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        routes = self.routes()
+        self.assertEqual(set(routes), {'filtered-dog-detail', 'api:dog-liked'})
+        route = routes['filtered-dog-detail']
+        self.assertEqual(route['wall_ms']['count'], 2)
+        self.assertGreater(route['queries']['max'], 0)
+        self.assertGreater(route['serializer_ms']['max'], 0)
+        self.assertGreater(route['response_bytes']['p50'], 0)
+
+    @override_settings(PUGORUGH_PROFILING_SAMPLE_RATE=0.0)
+    def test_unsampled_requests_are_not_recorded(self):
+        self.client.get('/api/dog/-1/undecided/next/')
+        self.assertEqual(self.routes(), {})
+
+    @override_settings(PUGORUGH_PROFILING=False)
+    def test_disabled(self):
+        self.client.get('/api/dog/-1/undecided/next/')
+        self.assertEqual(self.routes(), {})
+
+    def test_histogram(self):
+        histogram = profiling.Histogram((1, 2, 5, 10))
+        for value in (0.5, 1.5, 1.5, 3, 4, 7, 30):
+            histogram.add(value)
+        self.assertEqual(histogram.buckets, [1, 2, 2, 1, 1])
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(99), 30)
+        self.assertIsNone(profiling.Histogram((1,)).percentile(50))
+
+    def test_report_is_staff_only(self):
+        url = '/api/stats/profiling/'
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.test_user.is_staff = True
+        self.test_user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data['sample_rate'], 1.0)
+        self.assertIn('profiling-report',
+                      [route['route'] for route in response.data['routes']])
+
+
+
+class MetricsTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        metrics.store.clear()
+        self.addCleanup(metrics.store.clear)
+
+    def test_swipe_path_is_counted(self):
+        self.client.force_authenticate(user=self.test_user)
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.client.get('/api/dog/-1/undecided/next/')
+        text = self.client.get('/metrics').content.decode('utf-8')
+        self.assertIn('pugorugh_decisions_total{status="l"} 1\n', text)
+        self.assertIn('pugorugh_request_duration_seconds_count{'
+                      'view="api:dog-liked",method="PUT",status="200"} 1\n',
+                      text)
+        self.assertIn(
+            'pugorugh_db_queries_count{view="filtered-dog-detail"} 1\n',
+            text)
+        self.assertIn('pugorugh_cache_requests_total{cache="bitmaps",'
+                      'result="hit"}', text)
+
+    def test_registration_and_import_are_counted(self):
+        self.client.post('/api/user/', {'username': 'new_user',
+                                        'password': 'secret'})
+        importers.DogImporter().run([
+            {'name': 'Ace', 'image_filename': 'ace.jpg', 'breed': 'Pug',
+             'age': 5, 'gender': 'm', 'size': 's'},
+            {'name': 'Bad', 'age': 'old'}])
+        text = metrics.render()
+        self.assertIn('pugorugh_registrations_total 1\n', text)
+        self.assertIn('pugorugh_import_rows_total{result="created"} 1\n',
+                      text)
+        self.assertIn('pugorugh_import_rows_total{result="invalid"} 1\n',
+                      text)
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('view',),
+                                      (0.1, 1))
+        self.addCleanup(metrics.METRICS.pop, 'test_seconds')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, view='a"b')
+        text = metrics.render()
+        self.assertIn('# TYPE test_seconds histogram\n'
+                      'test_seconds_bucket{view="a\\"b",le="0.1"} 1\n'
+                      'test_seconds_bucket{view="a\\"b",le="1"} 2\n'
+                      'test_seconds_bucket{view="a\\"b",le="+Inf"} 3\n'
+                      'test_seconds_sum{view="a\\"b"} 5.55\n'
+                      'test_seconds_count{view="a\\"b"} 3\n', text)
+
+    def test_processes_are_summed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.DECISIONS.inc(status='l')
+        with open(os.path.join(directory, 'pugorugh-1-other.json'),
+                  'w') as other:
+            json.dump({'counters': [['pugorugh_decisions_total', ['l'], 2]],
+                       'histograms': []}, other)
+        with override_settings(PUGORUGH_METRICS_DIR=directory):
+            metrics.store.dump()
+            self.assertIn('pugorugh_decisions_total{status="l"} 3\n',
+                          metrics.render())
+
+    def test_queries_of_views_without_a_budget(self):
+        self.client.get('/metrics')
+        self.assertIn('pugorugh_db_queries_count{view="metrics"}',
+                      metrics.render())
+
+    def test_forked_worker_writes_its_own_file(self):
+        metrics.DECISIONS.inc(status='l')
+        filename = metrics.store.filename
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertNotEqual(metrics.store.filename, filename)
+            self.assertNotIn('pugorugh_decisions_total{status="l"}',
+                             metrics.render())
+
+    @override_settings(PUGORUGH_METRICS=False)
+    def test_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+
+@override_settings(PUGORUGH_REPLICA_DATABASES=['replica'])
+class ReplicaRoutingTests(BasicSetupForAPITests):
+    """A second SQLite file stands in for the replica."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(directory, 'replica.sqlite3'),
+        }
+        self.addCleanup(connections.__delitem__, 'replica')
+        self.addCleanup(connections.databases.pop, 'replica')
+        self.addCleanup(connections['replica'].close)
+        call_command('migrate', database='replica', verbosity=0)
+        # The replica has not caught up with a rename yet.
+        dog = Dog.objects.get(pk=self.test_dog1.pk)
+        dog.name = 'Lagging'
+        dog.save(using='replica', force_insert=True)
+        self.url = '/api/dog/{}/'.format(self.test_dog1.pk)
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.client.get(self.url).data['name'], 'Lagging')
+        self.assertIsNone(routers.current())
+
+    def test_reads_stick_to_the_primary_after_a_write(self):
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.assertEqual(self.client.get(self.url).data['name'],
+                         self.test_dog1.name)
+
+    @override_settings(PUGORUGH_REPLICA_STICKY_SECONDS=0)
+    def test_stickiness_expires(self):
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.assertEqual(self.client.get(self.url).data['name'], 'Lagging')
+
+    def test_budgets_count_replica_queries(self):
+        budgets.registry.clear()
+        self.addCleanup(budgets.registry.clear)
+        with CaptureQueriesContext(connection) as primary:
+            self.client.get(self.url)
+        report = {view['view']: view for view in budgets.registry.report()}
+        # The dog is read from the replica.
+        self.assertEqual(report['DogViewSet.retrieve']['max_queries'],
+                         len(primary) + 1)
+
+    @override_settings(PUGORUGH_PROFILING=True,
+                       PUGORUGH_PROFILING_SAMPLE_RATE=1.0)
+    def test_profiles_count_replica_queries(self):
+        profiling.registry.clear()
+        self.addCleanup(profiling.registry.clear)
+        with CaptureQueriesContext(connection) as primary:
+            self.client.get(self.url)
+        [route] = profiling.registry.report()
+        self.assertEqual(route['queries']['max'], len(primary) + 1)
+
+    def test_writes_go_to_the_primary(self):
+        routers.begin_replica_reads()
+        self.addCleanup(routers.end_replica_reads)
+        dog = Dog.objects.get(pk=self.test_dog1.pk)
+        self.assertEqual(dog.name, 'Lagging')
+        dog.name = 'Renamed'
+        dog.save()
+        routers.end_replica_reads()
+        self.assertEqual(Dog.objects.get(pk=dog.pk).name, 'Renamed')
+        self.assertEqual(
+            Dog.objects.using('replica').get(pk=dog.pk).name, 'Lagging')
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_replicas_require_a_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.get(self.url)
+        self.assertIn('pugorugh.E001', [
+            error.id for error in checks.check_shared_cache(None)])
+
+    @override_settings(PUGORUGH_REPLICA_DATABASES=[])
+    def test_without_replicas_reads_go_to_the_primary(self):
+        self.assertEqual(self.client.get(self.url).data['name'],
+                         self.test_dog1.name)
+
+
+class ConditionalGetTests(BasicSetupForAPITests):
+    def test_dog_not_modified_without_query(self):
+        url = '/api/dog/{}/'.format(self.test_dog1.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_dog_is_sent_again(self):
+        url = '/api/dog/{}/'.format(self.test_dog1.pk)
+        etag = self.client.get(url)['ETag']
+        self.test_dog1.name = 'Bud'
+        self.test_dog1.save(update_fields=['name'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'Bud')
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_dog_versions_read_from_the_db_without_a_shared_cache(self):
+        url = '/api/dog/{}/'.format(self.test_dog1.pk)
+        etag = self.client.get(url)['ETag']
+        # Changed through another worker process.
+        Dog.objects.filter(pk=self.test_dog1.pk).update(
+            name='Bud', updated_at=timezone.now())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['name'], 'Bud')
+
+    def test_missing_dog(self):
+        response = self.client.get('/api/dog/9999/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+    def test_preferences_not_modified(self):
+        etag = self.client.get('/api/user/preferences/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/api/user/preferences/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.put(
+            '/api/user/preferences/',
+            {'age': 'b', 'gender': 'f', 'size': 'xl'},
+            HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+            '/api/user/preferences/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['age'], 'b')
+
+    def test_next_dog_not_modified(self):
+        url = '/api/dog/-1/undecided/next/'
+        response = self.client.get(url)
+        self.assertNotIn('Last-Modified', response)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        etag = self.client.get(url + '?count=2')['ETag']
+        response = self.client.get(url + '?count=2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.client.post('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        response = self.client.get(url + '?count=2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
 class AccountViewsTests(BasicSetupForAPITests):
     def test_user_good_registration(self):
         response = self.client.post(
@@ -392,7 +1512,8 @@ class DogSerializerTest(TestCase):
     def test_contains_expected_fields(self):
         data = self.serializer.data
         self.assertCountEqual(data.keys(), ['id', 'name', 'image_filename',
-            'breed', 'age', 'gender', 'size'])
+            'image_variants', 'image_width', 'image_height', 'dominant_color',
+            'placeholder', 'breed', 'age', 'gender', 'size'])
 
     def test_name_field_content(self):
         data = self.serializer.data
@@ -493,6 +1614,294 @@ class DogModelTests(TestCase):
         self.assertEqual(dog.name, 'Buddy')
         self.assertEqual(dog.age, 23)
 
+    def test_age_bucket_follows_age(self):
+        dog = Dog.objects.create(name='Buddy', age=5)
+        self.assertEqual(dog.age_bucket, 'b')
+        dog.age = 80
+        dog.save(update_fields=['age'])
+        self.assertEqual(Dog.objects.get(pk=dog.pk).age_bucket, 's')
+        dog.age = 250
+        dog.save()
+        self.assertEqual(Dog.objects.get(pk=dog.pk).age_bucket, '')
+
+
+class DogCatalogTests(BasicSetupForAPITests):
+    def setUp(self):
+        super().setUp()
+        self.catalog = catalog.get_catalog()
+
+    def test_match_after_filters_on_preferences(self):
+        self.assertEqual(
+            self.catalog.match_after(-1, 10, ['b'], ['m', 's'], ['m']),
+            [self.test_dog1.pk, self.test_dog5.pk]
+        )
+        self.assertEqual(
+            self.catalog.match_after(
+                self.test_dog1.pk, 10, ['b'], ['m', 's'], ['m']),
+            [self.test_dog5.pk]
+        )
+
+    def test_match_after_skips_decided_dogs(self):
+        decided = bytearray()
+        decisions.set_bit(decided, self.test_dog1.pk)
+        self.assertEqual(
+            self.catalog.match_after(-1, 10, ['b'], ['m', 's'], ['m'], decided),
+            [self.test_dog5.pk]
+        )
+        decisions.set_bit(decided, self.test_dog5.pk)
+        self.assertFalse(
+            self.catalog.has_match(['b'], ['m', 's'], ['m'], decided))
+
+    def test_follows_dog_changes(self):
+        self.catalog.columns()
+        self.test_dog6.age = 5
+        self.test_dog6.save()
+        new_dog = Dog.objects.create(**dog1)
+        Dog.objects.get(pk=self.test_dog1.pk).delete()
+        self.assertEqual(
+            self.catalog.match_after(-1, 10, ['b'], ['s', 'm', 'l'], ['m']),
+            [self.test_dog5.pk, self.test_dog6.pk, new_dog.pk]
+        )
+        new_dog.delete()
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_requires_a_shared_cache(self):
+        self.assertFalse(catalog.is_enabled())
+        self.assertEqual([error.id for error in checks.check_shared_cache(
+            None)], ['pugorugh.W002', 'pugorugh.W001', 'pugorugh.W003'])
+        with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                'LOCATION': 'pugorugh_cache'}}):
+            self.assertTrue(catalog.is_enabled())
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class DogImporterTests(TestCase):
+    feed = (
+        '[{"name": "Ace", "image_filename": "ace.jpg", "breed": "Pug", '
+        '"age": 5, "gender": "m", "size": "s"}, '
+        '{"name": "Bo", "image_filename": "bo.jpg", "breed": "Boxer", '
+        '"age": 40, "gender": "f", "size": "l"}, '
+        '{"name": "Bad", "age": "old"}]'
+    )
+
+    def test_iter_json_array_reads_in_chunks(self):
+        rows = list(importers.iter_json_array(StringIO(self.feed), 7))
+        self.assertEqual([row['name'] for row in rows], ['Ace', 'Bo', 'Bad'])
+
+    def test_import_is_idempotent(self):
+        importer = importers.DogImporter(batch_size=2).run(
+            importers.iter_json_array(StringIO(self.feed)))
+        self.assertEqual((importer.created, importer.updated), (2, 0))
+        self.assertEqual(len(importer.errors), 1)
+        self.assertEqual(Dog.objects.get(name='Bo').age_bucket, 'a')
+
+        importer = importers.DogImporter(batch_size=2).run(
+            importers.iter_json_array(StringIO(self.feed)))
+        self.assertEqual((importer.created, importer.unchanged), (0, 2))
+        self.assertEqual(Dog.objects.count(), 2)
+
+    def test_import_updates_on_natural_key(self):
+        importers.DogImporter().run(importers.iter_json_array(
+            StringIO(self.feed)))
+        importer = importers.DogImporter().run(importers.iter_csv(StringIO(
+            'name,image_filename,breed,age,gender,size\n'
+            'Ace,ace.jpg,Pug,80,m,s\n'
+            'Cy,cy.jpg,Corgi,12,f,m\n'
+        )))
+        self.assertEqual((importer.created, importer.updated), (1, 1))
+        ace = Dog.objects.get(image_filename='ace.jpg')
+        self.assertEqual((ace.age, ace.age_bucket), (80, 's'))
+
+    def test_rows_without_a_natural_key_are_rejected(self):
+        importer = importers.DogImporter(('name', 'breed')).run([
+            {'name': 'Ace', 'breed': 'Pug', 'age': 5, 'gender': 'm',
+             'size': 's'},
+            {'name': 'Bo', 'age': 40, 'gender': 'f', 'size': 'l'},
+            {'name': 'Cy', 'age': 12, 'gender': 'f', 'size': 'm'},
+        ])
+        self.assertEqual(importer.created, 1)
+        self.assertEqual([(line, list(errors))
+                          for line, errors in importer.errors],
+                         [(2, ['breed']), (3, ['breed'])])
+
+    def test_duplicate_keys_in_a_chunk_are_skipped(self):
+        importer = importers.DogImporter().run(importers.iter_csv(StringIO(
+            'name,image_filename,breed,age,gender,size\n'
+            'Ace,ace.jpg,Pug,5,m,s\n'
+            'Ace,ace.jpg,Pug,80,m,s\n'
+            'Bo,bo.jpg,Boxer,40,f,l\n'
+        )))
+        self.assertEqual((importer.read, importer.created, importer.skipped),
+                         (3, 2, 1))
+        self.assertEqual(Dog.objects.get(image_filename='ace.jpg').age, 80)
+
+    def test_import_dogs_command(self):
+        path = os.path.join(settings.BASE_DIR, 'pugorugh', 'static',
+                            'dog_details.json')
+        out = StringIO()
+        call_command('import_dogs', path, stdout=out)
+        count = Dog.objects.count()
+        self.assertGreater(count, 0)
+        call_command('import_dogs', path, '--batch-size', '3', stdout=out)
+        self.assertEqual(Dog.objects.count(), count)
+        self.assertIn('0 created', out.getvalue())
+
+
+@unittest.skipUnless(images.is_enabled(), 'Pillow is not installed')
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        source_dir = os.path.join(self.directory, 'dogs')
+        os.mkdir(source_dir)
+        images.Image.new('RGB', (1200, 900), 'brown').save(
+            os.path.join(source_dir, 'buddy.png'))
+        settings_override = override_settings(
+            PUGORUGH_IMAGE_SOURCE_DIR=source_dir,
+            PUGORUGH_IMAGE_VARIANT_DIR=os.path.join(source_dir, 'variants'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.dog = Dog.objects.create(**dog1)
+
+    def build(self, *args):
+        out = StringIO()
+        call_command('build_image_variants', '--workers', '1', *args,
+                     stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_renders_resized_variants(self):
+        self.assertIn('1 photos rendered', self.build())
+        variants = images.read_manifest()['buddy.png']['variants']
+        self.assertEqual(set(variants), set(images.VARIANTS))
+        card = images.Image.open(os.path.join(
+            images.variant_dir(), variants['card']['webp']))
+        self.assertEqual(card.size, (480, 360))
+
+        data = DogSerializer(self.dog).data
+        self.assertTrue(data['image_variants']['card']['jpeg'].endswith(
+            variants['card']['jpeg']))
+
+    def test_skips_truncated_photos(self):
+        path = os.path.join(images.source_dir(), 'broken.jpg')
+        images.Image.new('RGB', (1200, 900), 'white').save(path, 'JPEG')
+        with open(path, 'r+b') as photo:
+            photo.truncate(os.path.getsize(path) // 2)
+        Dog.objects.create(**dict(dog2, image_filename='broken.jpg'))
+
+        out, err = StringIO(), StringIO()
+        call_command('build_image_variants', '--workers', '1',
+                     stdout=out, stderr=err)
+        self.assertIn('1 photos rendered, 0 unchanged, 1 unreadable',
+                      out.getvalue())
+        self.assertIn('Unreadable photo: broken.jpg', err.getvalue())
+        self.assertEqual(list(images.read_manifest()), ['buddy.png'])
+        self.assertIsNone(
+            Dog.objects.get(image_filename='broken.jpg').image_width)
+
+    def test_stores_photo_details(self):
+        self.build()
+        dog = Dog.objects.get(pk=self.dog.pk)
+        self.assertEqual((dog.image_width, dog.image_height), (1200, 900))
+        self.assertEqual(dog.dominant_color, '#a52a2a')
+        self.assertTrue(dog.placeholder.startswith('data:image/jpeg;base64,'))
+
+    def test_backfill_image_details(self):
+        out = StringIO()
+        call_command('backfill_image_details', '--workers', '1', stdout=out)
+        self.assertIn('1 dogs updated', out.getvalue())
+        self.assertEqual(Dog.objects.get(pk=self.dog.pk).image_width, 1200)
+        call_command('backfill_image_details', '--workers', '1', stdout=out)
+        self.assertIn('0 dogs updated from 0 photos', out.getvalue())
+
+    def test_importer_computes_photo_details(self):
+        Dog.objects.all().delete()
+        importers.DogImporter().run([dog1, dog2])
+        self.assertEqual(
+            Dog.objects.get(image_filename='buddy.png').image_width, 1200)
+        # No photo in the source directory.
+        self.assertIsNone(
+            Dog.objects.get(image_filename='shadow.png').image_width)
+
+    def test_incremental_run_skips_unchanged_photos(self):
+        self.build()
+        self.assertIn('0 photos rendered, 1 unchanged', self.build())
+        self.assertIn('1 photos rendered', self.build('--force'))
+
+    def test_changed_photo_gets_new_names(self):
+        self.build()
+        before = images.read_manifest()['buddy.png']['variants']
+        path = os.path.join(images.source_dir(), 'buddy.png')
+        images.Image.new('RGB', (300, 300), 'white').save(path, 'PNG')
+        self.assertIn('1 photos rendered', self.build('--prune'))
+        after = images.read_manifest()['buddy.png']['variants']
+        self.assertNotEqual(before['card']['webp'], after['card']['webp'])
+        self.assertCountEqual(
+            os.listdir(images.variant_dir()),
+            [images.MANIFEST_NAME] + [name for formats in after.values()
+                                      for name in formats.values()])
+
+
+class DecisionBitmapsTests(BasicSetupForAPITests):
+    def test_built_from_user_dogs(self):
+        bitmaps = decisions.get_bitmaps(self.test_user)
+        self.assertEqual(
+            decisions.ids_after(bitmaps.liked, -1, 10),
+            [self.test_dog1.pk, self.test_dog2.pk]
+        )
+        self.assertEqual(
+            decisions.ids_after(bitmaps.disliked, self.test_dog3.pk, 10),
+            [self.test_dog4.pk]
+        )
+        self.assertFalse(bitmaps.is_decided(self.test_dog5.pk))
+
+    def test_cached_bitmaps_follow_decisions(self):
+        decisions.get_bitmaps(self.test_user)
+        self.client.put('/api/dog/{}/liked/'.format(self.test_dog5.pk))
+        self.client.put('/api/dog/{}/disliked/'.format(self.test_dog1.pk))
+        with self.assertNumQueries(0):
+            bitmaps = decisions.get_bitmaps(self.test_user)
+        self.assertEqual(
+            decisions.ids_after(bitmaps.liked, -1, 10),
+            [self.test_dog2.pk, self.test_dog5.pk]
+        )
+        self.assertTrue(bitmaps.is_decided(self.test_dog1.pk))
+        self.assertFalse(decisions.test_bit(bitmaps.liked, self.test_dog1.pk))
+
+    @override_settings(PUGORUGH_SINGLE_PROCESS=False)
+    def test_read_from_the_db_without_a_shared_cache(self):
+        decisions.get_bitmaps(self.test_user)
+        # A decision recorded by another worker process.
+        UserDog.objects.create(user=self.test_user, dog=self.test_dog5,
+                               status='l')
+        bitmaps = decisions.get_bitmaps(self.test_user)
+        self.assertTrue(decisions.test_bit(bitmaps.liked, self.test_dog5.pk))
+
+    def test_racing_updates_do_not_lose_decisions(self):
+        decisions.get_bitmaps(self.test_user)
+        key = decisions.cache_key(self.test_user.pk)
+        # Two decisions read the entry before either writes it back.
+        first = cache.get(key)
+        decisions.write_decision(self.test_user.pk, self.test_dog5.pk, 'l')
+        decisions.bump_version(self.test_user.pk)
+        decisions.write_decision(self.test_user.pk, self.test_dog6.pk, 'd')
+        decisions.update_bitmaps(self.test_user, [(self.test_dog6.pk, 'd')])
+        version, bitmaps = first
+        bitmaps.set(self.test_dog5.pk, 'l')
+        cache.set(key, (version + 1, bitmaps))
+
+        bitmaps = decisions.get_bitmaps(self.test_user)
+        self.assertTrue(decisions.test_bit(bitmaps.liked, self.test_dog5.pk))
+        self.assertTrue(
+            decisions.test_bit(bitmaps.disliked, self.test_dog6.pk))
+
+    def test_next_liked_dog_skips_user_dog_join(self):
+        decisions.get_bitmaps(self.test_user)
+        with self.assertNumQueries(2):
+            # Token authentication plus the dog itself.
+            response = self.client.get('/api/dog/-1/liked/next/')
+        self.assertEqual(response.data['id'], self.test_dog1.pk)
+
 
 class UserDogModelTests(TestCase):
     def setUp(self):
@@ -522,6 +1931,21 @@ class UserDogModelTests(TestCase):
         self.assertEqual(user_dog.dog.breed, 'labrador')
 
 
+class UserDogConstraintTests(BasicSetupForAPITests):
+    def test_user_dog_is_unique(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserDog.objects.create(
+                user=self.test_user, dog=self.test_dog1, status='d')
+
+    def test_explain_queries(self):
+        out = StringIO()
+        call_command('explain_queries', user_id=self.test_user.pk,
+                     stdout=out)
+        output = out.getvalue()
+        self.assertIn('liked dogs', output)
+        self.assertIn('decision lookup', output)
+
+
 class UserPrefModelTests(TestCase):
     def setUp(self):
         self.test_user = get_user_model().objects.create(
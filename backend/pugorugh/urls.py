@@ -5,7 +5,10 @@ from django.views.generic.base import RedirectView
 from rest_framework.urlpatterns import format_suffix_patterns
 from rest_framework.authtoken.views import obtain_auth_token
 
-from pugorugh.views import UserRegisterView, GetFilteredDog, IsStaff
+from pugorugh.views import (UserRegisterView, GetFilteredDog, IsStaff,
+                            WriteBehindStats, QueryBudgetReport,
+                            ProfilingReport, DecisionExport,
+                            prometheus_metrics)
 
 # API endpoints
 urlpatterns = format_suffix_patterns([
@@ -24,4 +27,17 @@ urlpatterns = format_suffix_patterns([
         GetFilteredDog.as_view(),
         name='filtered-dog-detail'),
     url(r'^api/user/isstaff/$', IsStaff.as_view(), name='user-is-staff'),
+    url(r'^api/stats/write-behind/$', WriteBehindStats.as_view(),
+        name='write-behind-stats'),
+    url(r'^api/stats/query-budgets/$', QueryBudgetReport.as_view(),
+        name='query-budget-report'),
+    url(r'^api/stats/profiling/$', ProfilingReport.as_view(),
+        name='profiling-report'),
+    url(r'^api/export/decisions/$', DecisionExport.as_view(),
+        name='export-decisions'),
 ])
+
+# Prometheus scrape target, a plain Django view without format suffixes.
+urlpatterns += [
+    url(r'^metrics$', prometheus_metrics, name='metrics'),
+]
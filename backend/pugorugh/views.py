@@ -1,206 +1,456 @@
-from bisect import bisect
-
 from django.contrib.auth import get_user_model
-from django.shortcuts import Http404, get_object_or_404
-from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import Http404
 
 from rest_framework import permissions
 from rest_framework import mixins
 from rest_framework import viewsets
 from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import (CreateAPIView, RetrieveAPIView,
                                      UpdateAPIView)
 from rest_framework.response import Response
-
+from rest_framework.views import APIView
+
+from . import budgets
+from . import cards
+from . import conditional
+from . import decisions
+from . import exports
+from . import metrics
 from . import serializers
 from . import models
+from . import profiling
+from . import queries
+from . import routers
+from . import similarity
+from . import stats
 
-def classify_dog_age(age_prefs):
-    age_filter = {}
-    for age_pref in age_prefs.split(','):
-        if age_pref == 'b':
-            age_filter['b'] = range(0, 12)
-        elif age_pref == 'y':
-            age_filter['y'] = range(12, 24)
-        elif age_pref == 'a':
-            age_filter['a'] = range(24, 72)
-        elif age_pref == 's':
-            age_filter['s'] = range(72, 200)
-    return age_filter
-
-def create_dog_age_list(age_ranges):
-    age_range_list = []
-    for age_range in age_ranges.values():
-        for x in age_range:
-            age_range_list.append(x)
-    return age_range_list
-
-class UserRegisterView(CreateAPIView):
+class UserRegisterView(budgets.QueryBudgetMixin, CreateAPIView):
     permission_classes = (permissions.AllowAny,)
+    query_budget = budgets.Budget(queries=10, sql_ms=100)
     model = get_user_model()
     serializer_class = serializers.UserSerializer
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        metrics.REGISTRATIONS.inc()
+
 
-class GetFilteredDog(RetrieveAPIView):
+class GetFilteredDog(budgets.QueryBudgetMixin, routers.ReplicaReadMixin,
+                     RetrieveAPIView):
     '''
     View to get the next dog based on the user filter choice (undecided, liked
      or disliked).
 
-    Only those undecided dogs that match user preferences are shown.
+    Only those undecided dogs that match user preferences are shown, in the
+    order given by `?order=` (id, recent, score or recommended), which
+    defaults to the
+    PUGORUGH_UNDECIDED_ORDERING setting.
     '''
     permission_classes = (permissions.IsAuthenticated,)
+    # Token, preferences, bitmaps, keyset position and a batch of dogs.
+    query_budget = budgets.Budget(queries=6, sql_ms=50)
     queryset = models.Dog.objects.all()
     serializer_class = serializers.DogSerializer
+    max_page_size = 50
 
     def get_object(self):
         user = self.request.user
         pk = int(self.kwargs.get('pk'))
         dog_filter = self.kwargs.get('dog_filter')
 
-        if dog_filter == 'undecided':
-            # Get size, gender and age of dogs the current user prefers.
-            (size, gender, age) = models.UserPref.objects.filter(
-                user=user
-            ).values_list('size', 'gender', 'age')[0]
-
-            # Convert the preferred age into the age query.
-            age_ranges = classify_dog_age(age)
-            age_query = create_dog_age_list(age_ranges)
-
-            # Get the ids of all dogs liked and disliked by the current user.
-            decided_dog_ids = models.Dog.objects.filter(
-                userdog__user=user
-            ).values_list('id', flat=True)
-
-            # Get a list of ordered ids of all undecided dogs, which suit the
-            # current user.
-            filtered_dogs_ids = models.Dog.objects.exclude(
-                id__in=decided_dog_ids
-            ).filter(
-                age__in=age_query,
-                size__in=size.split(','),
-                gender__in=gender.split(',')
-            ).order_by('id').values_list('id', flat=True)
-
-        elif dog_filter == 'liked':
-            # Get ids of all dogs liked by the current user
-            filtered_dogs_ids = models.Dog.objects.filter(
-                userdog__user=user,
-                userdog__status='l'
-            ).order_by('id').values_list('id', flat=True)
+        return queries.next_dog(user, dog_filter, pk,
+                                self.undecided_ordering())
 
-        else:
-            # Get ids of all dogs disliked by the current user
-            filtered_dogs_ids = models.Dog.objects.filter(
-                userdog__user=user,
-                userdog__status='d'
-            ).order_by('id').values_list('id', flat=True)
-
-        # If there are filtered dogs
-        if filtered_dogs_ids:
-            # If pk is equal or greater than the highest filtered dog id
-            if pk >= filtered_dogs_ids[len(filtered_dogs_ids) - 1]:
-                # Send an imaginary Dog with the id of -1
-                return models.Dog(
-                    name=None,
-                    image_filename=None,
-                    breed=None,
-                    age=None,
-                    gender=None,
-                    size=None,
-                    id=-1
-                )
-            else:
-                # Get the id of the next dog
-                index = bisect(filtered_dogs_ids, pk)
-                dog_id = filtered_dogs_ids[index]
+    def undecided_ordering(self):
+        ordering = self.request.query_params.get(
+            'order', queries.undecided_ordering())
+        if ordering not in queries.UNDECIDED_ORDERINGS:
+            raise ValidationError({'order': 'Must be one of {}.'.format(
+                ', '.join(queries.UNDECIDED_ORDERINGS))})
+        return ordering
 
-            return get_object_or_404(self.get_queryset(), pk=dog_id)
+    def retrieve(self, request, *args, **kwargs):
+        count = request.query_params.get('count')
+        if count is not None:
+            return self.retrieve_page(request, count)
+        if self.kwargs.get('dog_filter') != 'undecided':
+            return self.retrieve_decided(request)
 
+        dog = self.get_object()
+        if dog.updated_at is None:
+            # The unsaved end of list dog.
+            return Response(self.get_serializer(dog).data)
+        # No Last-Modified: the next dog may be older than the previous one.
+        return conditional.conditional_response(
+            request,
+            conditional.make_etag(
+                'dog', dog.pk, conditional.timestamp(dog.updated_at)),
+            None,
+            lambda: Response(self.get_serializer(dog).data)
+        )
+
+    def retrieve_decided(self, request):
+        '''
+        Return the next liked or disliked dog from the cached id list and
+        dog cards, which a warm cache serves without any query.
+        '''
+        found, has_match = queries.next_decided(
+            request.user,
+            self.kwargs.get('dog_filter'),
+            int(self.kwargs.get('pk')),
+            1
+        )
+        if not found:
+            if not has_match:
+                raise Http404
+            return Response(self.get_serializer(
+                queries.end_of_list_dog()).data)
+
+        def render():
+            dog_cards = cards.dog_cards(found)
+            if not dog_cards:
+                # Deleted since its version was read.
+                raise Http404
+            return Response(dog_cards[0])
+
+        dog_id, updated_at = found[0]
+        return conditional.conditional_response(
+            request,
+            conditional.make_etag(
+                'dog', dog_id, conditional.timestamp(updated_at)),
+            None,
+            render
+        )
+
+    # /api/dog/<pk>/<dog_filter>/next/?count=<n>
+    def retrieve_page(self, request, count):
+        """Return the next `count` dogs plus a cursor for the next page."""
+        try:
+            count = int(count)
+        except ValueError:
+            raise ValidationError({'count': 'A valid integer is required.'})
+        if not 1 <= count <= self.max_page_size:
+            raise ValidationError({'count': 'Must be between 1 and {}.'.format(
+                self.max_page_size)})
+
+        dog_filter = self.kwargs.get('dog_filter')
+        pk = int(self.kwargs.get('pk'))
+        if dog_filter == 'undecided':
+            dogs, cursor = queries.next_dogs(request.user, dog_filter, pk,
+                                             count, self.undecided_ordering())
+            versions = [(dog.pk, dog.updated_at) for dog in dogs]
+
+            def render():
+                return self.get_serializer(dogs, many=True).data
         else:
-            # If there are no filtered dogs
-            raise Http404
+            versions, has_match = queries.next_decided(
+                request.user, dog_filter, pk, count + 1)
+            if not versions and not has_match:
+                raise Http404
+            cursor = versions[count - 1][0] if len(versions) > count else None
+            versions = versions[:count]
+
+            def render():
+                return cards.dog_cards(versions)
+
+        def respond():
+            results = render()
+            return Response({
+                'results': results,
+                'next': cursor,
+                'images': [queries.dog_image_url(dog['image_filename'])
+                           for dog in results],
+            })
+
+        return conditional.conditional_response(
+            request,
+            conditional.make_etag('dogs', cursor, *(
+                '{}.{}'.format(dog_id, conditional.timestamp(updated_at))
+                for dog_id, updated_at in versions)),
+            None,
+            respond
+        )
 
 
 class DogViewSet(
+    budgets.QueryBudgetMixin,
+    routers.ReplicaReadMixin,
     mixins.CreateModelMixin,
     mixins.RetrieveModelMixin,
     mixins.UpdateModelMixin,
     mixins.DestroyModelMixin,
     viewsets.GenericViewSet):
     permission_classes = (permissions.IsAuthenticated,)
+    query_budget = {
+        None: budgets.Budget(queries=6, sql_ms=50),
+        # Token, dog version and the dog.
+        'retrieve': budgets.Budget(queries=3, sql_ms=20),
+        'liked': budgets.Budget(queries=4, sql_ms=30),
+        'disliked': budgets.Budget(queries=4, sql_ms=30),
+        'undecided': budgets.Budget(queries=4, sql_ms=30),
+        'decisions': budgets.Budget(queries=8, sql_ms=200),
+        'similar': budgets.Budget(queries=3, sql_ms=20),
+        'dog_stats': budgets.Budget(queries=2, sql_ms=20),
+    }
     queryset = models.Dog.objects.all()
     serializer_class = serializers.DogSerializer
+    max_decisions = 500
+    replica_actions = ('retrieve',)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Answer 304 from the cached dog version, without a query."""
+        try:
+            updated_at = conditional.dog_version(int(kwargs['pk']))
+        except ValueError:
+            raise Http404
+        if updated_at is None:
+            raise Http404
+        return conditional.conditional_response(
+            request,
+            conditional.make_etag(
+                'dog', kwargs['pk'], conditional.timestamp(updated_at)),
+            updated_at,
+            lambda: super(DogViewSet, self).retrieve(
+                request, *args, **kwargs)
+        )
+
+    def decide(self, request, pk, status):
+        """Record the user's decision on the dog without fetching it."""
+        try:
+            dog_id = int(pk)
+        except ValueError:
+            raise Http404
+        user_dog = decisions.record_decision(request.user, dog_id, status)
+        serializer = serializers.UserDogSerializer(user_dog)
+        return Response(serializer.data)
 
     # /api/dog/<pk>/liked/
     @detail_route(methods=['post', 'put'])
     def liked(self, request, pk=None):
-        user = request.user
-        dog = self.get_object()
-        user_dog, created = models.UserDog.objects.get_or_create(
-            user=user, dog=dog
-        )
-        user_dog.status = 'l'
-        user_dog.save()
-        serializer = serializers.UserDogSerializer(user_dog)
-        return Response(serializer.data)
+        return self.decide(request, pk, 'l')
 
-    # /api/dog/<pk>/diksliked/
+    # /api/dog/<pk>/disliked/
     @detail_route(methods=['post', 'put'])
     def disliked(self, request, pk=None):
-        user = request.user
-        dog = self.get_object()
-        user_dog, created = models.UserDog.objects.get_or_create(
-            user=user, dog=dog
-        )
-        user_dog.status = 'd'
-        user_dog.save()
-        serializer = serializers.UserDogSerializer(user_dog)
-        return Response(serializer.data)
+        return self.decide(request, pk, 'd')
 
     # /api/dog/<pk>/undecided/
     @detail_route(methods=['post', 'put'])
     def undecided(self, request, pk=None):
-        user = request.user
-        dog = self.get_object()
-        user_dog, created = models.UserDog.objects.get_or_create(
-            user=user, dog=dog
+        return self.decide(request, pk, 'u')
+
+    # /api/dog/<pk>/similar/?count=<n>
+    @detail_route(methods=['get'])
+    def similar(self, request, pk=None):
+        """Return the `count` (default 10) dogs most similar to this one."""
+        if not similarity.is_enabled():
+            raise NotFound('Similar dogs are not available.')
+        try:
+            dog_id = int(pk)
+        except ValueError:
+            raise Http404
+        try:
+            count = int(request.query_params.get('count', 10))
+        except ValueError:
+            raise ValidationError({'count': 'A valid integer is required.'})
+        if not 1 <= count <= GetFilteredDog.max_page_size:
+            raise ValidationError({'count': 'Must be between 1 and {}.'.format(
+                GetFilteredDog.max_page_size)})
+
+        dog_ids = similarity.similar_to(dog_id, count)
+        if dog_ids is None:
+            raise Http404
+        versions = conditional.dog_versions(dog_ids)
+        return Response({'results': cards.dog_cards(
+            [(dog_id, versions[dog_id])
+             for dog_id in dog_ids if dog_id in versions])})
+
+    # /api/dog/<pk>/stats/
+    @detail_route(methods=['get'], url_path='stats',
+                  permission_classes=(permissions.IsAdminUser,))
+    def dog_stats(self, request, pk=None):
+        """Staff-only likes, dislikes and like rate per preference segment."""
+        try:
+            dog_id = int(pk)
+        except ValueError:
+            raise Http404
+        if conditional.dog_version(dog_id) is None:
+            raise Http404
+        return Response({'dog': dog_id, 'segments': stats.dog_stats(dog_id)})
+
+    # /api/dog/decisions/
+    @list_route(methods=['post'])
+    def decisions(self, request):
+        '''
+        Record a list of {"dog": <pk>, "status": "l"|"d"|"u"} decisions at
+        once and return one result per item, in order.
+        '''
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of decisions.')
+        if len(request.data) > self.max_decisions:
+            raise ValidationError('At most {} decisions per request.'.format(
+                self.max_decisions))
+
+        items = [serializers.DecisionSerializer(data=item)
+                 for item in request.data]
+        valid = [item.validated_data for item in items if item.is_valid()]
+        recorded = decisions.record_decisions(
+            request.user,
+            [(decision['dog'], decision['status']) for decision in valid]
         )
-        user_dog.status = 'u'
-        user_dog.save()
-        serializer = serializers.UserDogSerializer(user_dog)
-        return Response(serializer.data)
+
+        results = []
+        for item in items:
+            if item.errors:
+                results.append({'errors': item.errors})
+            elif item.validated_data['dog'] not in recorded:
+                results.append(dict(item.validated_data, errors={
+                    'dog': ['Not found.']}))
+            else:
+                results.append(dict(item.validated_data))
+        return Response(results)
 
 
 class UserPrefViewSet(
+    budgets.QueryBudgetMixin,
+    routers.ReplicaReadMixin,
     mixins.RetrieveModelMixin,
     mixins.UpdateModelMixin,
     viewsets.GenericViewSet):
     """View to get and update User Preferences."""
     permission_classes = (permissions.IsAuthenticated,)
+    query_budget = budgets.Budget(queries=4, sql_ms=30)
     queryset = models.UserPref.objects.all()
     serializer_class = serializers.UserPrefSerializer
+    replica_actions = ('preferences',)
+
+    @staticmethod
+    def comma_separated(value):
+        """Store lists of choices the way the UI sends them: "b,y,a"."""
+        if isinstance(value, (list, tuple)):
+            return ','.join(value)
+        return value
 
     # /api/user/preferences/
     @list_route(methods=['get', 'put'])
     def preferences(self, request, pk=None):
         user = request.user
-        user_pref = models.UserPref.objects.get(user=user)
 
-        if request.method == 'PUT':
+        if request.method == 'GET':
+            user_pref = models.UserPref.for_user(user)
+        else:
+            user_pref = models.UserPref.objects.get(user=user)
             data = request.data
-            user_pref.age = data.get('age')
-            user_pref.gender = data.get('gender')
-            user_pref.size = data.get('size')
+            user_pref.age = self.comma_separated(data.get('age'))
+            user_pref.gender = self.comma_separated(data.get('gender'))
+            user_pref.size = self.comma_separated(data.get('size'))
             user_pref.save()
 
-        serializer = serializers.UserPrefSerializer(user_pref)
-        return Response(serializer.data)
+        return conditional.conditional_response(
+            request,
+            conditional.make_etag(
+                'prefs', user.pk, conditional.timestamp(user_pref.updated_at)),
+            user_pref.updated_at,
+            lambda: Response(serializers.UserPrefSerializer(user_pref).data)
+        )
 
 
-class IsStaff(RetrieveAPIView):
+class IsStaff(budgets.QueryBudgetMixin, RetrieveAPIView):
     """View to get whether the current user is staff or not."""
+    query_budget = budgets.Budget(queries=1, sql_ms=10)
     serializer_class = serializers.StaffUserSerializer
 
     def get_object(self):
         return self.request.user
+
+
+class WriteBehindStats(budgets.QueryBudgetMixin, APIView):
+    """Staff-only view of the write-behind decision buffer."""
+    permission_classes = (permissions.IsAdminUser,)
+    query_budget = budgets.Budget(queries=1, sql_ms=10)
+
+    def get(self, request, format=None):
+        return Response(dict(
+            decisions.buffer.stats(),
+            enabled=decisions.write_behind_enabled()
+        ))
+
+
+class QueryBudgetReport(budgets.QueryBudgetMixin, APIView):
+    '''
+    Staff-only list of the budgeted views of this process, worst offenders
+    first, with the normalized SQL of their worst breaching request.
+    '''
+    permission_classes = (permissions.IsAdminUser,)
+    query_budget = budgets.Budget(queries=1, sql_ms=10)
+
+    def get(self, request, format=None):
+        return Response(dict(
+            views=budgets.registry.report(),
+            enabled=budgets.is_enabled(),
+            strict=budgets.is_strict()
+        ))
+
+
+class ProfilingReport(budgets.QueryBudgetMixin, APIView):
+    '''
+    Staff-only histograms of the sampled requests of this process, per URL
+    name, most total wall time first.
+    '''
+    permission_classes = (permissions.IsAdminUser,)
+    query_budget = budgets.Budget(queries=1, sql_ms=10)
+
+    def get(self, request, format=None):
+        return Response(dict(
+            routes=profiling.registry.report(),
+            enabled=profiling.is_enabled(),
+            sample_rate=profiling.sample_rate()
+        ))
+
+
+class DecisionExport(APIView):
+    '''
+    Staff-only streaming export of the decisions joined with their dog and
+    user.
+
+    Query parameters: `output` (csv or jsonl, default csv), `user` (only
+    export that user's decisions) and `gzip` (1 to compress the export).
+    '''
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        params = request.query_params
+        export_format = params.get('output', 'csv')
+        if export_format not in exports.FORMATS:
+            raise ValidationError({'output': 'Must be one of {}.'.format(
+                ', '.join(exports.FORMATS))})
+        user_id = params.get('user')
+        if user_id is not None:
+            try:
+                user_id = int(user_id)
+            except ValueError:
+                raise ValidationError(
+                    {'user': 'A valid integer is required.'})
+        compress = params.get('gzip') in ('1', 'true')
+
+        response = StreamingHttpResponse(
+            exports.export(export_format, user_id, compress),
+            content_type=('application/gzip' if compress
+                          else exports.CONTENT_TYPES[export_format])
+        )
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            exports.filename(export_format, user_id, compress))
+        return response
+
+
+def prometheus_metrics(request):
+    '''
+    The counters and histograms of every worker in the Prometheus text
+    format. Like most scrape targets it is not authenticated; keep it off
+    the public network.
+    '''
+    if not metrics.is_enabled():
+        raise Http404
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,185 @@
+"""
+Write-behind buffer for swipe decisions.
+
+With `PUGORUGH_WRITE_BEHIND = True` the decision actions do not write to
+`UserDog` themselves. They put the decision in an in-process buffer, which
+a background thread flushes in batches every
+`PUGORUGH_WRITE_BEHIND_INTERVAL_MS` milliseconds, or as soon as
+`PUGORUGH_WRITE_BEHIND_BATCH` decisions are pending. Later decisions on the
+same (user, dog) pair replace earlier pending ones. Pending decisions are
+flushed when the process exits. A batch being flushed stays visible to
+`pending_for` until the writer returns, so that decisions are never
+missing from both the buffer and the database.
+
+Subclasses can buffer other keyed values by overriding `merge` and
+`restore` (see `pugorugh.stats.DeltaBuffer`).
+
+SQLite takes one writer at a time, and with a shared cache (the in-memory
+test database) a second connection writing meanwhile fails at once with
+"database table is locked" instead of waiting. Code writing from a flush
+thread or from a request takes `serialized_writes()`, so that the writes
+of one process to SQLite never overlap.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_sqlite_writes = threading.RLock()
+
+
+@contextmanager
+def serialized_writes(using):
+    """Hold the write lock of this process when `using` is SQLite."""
+    if connections[using].vendor != 'sqlite':
+        yield
+        return
+    with _sqlite_writes:
+        yield
+
+
+class DecisionBuffer(object):
+    """Pending (user_id, dog_id) -> status decisions plus a flush thread."""
+
+    def __init__(self, writer, interval=0.2, batch_size=500, autostart=True,
+                 name='pugorugh-write-behind'):
+        # `writer` receives a list of (user_id, dog_id, status) rows.
+        self.writer = writer
+        self.name = name
+        self.interval = interval
+        self.batch_size = batch_size
+        self.autostart = autostart
+        self._pending = OrderedDict()
+        # The batch being written, one flush at a time.
+        self._inflight = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.flushes = 0
+        self.failures = 0
+        self.flushed = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flush thread and flush whatever is still pending."""
+        thread = self._thread
+        self._stopped = True
+        self._wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    def add(self, user_id, dog_id, status):
+        self.put((user_id, dog_id), status)
+
+    def put(self, key, value):
+        with self._lock:
+            self.merge(key, value)
+            depth = len(self._pending)
+        if self.autostart and self._thread is None:
+            self.start()
+        if depth >= self.batch_size:
+            self._wakeup.set()
+
+    def merge(self, key, value):
+        """Queue `value`; a later decision replaces a pending one."""
+        self._pending.pop(key, None)
+        self._pending[key] = value
+
+    def restore(self, batch):
+        """Queue a batch again after a failed flush."""
+        # Decisions made since take precedence over the failed ones.
+        for key, value in batch.items():
+            self._pending.setdefault(key, value)
+
+    def pending_for(self, user_id):
+        '''
+        Return the pending (dog_id, status) decisions of a user, including
+        those of a flush not committed yet.
+        '''
+        found = OrderedDict()
+        with self._lock:
+            # Pending decisions were made after the in-flight ones.
+            for entries in (self._inflight, self._pending):
+                for (pending_user_id, dog_id), status in entries.items():
+                    if pending_user_id == user_id:
+                        found[dog_id] = status
+        return list(found.items())
+
+    def depth(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write every pending decision; return the number written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+                self._inflight = batch
+            if not batch:
+                return 0
+            try:
+                return self._write(batch)
+            finally:
+                with self._lock:
+                    self._inflight = OrderedDict()
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            self.writer([key + (value,) for key, value in batch.items()])
+        except Exception:
+            logger.exception('Flushing %d entries of %s failed',
+                             len(batch), self.name)
+            self.failures += 1
+            with self._lock:
+                self.restore(batch)
+            return 0
+
+        elapsed = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed += len(batch)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        return len(batch)
+
+    def _run(self):
+        try:
+            while not self._stopped:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                self.flush()
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'running': self._thread is not None,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'flushed': self.flushed,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 3),
+            'max_flush_ms': round(self.max_flush_seconds * 1000, 3),
+        }